@@ -5,6 +5,7 @@ from . import alias
 # Initialize DB on startup
 driver = get_driver()
 driver.on_startup(handlers.init_data)
+driver.on_shutdown(handlers.shutdown_data)
 
 # --- Command Matchers ---
 
@@ -43,3 +44,31 @@ list_memes_cmd.handle()(handlers.handle_list_memes)
 # 9. Help: "/help"
 help_cmd = on_command("有啥花活", priority=10, block=True)
 help_cmd.handle()(handlers.handle_help)
+
+# 10. DB Status: "/图库状态" (Superuser only)
+status_cmd = on_command("图库状态", priority=5, block=True)
+status_cmd.handle()(handlers.handle_status)
+
+# 11. Re-encode: "/压缩图库 [keyword] [--kb N]" (Superuser only)
+reencode_cmd = on_command("压缩图库", priority=5, block=True)
+reencode_cmd.handle()(handlers.handle_reencode)
+
+# 12. Export: "/导出图库 [group_id] [--zip]" (Superuser only)
+export_cmd = on_command("导出图库", priority=5, block=True)
+export_cmd.handle()(handlers.handle_export)
+
+# 13. Import: "/导入图库 file_name [target_id]" (Superuser only)
+import_cmd = on_command("导入图库", priority=5, block=True)
+import_cmd.handle()(handlers.handle_import)
+
+# 14. Maintenance: "/维护图库" (Superuser only; also runs daily at MEME_MAINTENANCE_HOUR)
+maintenance_cmd = on_command("维护图库", priority=5, block=True)
+maintenance_cmd.handle()(handlers.handle_maintenance)
+
+# 15. Hot Memes: "热门图库 [days]"
+hot_memes_cmd = on_startswith("热门图库", priority=10, block=True)
+hot_memes_cmd.handle()(handlers.handle_hot_memes)
+
+# 16. Search: "搜索表情 text"
+search_memes_cmd = on_startswith("搜索表情", priority=10, block=True)
+search_memes_cmd.handle()(handlers.handle_search_memes)
@@ -1,20 +1,20 @@
 from nonebot.adapters.onebot.v11 import MessageEvent
 from nonebot.matcher import Matcher
 
-from . import db
+from .repository import repo
 from .utils import get_context_id
 
 class AliasManager:
     @staticmethod
-    def add_alias(real_name: str, alias_name: str, context_id: str) -> str:
+    async def add_alias(real_name: str, alias_name: str, context_id: str) -> str:
         name1 = real_name.lower()
         name2 = alias_name.lower()
         
         if name1 == name2:
             return "别名不能和原名一样"
 
-        lib1_id = db.get_library_id(name1, context_id)
-        lib2_id = db.get_library_id(name2, context_id)
+        lib1_id = await repo.get_library_id(name1, context_id)
+        lib2_id = await repo.get_library_id(name2, context_id)
         
         # Case 1: Both exist
         if lib1_id and lib2_id:
@@ -23,20 +23,20 @@ class AliasManager:
                  
             # Different libraries -> Merge
             try:
-                db.merge_libraries(lib2_id, lib1_id)
+                await repo.merge_libraries(lib2_id, lib1_id)
                 return f"检测到 '{name1}' 和 '{name2}' 都有图库，已将它们合并！\n现在 '{name2}' 的图也都归 '{name1}' 啦。"
             except Exception as e:
                 return f"合并失败：{e}"
                 
         # Case 2: Only 1 exists (Add alias)
         elif lib1_id and not lib2_id:
-            if db.add_name_to_library(name2, lib1_id, context_id):
+            if await repo.add_name_to_library(name2, lib1_id, context_id):
                 return f"成功！以后叫 '{name2}' 也可以。"
             else:
                  return f"添加失败。"
                  
         elif not lib1_id and lib2_id:
-            db.add_name_to_library(name1, lib2_id, context_id)
+            await repo.add_name_to_library(name1, lib2_id, context_id)
             return f"成功！以后叫 '{name1}' 也可以。"
                  
         # Case 3: Neither exists
@@ -44,19 +44,19 @@ class AliasManager:
             return f"找不到 '{name1}' 也没有 '{name2}'，你先添加点图呗？"
 
     @staticmethod
-    def remove_alias(target_name: str, context_id: str) -> str:
+    async def remove_alias(target_name: str, context_id: str) -> str:
         target_name = target_name.lower()
-        lib_id = db.get_library_id(target_name, context_id)
+        lib_id = await repo.get_library_id(target_name, context_id)
         if not lib_id:
             return f"找不到 '{target_name}'"
             
         try:
             # Check if it's the last name
-            all_names = db.get_library_names(lib_id)
+            all_names = await repo.get_library_names(lib_id)
             if len(all_names) <= 1:
                 return f"'{target_name}' 是这个图库唯一的这类名字了，删了就找不到了！"
                 
-            if db.remove_name(target_name, context_id):
+            if await repo.remove_name(target_name, context_id):
                 return f"已删除名字 '{target_name}'"
             else:
                 return f"删除失败。"
@@ -64,13 +64,13 @@ class AliasManager:
             return f"删除失败：{e}"
             
     @staticmethod
-    def list_aliases(name: str, context_id: str) -> str:
+    async def list_aliases(name: str, context_id: str) -> str:
         name = name.lower()
-        lib_id = db.get_library_id(name, context_id)
+        lib_id = await repo.get_library_id(name, context_id)
         if not lib_id:
             return f"找不到图库 '{name}'"
             
-        names = db.get_library_names(lib_id)
+        names = await repo.get_library_names(lib_id)
         if names:
             names_str = "、".join(names)
             return f"这个图库的名字有：\n{names_str}"
@@ -92,7 +92,7 @@ async def handle_add_alias(matcher: Matcher, event: MessageEvent):
     alias_name = args[1]
     
     context_id = get_context_id(event)
-    result = AliasManager.add_alias(real_name, alias_name, context_id)
+    result = await AliasManager.add_alias(real_name, alias_name, context_id)
     await matcher.finish(result)
 
 async def handle_del_alias(matcher: Matcher, event: MessageEvent):
@@ -105,7 +105,7 @@ async def handle_del_alias(matcher: Matcher, event: MessageEvent):
         return
 
     context_id = get_context_id(event)
-    result = AliasManager.remove_alias(target_name, context_id)
+    result = await AliasManager.remove_alias(target_name, context_id)
     await matcher.finish(result)
 
 async def handle_list_alias(matcher: Matcher, event: MessageEvent):
@@ -118,5 +118,5 @@ async def handle_list_alias(matcher: Matcher, event: MessageEvent):
         return
         
     context_id = get_context_id(event)
-    result = AliasManager.list_aliases(name, context_id)
+    result = await AliasManager.list_aliases(name, context_id)
     await matcher.finish(result)
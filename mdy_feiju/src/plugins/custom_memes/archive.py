@@ -0,0 +1,390 @@
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Dict, IO, Iterator, List, Optional, Set
+
+from nonebot.log import logger
+
+from . import db
+from .hash_index import hex_to_int
+
+# Archive layout:
+#   manifest.json    format/version, source group, counts
+#   libraries.jsonl  {"idx": n, "names": [primary, alias, ...]} per library
+#   memes.jsonl      {"library": idx, "type", "phash", "digest", "format", "size", "segments"} per meme
+#   blobs/<sha256>   each payload once, byte-for-byte as stored
+ARCHIVE_FORMAT = "custom_memes"
+ARCHIVE_VERSION = 1
+
+# Where the chat commands write and read archives (env override, like MEME_DB_PATH)
+env_export_dir = os.getenv("MEME_EXPORT_DIR")
+if env_export_dir:
+    EXPORT_DIR = Path(env_export_dir)
+else:
+    EXPORT_DIR = db.DB_PATH.parent / "meme_exports"
+
+IMPORT_BATCH_SIZE = 200
+
+
+class ArchiveError(Exception):
+    """Raised for unreadable or incompatible archives."""
+
+
+# --- Container wrappers: same interface for tar and zip ---
+
+class _TarWriter:
+    def __init__(self, path: Path):
+        self._tar = tarfile.open(path, "w")
+
+    def add_stream(self, name: str, fileobj: IO[bytes], size: int):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        self._tar.addfile(info, fileobj)
+
+    def close(self):
+        self._tar.close()
+
+
+class _ZipWriter:
+    def __init__(self, path: Path):
+        # Memes are already compressed images; deflating them again only costs CPU
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def add_stream(self, name: str, fileobj: IO[bytes], size: int):
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        with self._zip.open(info, "w", force_zip64=size > 0x7FFFFFFF) as out:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                out.write(chunk)
+
+    def close(self):
+        self._zip.close()
+
+
+class _TarReader:
+    def __init__(self, path: Path):
+        self._tar = tarfile.open(path, "r")
+        # Member headers only; the data stays on disk until a member is opened
+        self._members = {m.name: m for m in self._tar.getmembers() if m.isfile()}
+
+    def open(self, name: str) -> Optional[IO[bytes]]:
+        member = self._members.get(name)
+        return self._tar.extractfile(member) if member is not None else None
+
+    def close(self):
+        self._tar.close()
+
+
+class _ZipReader:
+    def __init__(self, path: Path):
+        self._zip = zipfile.ZipFile(path, "r")
+        self._names = set(self._zip.namelist())
+
+    def open(self, name: str) -> Optional[IO[bytes]]:
+        return self._zip.open(name) if name in self._names else None
+
+    def close(self):
+        self._zip.close()
+
+
+def _open_reader(path: Path):
+    if zipfile.is_zipfile(path):
+        return _ZipReader(path)
+    try:
+        return _TarReader(path)
+    except tarfile.TarError:
+        raise ArchiveError(f"不是有效的图库归档：{path.name}")
+
+
+def _iter_jsonl(fileobj: IO[bytes]) -> Iterator[dict]:
+    for line in io.TextIOWrapper(fileobj, encoding="utf-8"):
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+# --- Export ---
+
+def export_group(group_id: str, path: Path, fmt: str = "tar") -> Dict[str, int]:
+    """
+    Write every library of `group_id` (names, aliases, memes) to an archive at `path`.
+
+    Blobs are copied from the blob store one file at a time, each unique digest once;
+    the JSONL indexes are spooled to temp files, so memory stays flat however big the
+    group is. A blob that vanishes mid-export (meme deleted meanwhile) skips that meme.
+    Returns counts: libraries, memes, blobs, bytes, missing.
+    """
+    libraries = db.get_group_libraries(group_id)
+    lib_idx = {lib_id: idx for idx, (lib_id, _) in enumerate(libraries)}
+    stats = {"libraries": len(libraries), "memes": 0, "blobs": 0, "bytes": 0, "missing": 0}
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    writer = _ZipWriter(path) if fmt == "zip" else _TarWriter(path)
+    written: Set[str] = set()
+
+    def add_blob(digest: str) -> bool:
+        if digest in written:
+            return True
+        try:
+            with open(db.blob_store.path_for(digest), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                writer.add_stream(f"blobs/{digest}", f, size)
+        except (FileNotFoundError, ValueError):
+            return False
+        written.add(digest)
+        stats["blobs"] += 1
+        stats["bytes"] += size
+        return True
+
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as memes_file:
+            for lib_id, image_id, digest, size, img_format, phash, meme_type in db.iter_group_memes(group_id):
+                segments = None
+                if meme_type == "mixed":
+                    segments = [list(ref) for ref in db.get_segment_refs(image_id)]
+                    blob_digests = [ref[2] for ref in segments if ref[0] == "image"]
+                else:
+                    blob_digests = [digest]
+                if not all(add_blob(d) for d in blob_digests):
+                    stats["missing"] += 1
+                    continue
+
+                record = {
+                    "library": lib_idx[lib_id], "type": meme_type, "phash": phash,
+                    "digest": digest, "format": img_format, "size": size, "segments": segments,
+                }
+                memes_file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+                stats["memes"] += 1
+
+            libraries_data = "".join(
+                json.dumps({"idx": idx, "names": names}, ensure_ascii=False) + "\n"
+                for idx, (_, names) in enumerate(libraries)
+            ).encode("utf-8")
+            writer.add_stream("libraries.jsonl", io.BytesIO(libraries_data), len(libraries_data))
+
+            memes_size = memes_file.tell()
+            memes_file.seek(0)
+            writer.add_stream("memes.jsonl", memes_file, memes_size)
+
+        manifest = json.dumps({
+            "format": ARCHIVE_FORMAT,
+            "version": ARCHIVE_VERSION,
+            "group_id": group_id,
+            "created_at": int(time.time()),
+            "libraries": stats["libraries"],
+            "memes": stats["memes"],
+            "blobs": stats["blobs"],
+            "bytes": stats["bytes"],
+        }, ensure_ascii=False, indent=2).encode("utf-8")
+        writer.add_stream("manifest.json", io.BytesIO(manifest), len(manifest))
+    except BaseException:
+        writer.close()
+        path.unlink(missing_ok=True)
+        raise
+    writer.close()
+
+    logger.info(f"[CustomMemes] Exported {group_id} to {path}: {stats}")
+    return stats
+
+
+# --- Import ---
+
+def _read_manifest(reader) -> dict:
+    fileobj = reader.open("manifest.json")
+    if fileobj is None:
+        raise ArchiveError("归档里没有 manifest.json")
+    with fileobj:
+        manifest = json.load(fileobj)
+    if manifest.get("format") != ARCHIVE_FORMAT:
+        raise ArchiveError("不是图库归档")
+    if manifest.get("version", 0) > ARCHIVE_VERSION:
+        raise ArchiveError(f"归档版本 v{manifest.get('version')} 太新，当前只支持到 v{ARCHIVE_VERSION}")
+    return manifest
+
+
+def _valid_record(record: dict) -> bool:
+    """
+    memes.jsonl comes from outside: accept only the shapes export_group() writes.
+    Every blob digest must be a sha256 hex digest, so it can't name a path outside the store.
+    """
+    if not isinstance(record, dict) or not isinstance(record.get("library"), int):
+        return False
+    if not isinstance(record.get("phash"), str):
+        return False
+    meme_type = record.get("type")
+    if meme_type == "image":
+        return db.blob_store.is_digest(record.get("digest"))
+    if meme_type != "mixed" or record.get("digest") != "":
+        return False
+    segments = record.get("segments")
+    if not isinstance(segments, list) or not segments:
+        return False
+    for ref in segments:
+        if not isinstance(ref, list) or len(ref) != 3:
+            return False
+        kind, text, digest = ref
+        if kind == "text":
+            if not isinstance(text, str) or digest is not None:
+                return False
+        elif kind == "image":
+            if text is not None or not db.blob_store.is_digest(digest):
+                return False
+        else:
+            return False
+    return True
+
+
+def _is_near(phash: str, accepted: List[int], threshold: int) -> bool:
+    try:
+        value = hex_to_int(phash)
+    except (TypeError, ValueError):
+        return False
+    return any(bin(value ^ other).count("1") <= threshold for other in accepted)
+
+
+def _import_batch(reader, batch: List[dict], lib_map: Dict[int, int], threshold: int,
+                  stats: Dict[str, int]):
+    # Dedup against what the target library already has (in-memory hash index / exact hash)
+    # and against earlier memes of the same batch
+    accepted: List[dict] = []
+    batch_hashes: Dict[int, List[int]] = {}
+    batch_exact: Set[tuple] = set()
+    for record in batch:
+        lib_id = lib_map[record["library"]]
+        meme_type, phash = record["type"], record["phash"]
+        if db.find_duplicate(lib_id, phash, meme_type, threshold):
+            stats["duplicates"] += 1
+            continue
+        if meme_type == "image" and phash:
+            hashes = batch_hashes.setdefault(lib_id, [])
+            if _is_near(phash, hashes, threshold):
+                stats["duplicates"] += 1
+                continue
+            try:
+                hashes.append(hex_to_int(phash))
+            except (TypeError, ValueError):
+                pass
+        else:
+            key = (lib_id, meme_type, phash)
+            if key in batch_exact:
+                stats["duplicates"] += 1
+                continue
+            batch_exact.add(key)
+        accepted.append(record)
+
+    if not accepted:
+        return
+
+    def copy_blob(digest: str) -> int:
+        fileobj = reader.open(f"blobs/{digest}")
+        if fileobj is None:
+            raise KeyError(digest)
+        with fileobj:
+            return db.blob_store.put_stream(fileobj, expected_digest=digest)[1]
+
+    # Stream and verify the blobs without holding the writer lock, so adds and
+    # usage flushes carry on while a batch is copied
+    rows = []
+    row_digests = []
+    for record in accepted:
+        if record["type"] == "mixed":
+            refs = [tuple(ref) for ref in record["segments"]]
+            digests = [ref[2] for ref in refs if ref[0] == "image"]
+        else:
+            refs = None
+            digests = [record["digest"]]
+        try:
+            size = sum(copy_blob(digest) for digest in digests)
+        except (KeyError, ValueError) as e:
+            logger.warning(f"[CustomMemes] Import: skipping meme with bad blob {e}")
+            stats["failed"] += 1
+            continue
+        if refs is None:
+            record["size"] = size
+        rows.append((lib_map[record["library"]], record["digest"], record["size"],
+                     record.get("format"), record["phash"], record["type"], refs))
+        row_digests.extend(digests)
+
+    # Under the lock only to insert. A blob that was already stored may have been
+    # released by a concurrent delete since it was checked; copy those again first
+    with db.connections.write():
+        for digest in set(row_digests):
+            if not db.blob_store.exists(digest):
+                copy_blob(digest)
+        db.insert_meme_rows(rows)
+    stats["added"] += len(rows)
+
+
+def import_archive(path: Path, group_id: Optional[str] = None, batch_size: int = IMPORT_BATCH_SIZE,
+                   threshold: int = 18) -> Dict[str, int]:
+    """
+    Load an archive made by export_group() into `group_id` (default: the group it came from).
+
+    Libraries are matched by any of their names, or created with all their aliases.
+    memes.jsonl is streamed record by record and committed `batch_size` memes per
+    transaction; every blob is streamed into the blob store and checked against its
+    digest. Memes that duplicate the target library (same dHash rules as 添加) or an
+    earlier meme in the archive are skipped.
+    Returns counts: libraries, added, duplicates, failed.
+    """
+    reader = _open_reader(path)
+    try:
+        manifest = _read_manifest(reader)
+        target = group_id or manifest["group_id"]
+
+        libraries_file = reader.open("libraries.jsonl")
+        memes_file = reader.open("memes.jsonl")
+        if libraries_file is None or memes_file is None:
+            raise ArchiveError("归档不完整，缺少 libraries.jsonl 或 memes.jsonl")
+
+        lib_map: Dict[int, int] = {}
+        with libraries_file:
+            for record in _iter_jsonl(libraries_file):
+                names = [name.lower() for name in record["names"] if name]
+                if names:
+                    lib_map[record["idx"]] = db.get_or_create_library(names, target)
+
+        stats = {"libraries": len(lib_map), "added": 0, "duplicates": 0, "failed": 0}
+        next_report = time.perf_counter() + 5
+        with memes_file:
+            batch: List[dict] = []
+            for record in _iter_jsonl(memes_file):
+                if not _valid_record(record) or record["library"] not in lib_map:
+                    stats["failed"] += 1
+                    continue
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    _import_batch(reader, batch, lib_map, threshold, stats)
+                    batch = []
+                    if time.perf_counter() >= next_report:
+                        logger.info(f"[CustomMemes] Importing {path.name}: {stats}")
+                        next_report = time.perf_counter() + 5
+            _import_batch(reader, batch, lib_map, threshold, stats)
+    finally:
+        reader.close()
+
+    logger.info(f"[CustomMemes] Imported {path.name} into {target}: {stats}")
+    return stats
+
+
+def resolve_archive(name: str) -> Path:
+    """An archive in EXPORT_DIR by bare file name; anything that would leave the directory is rejected."""
+    if not name or Path(name).name != name or name in (".", ".."):
+        raise ArchiveError("只能指定导出目录里的文件名")
+    path = EXPORT_DIR / name
+    if not path.is_file():
+        raise ArchiveError(f"找不到归档：{name}")
+    return path
+
+
+def new_export_path(group_id: str, fmt: str = "tar") -> Path:
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return EXPORT_DIR / f"memes-{group_id}-{stamp}.{'zip' if fmt == 'zip' else 'tar'}"
@@ -0,0 +1,105 @@
+"""
+Benchmark for dHash near-duplicate lookups.
+
+Compares, per library size:
+  - loop:   the old check_duplicate path (imagehash.hex_to_hash + subtraction per row)
+  - numpy:  PackedHashes vectorized XOR + popcount scan
+  - bktree: BKTree.nearest
+
+Usage:
+    python bench_dedup.py
+    python bench_dedup.py --sizes 10000 100000 1000000 --queries 5
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import imagehash
+
+# Standalone script: import the index module directly, without the NoneBot plugin package
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from hash_index import BKTree, PackedHashes  # noqa: E402
+
+THRESHOLDS = (3, 18)
+
+
+def make_hashes(n: int, rng: random.Random):
+    return [rng.getrandbits(64) for _ in range(n)]
+
+
+def make_queries(hashes, count: int, rng: random.Random):
+    # Half near-copies of stored hashes (hits), half random (mostly misses)
+    queries = []
+    for i in range(count):
+        if i % 2 == 0:
+            base = rng.choice(hashes)
+            for _ in range(rng.randint(0, 4)):
+                base ^= 1 << rng.randrange(64)
+            queries.append(base)
+        else:
+            queries.append(rng.getrandbits(64))
+    return queries
+
+
+def loop_nearest(hex_hashes, query_hex: str, threshold: int):
+    query_obj = imagehash.hex_to_hash(query_hex)
+    for i, stored in enumerate(hex_hashes):
+        if query_obj - imagehash.hex_to_hash(stored) <= threshold:
+            return i
+    return None
+
+
+def timed(fn, queries):
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="dHash duplicate lookup benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--loop-max", type=int, default=100_000,
+                        help="skip the (very slow) Python loop above this library size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'size':>9} {'method':>7} {'thr':>4} {'build ms':>10} {'query ms':>10}")
+
+    for size in args.sizes:
+        hashes = make_hashes(size, rng)
+        queries = make_queries(hashes, args.queries, rng)
+        entries = [(h, i) for i, h in enumerate(hashes)]
+
+        start = time.perf_counter()
+        packed = PackedHashes(entries)
+        packed_build = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        tree = BKTree(entries)
+        tree_build = (time.perf_counter() - start) * 1000
+
+        hex_hashes = None
+        if size <= args.loop_max:
+            hex_hashes = [f"{h:016x}" for h in hashes]
+
+        for threshold in THRESHOLDS:
+            if hex_hashes is not None:
+                ms = timed(lambda q: loop_nearest(hex_hashes, f"{q:016x}", threshold), queries)
+                print(f"{size:>9} {'loop':>7} {threshold:>4} {'-':>10} {ms:>10.2f}")
+            else:
+                print(f"{size:>9} {'loop':>7} {threshold:>4} {'-':>10} {'skipped':>10}")
+
+            ms = timed(lambda q: packed.nearest(q, threshold), queries)
+            print(f"{size:>9} {'numpy':>7} {threshold:>4} {packed_build:>10.1f} {ms:>10.2f}")
+
+            ms = timed(lambda q: tree.nearest(q, threshold), queries)
+            print(f"{size:>9} {'bktree':>7} {threshold:>4} {tree_build:>10.1f} {ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
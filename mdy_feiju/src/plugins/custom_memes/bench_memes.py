@@ -0,0 +1,339 @@
+"""
+Synthetic-load benchmark for the custom_memes plugin.
+
+  generate: build a synthetic memes.db + blob store, N groups x M libraries x K images,
+            with a realistic size mix (small PNG stickers, JPEG photos, animated GIFs)
+            and aliases on some libraries. Identical pictures are shared across groups,
+            like popular memes are.
+  run:      time get_meme, add_meme, check_duplicate, delete_meme, get_all_library_names
+            and the cached 查看图库 listing against that data, with the downloader stubbed
+            out (optionally with a fake network delay). Reports p50/p99 latency and
+            throughput per operation and writes them to a JSON file; --compare prints
+            the change against an earlier results file.
+
+Everything lives under --data-dir (never the bot's own MEME_DB_PATH).
+
+Usage:
+    python bench_memes.py generate --groups 5 --libraries 20 --images 30
+    python bench_memes.py run --iterations 300 --concurrency 8
+    python bench_memes.py run --download-ms 50 --compare bench_results/bench-20260101-120000.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import imagehash
+import numpy as np
+from PIL import Image
+
+# (kind, share of images); GIFs are the animated reaction images
+SIZE_MIX = (("sticker", 0.55), ("photo", 0.25), ("large", 0.08), ("gif", 0.12))
+ALIAS_RATIO = 0.3
+OPERATIONS = ("get_meme", "add_meme", "check_duplicate", "delete_meme", "get_all_library_names", "get_listing")
+
+
+def make_image(rng: random.Random, kind: str) -> bytes:
+    """A picture with its own dHash: random low-res blocks scaled up, plus some grain."""
+    seed = rng.getrandbits(32)
+    np_rng = np.random.RandomState(seed)
+
+    def frame(size: Tuple[int, int], grain: int) -> Image.Image:
+        blocks = np_rng.randint(0, 255, (9, 10, 3), dtype=np.uint8)
+        img = Image.fromarray(blocks).resize(size, Image.BILINEAR)
+        if grain:
+            # A tiled noise patch is enough to give JPEGs a photo-like size, and is cheap
+            tile = np_rng.randint(-grain, grain + 1, (64, 64, 3)).astype(np.int16)
+            noise = np.tile(tile, (size[1] // 64 + 1, size[0] // 64 + 1, 1))[:size[1], :size[0]]
+            img = Image.fromarray(np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+        return img
+
+    def gif_frame(side: int, palette: List[int]) -> Image.Image:
+        # Paletted blocks, so saving as GIF needs no quantization
+        blocks = Image.fromarray(np_rng.randint(0, 256, (9, 10), dtype=np.uint8), mode="P")
+        blocks.putpalette(palette)
+        return blocks.resize((side, side), Image.NEAREST)
+
+    buf = io.BytesIO()
+    if kind == "sticker":
+        side = rng.randint(96, 240)
+        frame((side, side), 0).save(buf, format="PNG")
+    elif kind == "photo":
+        frame((rng.randint(320, 720), rng.randint(320, 720)), 12).save(buf, format="JPEG", quality=85)
+    elif kind == "large":
+        frame((rng.randint(900, 1600), rng.randint(900, 1600)), 16).save(buf, format="JPEG", quality=90)
+    else:
+        side = rng.randint(120, 240)
+        palette = np_rng.randint(0, 256, 768).tolist()
+        frames = [gif_frame(side, palette) for _ in range(rng.randint(4, 10))]
+        frames[0].save(buf, format="GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+    return buf.getvalue()
+
+
+def pick_kind(rng: random.Random) -> str:
+    return rng.choices([k for k, _ in SIZE_MIX], weights=[w for _, w in SIZE_MIX])[0]
+
+
+def dhash_of(data: bytes) -> str:
+    return str(imagehash.dhash(Image.open(io.BytesIO(data))))
+
+
+def group_id(g: int) -> str:
+    return str(100000 + g)
+
+
+def library_name(g: int, m: int) -> str:
+    return f"库{g}_{m}"
+
+
+def generate(db, groups: int, libraries: int, images: int, seed: int) -> Dict[str, int]:
+    """Fill an empty memes.db. Returns what was written."""
+    rng = random.Random(seed)
+    # A shared pool, so the same picture shows up in several groups (as with real memes);
+    # within a library every picture is distinct
+    pool_size = max(images * 2, min(groups * libraries * images, 400))
+    pool = []
+    for _ in range(pool_size):
+        data = make_image(rng, pick_kind(rng))
+        pool.append((data, dhash_of(data), db.blob_store.put(data)))
+
+    stats = {"libraries": 0, "aliases": 0, "memes": 0}
+    for g in range(groups):
+        gid = group_id(g)
+        for m in range(libraries):
+            name = library_name(g, m)
+            lib_id = db.create_library(name, gid)
+            stats["libraries"] += 1
+            if rng.random() < ALIAS_RATIO:
+                for a in range(rng.randint(1, 3)):
+                    db.add_name_to_library(f"{name}别名{a}", lib_id, gid)
+                    stats["aliases"] += 1
+            rows = []
+            for data, phash, digest in rng.sample(pool, images):
+                rows.append((lib_id, digest, len(data), Image.open(io.BytesIO(data)).format.lower(), phash, "image", None))
+            db.insert_meme_rows(rows)
+            stats["memes"] += len(rows)
+    return stats
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+async def measure(op: Callable[[int], Awaitable[object]], count: int, concurrency: int) -> Dict[str, float]:
+    """Run op(0..count-1), at most `concurrency` at once. Latencies in ms, throughput in ops/s."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await op(i)
+            except Exception as e:
+                errors.append(str(e))
+                return
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    wall = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    wall = time.perf_counter() - wall
+    if errors:
+        print(f"  {len(errors)} call(s) failed, e.g. {errors[0]}")
+    if not latencies:
+        return {"count": count, "errors": len(errors)}
+    return {
+        "count": count,
+        "errors": len(errors),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "max_ms": round(max(latencies), 3),
+        "throughput_ops": round(count / wall, 1),
+    }
+
+
+async def run_benchmarks(db, iterations: int, concurrency: int, download_ms: float, seed: int) -> Dict[str, dict]:
+    from nonebot.adapters.onebot.v11 import Message, MessageSegment
+    from src.plugins.custom_memes import data_source
+    from src.plugins.custom_memes.data_source import MemeManager
+    from src.plugins.custom_memes.repository import repo
+
+    rng = random.Random(seed)
+    with db.connections.read() as conn:
+        names = conn.execute("SELECT name, library_id, group_id FROM names").fetchall()
+        hashes = conn.execute(
+            "SELECT library_id, dhash FROM images WHERE dhash IS NOT NULL ORDER BY random() LIMIT ?", (iterations,)
+        ).fetchall()
+    if not names:
+        raise SystemExit("No data; run `generate` first")
+    group_ids = sorted({gid for _, _, gid in names})
+
+    # Stub downloader: "bench://<n>" urls served from memory after an optional fake delay
+    downloads: Dict[str, bytes] = {}
+
+    async def fake_download(url: str, max_bytes: int = 0) -> bytes:
+        if download_ms:
+            await asyncio.sleep(download_ms / 1000)
+        return downloads[url]
+
+    data_source.download_url = fake_download
+
+    # Memes to add: mostly new pictures, a quarter re-sends of the same ones (duplicates)
+    targets = [rng.choice(names) for _ in range(iterations)]
+    fresh = [make_image(rng, pick_kind(rng)) for _ in range(max(1, iterations * 3 // 4))]
+    for i in range(iterations):
+        downloads[f"bench://{i}"] = fresh[i % len(fresh)]
+
+    def image_message(i: int) -> Message:
+        # What the adapter delivers for a received picture: file plus download url
+        return Message(MessageSegment("image", {"file": f"{i}.image", "url": f"bench://{i}"}))
+
+    async def add_meme(i: int):
+        result, _ = await MemeManager.add_meme(targets[i][0], image_message(i), targets[i][2])
+        if "失败" in result:
+            raise RuntimeError(result)
+
+    async def delete_meme(i: int):
+        result = await MemeManager.delete_meme(targets[i][0], image_message(i), targets[i][2])
+        if "失败" in result:
+            raise RuntimeError(result)
+
+    def near_copy(dhash: int) -> str:
+        value = dhash & 0xFFFFFFFFFFFFFFFF
+        for _ in range(rng.randint(0, 4)):
+            value ^= 1 << rng.randrange(64)
+        return f"{value:016x}"
+
+    checks = [(lib_id, near_copy(h) if i % 2 == 0 else f"{rng.getrandbits(64):016x}")
+              for i, (lib_id, h) in enumerate(hashes)] or [(names[0][1], "0" * 16)]
+    lookups = [rng.choice(names) for _ in range(iterations)]
+
+    operations = {
+        "get_meme": lambda i: MemeManager.get_meme(lookups[i][0], lookups[i][2]),
+        "add_meme": add_meme,
+        "check_duplicate": lambda i: repo.check_duplicate(*checks[i % len(checks)]),
+        # Removes what add_meme added, so repeated runs see about the same data
+        "delete_meme": delete_meme,
+        "get_all_library_names": lambda i: repo.get_all_library_names(group_ids[i % len(group_ids)]),
+        "get_listing": lambda i: MemeManager.get_listing(group_ids[i % len(group_ids)]),
+    }
+
+    results = {}
+    for name in OPERATIONS:
+        results[name] = result = await measure(operations[name], iterations, concurrency)
+        if "p50_ms" in result:
+            print(f"{name:>22} p50 {result['p50_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  "
+                  f"{result['throughput_ops']:>9.1f} ops/s")
+    repo.shutdown()
+    return results
+
+
+def dataset_info(db) -> Dict[str, int]:
+    with db.connections.read() as conn:
+        groups, libraries = conn.execute("SELECT COUNT(DISTINCT group_id), COUNT(*) FROM libraries").fetchone()
+        memes, gifs = conn.execute("SELECT COUNT(*), COALESCE(SUM(format = 'gif'), 0) FROM images").fetchone()
+        names = conn.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+    blob_bytes = sum(p.stat().st_size for p in db.blob_store.root.glob("*/*/*") if p.is_file())
+    return {
+        "groups": groups, "libraries": libraries, "names": names, "memes": memes, "gifs": gifs,
+        "db_bytes": sum(p.stat().st_size for p in db.DB_PATH.parent.glob(db.DB_PATH.name + "*")),
+        "blob_bytes": blob_bytes,
+    }
+
+
+def compare(results: Dict[str, dict], previous_path: Path):
+    previous = json.loads(previous_path.read_text(encoding="utf-8"))["operations"]
+    print(f"\nvs {previous_path}:")
+    for name, current in results.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        changes = []
+        for key in ("p50_ms", "p99_ms", "throughput_ops"):
+            if old.get(key) and key in current:
+                changes.append(f"{key} {(current[key] - old[key]) / old[key]:+.0%}")
+        print(f"{name:>22} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", type=Path, default=Path("bench_data"),
+                        help="where the synthetic memes.db and blob store live")
+    parser.add_argument("--seed", type=int, default=0)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen_parser = sub.add_parser("generate", help="build the synthetic dataset")
+    gen_parser.add_argument("--groups", type=int, default=5)
+    gen_parser.add_argument("--libraries", type=int, default=20, help="libraries per group")
+    gen_parser.add_argument("--images", type=int, default=30, help="images per library")
+
+    run_parser = sub.add_parser("run", help="time the operations")
+    run_parser.add_argument("--iterations", type=int, default=200, help="calls per operation")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="calls in flight at once")
+    run_parser.add_argument("--download-ms", type=float, default=0.0, help="fake download delay")
+    run_parser.add_argument("-o", "--output", type=Path,
+                            help="results file (default: bench_results/bench-<time>.json)")
+    run_parser.add_argument("--compare", type=Path, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    # db reads these on import
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+    os.environ["MEME_DB_PATH"] = str(args.data_dir.resolve() / "memes.db")
+    os.environ["MEME_BLOB_DIR"] = str(args.data_dir.resolve() / "meme_blobs")
+
+    # The plugin package needs a NoneBot driver to import; a bare one is enough here
+    import nonebot
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..")))
+    nonebot.init(driver="~none")
+    from src.plugins.custom_memes import db
+    from src.plugins.custom_memes.pipeline import pipeline
+
+    db.init_db()
+    if args.command == "generate":
+        with db.connections.read() as conn:
+            if conn.execute("SELECT 1 FROM libraries LIMIT 1").fetchone():
+                raise SystemExit(f"{args.data_dir} already has data; pick another --data-dir")
+        start = time.perf_counter()
+        stats = generate(db, args.groups, args.libraries, args.images, args.seed)
+        print(f"Generated {stats} in {time.perf_counter() - start:.1f}s: {dataset_info(db)}")
+        return
+
+    try:
+        results = asyncio.run(run_benchmarks(db, args.iterations, args.concurrency, args.download_ms, args.seed))
+    finally:
+        pipeline.shutdown()
+
+    output = args.output or Path("bench_results") / time.strftime("bench-%Y%m%d-%H%M%S.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "params": {
+            "iterations": args.iterations, "concurrency": args.concurrency,
+            "download_ms": args.download_ms, "seed": args.seed,
+        },
+        "dataset": dataset_info(db),
+        "operations": results,
+    }
+    output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+class BlobStore:
+    """
+    Content-addressed file store for meme payloads.
+    Each blob lives at <root>/<aa>/<bb>/<sha256>, so identical bytes are only written once.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    @staticmethod
+    def digest_of(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def is_digest(value: str) -> bool:
+        """True for a well-formed sha256 hex digest (64 lowercase hex characters)."""
+        return isinstance(value, str) and _DIGEST_RE.fullmatch(value) is not None
+
+    def path_for(self, digest: str) -> Path:
+        # Digests can come from outside (archives), so never build a path from anything else
+        if not self.is_digest(digest):
+            raise ValueError(f"malformed blob digest: {digest!r}")
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def exists(self, digest: str) -> bool:
+        return self.is_digest(digest) and self.path_for(digest).exists()
+
+    def put(self, data: bytes) -> str:
+        """Store bytes and return their sha256 digest. Existing blobs are not rewritten."""
+        digest = self.digest_of(data)
+        path = self.path_for(digest)
+        if path.exists():
+            return digest
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file in the same directory, then rename atomically,
+        # so a crash never leaves a truncated blob under its final name.
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def put_stream(self, fileobj: BinaryIO, expected_digest: Optional[str] = None,
+                   chunk_size: int = 1024 * 1024) -> Tuple[str, int]:
+        """
+        Store a stream without holding it in memory; returns (digest, size).
+        The digest is computed while copying; if it doesn't match `expected_digest`
+        the data is discarded and ValueError is raised. A malformed `expected_digest`
+        is rejected up front.
+        """
+        if expected_digest is not None and not self.is_digest(expected_digest):
+            raise ValueError(f"malformed blob digest: {expected_digest!r}")
+        # A blob already in the store was verified when it was written
+        if expected_digest and self.exists(expected_digest):
+            return expected_digest, self.path_for(expected_digest).stat().st_size
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        try:
+            hasher = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    chunk = fileobj.read(chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            digest = hasher.hexdigest()
+            if expected_digest and digest != expected_digest:
+                raise ValueError(f"blob digest mismatch: expected {expected_digest}, got {digest}")
+
+            path = self.path_for(digest)
+            if path.exists():
+                os.remove(tmp_path)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, path)
+            return digest, size
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def get(self, digest: str) -> bytes:
+        return self.path_for(digest).read_bytes()
+
+    def delete(self, digest: str) -> int:
+        """Remove a blob. Returns the number of bytes freed (0 if it was missing)."""
+        path = self.path_for(digest)
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def iter_digests(self) -> Iterator[str]:
+        if not self.root.exists():
+            return
+        for path in self.root.glob("*/*/*"):
+            if path.is_file() and self.is_digest(path.name):
+                yield path.name
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator
+
+from nonebot.log import logger
+
+
+class ConnectionManager:
+    """
+    Long-lived SQLite connections for memes.db.
+
+    - Readers: one connection per thread, opened lazily and reused for the life of the thread.
+    - Writer: a single shared connection behind a lock, so writes are serialized and
+      never fight each other for the database lock.
+
+    Every connection runs in WAL mode (readers don't block the writer and vice versa),
+    with a busy timeout, memory-mapped reads and a prepared statement cache.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        busy_timeout_ms: int = 5000,
+        mmap_size: int = 256 * 1024 * 1024,
+        cached_statements: int = 256,
+        slow_query_ms: float = 200.0,
+    ):
+        self.db_path = Path(db_path)
+        self.busy_timeout_ms = busy_timeout_ms
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.slow_query_ms = slow_query_ms
+
+        self._local = threading.local()
+        self._all_connections = []
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.connections_opened = 0
+        self.reads = 0
+        self.writes = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+        self.write_wait_time = 0.0
+        self.max_read_time = 0.0
+        self.max_write_time = 0.0
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+            check_same_thread=check_same_thread,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        with self._stats_lock:
+            self.connections_opened += 1
+            self._all_connections.append(conn)
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _record(self, kind: str, elapsed: float):
+        with self._stats_lock:
+            if kind == "read":
+                self.reads += 1
+                self.read_time += elapsed
+                self.max_read_time = max(self.max_read_time, elapsed)
+            else:
+                self.writes += 1
+                self.write_time += elapsed
+                self.max_write_time = max(self.max_write_time, elapsed)
+        if elapsed * 1000 >= self.slow_query_ms:
+            logger.warning(f"[CustomMemes] Slow {kind} on memes.db: {elapsed * 1000:.1f} ms")
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """Borrow this thread's read connection."""
+        conn = self._reader()
+        start = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            self._record("read", time.perf_counter() - start)
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """
+        Hold the single writer connection.
+        Commits when the block exits normally, rolls back if it raises.
+        """
+        wait_start = time.perf_counter()
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._connect(check_same_thread=False)
+            start = time.perf_counter()
+            with self._stats_lock:
+                self.write_wait_time += start - wait_start
+            try:
+                yield self._writer
+                self._writer.commit()
+            except BaseException:
+                self._writer.rollback()
+                raise
+            finally:
+                self._record("write", time.perf_counter() - start)
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                "connections_opened": self.connections_opened,
+                "reads": self.reads,
+                "writes": self.writes,
+                "avg_read_ms": (self.read_time / self.reads * 1000) if self.reads else 0.0,
+                "avg_write_ms": (self.write_time / self.writes * 1000) if self.writes else 0.0,
+                "max_read_ms": self.max_read_time * 1000,
+                "max_write_ms": self.max_write_time * 1000,
+                "write_wait_ms": self.write_wait_time * 1000,
+            }
+
+    def close(self):
+        """Close every connection this manager opened (e.g. on shutdown)."""
+        with self._write_lock, self._stats_lock:
+            for conn in self._all_connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._all_connections.clear()
+            self._writer = None
+            self._local = threading.local()
@@ -1,77 +1,222 @@
-from typing import Optional, Tuple, List, Union
-import imagehash
-import json
-import base64
+import asyncio
 import hashlib
-from PIL import Image
-from io import BytesIO
+import os
+import time
+from typing import Awaitable, Callable, Optional, Tuple, List, Union
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
+from nonebot.log import logger
 
 from . import db
-from .utils import resize_image, download_url
+from .utils import download_url, download_many
+from .pipeline import pipeline
+from .repository import repo
+from .usage import usage_counter, today
+
+# Batch add (env overrides, like MEME_DB_PATH): images downloaded/processed at once, and per command
+BATCH_ADD_WORKERS = int(os.getenv("MEME_BATCH_WORKERS", "4"))
+BATCH_ADD_MAX = int(os.getenv("MEME_BATCH_MAX", "100"))
+
+
+def _file_key(segment: MessageSegment) -> Optional[str]:
+    """Source key from the segment's QQ file name (usually the image MD5 plus an extension)."""
+    name = segment.data.get("file") or ""
+    if not name or "://" in name:
+        return None
+    return f"file:{name.rsplit('.', 1)[0].lower()}"
+
+
+def _sent_file_key(data: bytes) -> str:
+    """The file key QQ gives these bytes once the bot sends them (their MD5)."""
+    return f"file:{hashlib.md5(data).hexdigest()}"
+
+
+def _raw_key(data: bytes) -> str:
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
 
 class MemeManager:
     @staticmethod
-    def get_meme(trigger_text: str, context_id: str) -> Tuple[Optional[Union[Message, MessageSegment]], str]:
+    async def get_meme(trigger_text: str, context_id: str) -> Tuple[Optional[Union[Message, MessageSegment]], str]:
         """
         Find a meme based on trigger text using prefix matching.
         Returns (message_or_segment, matched_name).
         """
-        # Prefix Maximum Matching
-        for i in range(len(trigger_text), 0, -1):
-            potential_name = trigger_text[:i].strip()
-            if not potential_name:
-                continue
+        # Prefix Maximum Matching: one pass over the text through the in-memory name trie,
+        # longest matching library name first
+        lowered = trigger_text.lower()
+        loaded, matches = db.name_index.try_longest_matches(lowered, context_id)
+        if not loaded:
+            # First use (or just invalidated): build the trie on the reader pool
+            matches = await repo.match_library_names(lowered, context_id)
+        for matched, lib_id in matches:
+            # Report the name as the user typed it (lower() can change length for a few characters)
+            if len(lowered) == len(trigger_text):
+                potential_name = trigger_text[:len(matched)].strip()
+            else:
+                potential_name = matched.strip()
+
+            msg, image_id = await MemeManager._random_message(lib_id)
+            if msg is not None:
+                usage_counter.record(context_id, lib_id, image_id)
+                return msg, potential_name
                 
-            # Try to find in current group
-            lib_id = db.get_library_id(potential_name.lower(), context_id)
-            
-            if lib_id:
-                data, meme_type = db.get_random_image(lib_id)
-                if data:
-                    if meme_type == "image":
-                        return MessageSegment.image(data), potential_name
-                    elif meme_type == "mixed":
-                        try:
-                            # Deserialize mixed content
-                            content_list = json.loads(data.decode("utf-8"))
-                            msg = Message()
-                            for seg in content_list:
-                                if seg["type"] == "text":
-                                    msg.append(MessageSegment.text(seg["data"]["text"]))
-                                elif seg["type"] == "image":
-                                    img_bytes = base64.b64decode(seg["data"]["file"])
-                                    msg.append(MessageSegment.image(img_bytes))
-                            return msg, potential_name
-                        except Exception as e:
-                            print(f"Error deserializing mixed meme: {e}")
-                            return None, ""
-                    
         return None, ""
 
     @staticmethod
-    def get_all_memes(context_id: str) -> List[str]:
+    async def suggest_names(trigger_text: str, context_id: str) -> List[str]:
+        """Names close to what was asked for, when get_meme matched nothing ("did you mean")."""
+        # The name is what comes before any trailing chatter ("来只猫猫 快点")
+        parts = trigger_text.split()
+        if not parts:
+            return []
+        return await repo.suggest_library_names(parts[0], context_id)
+
+    @staticmethod
+    async def _random_message(library_id: int) -> Tuple[Optional[Union[Message, MessageSegment]], Optional[int]]:
         """
-        Get all meme/library names for the current context.
-        Returns a formatted strings list.
+        A random meme of the library, ready to send, and its image id. Hot memes come from
+        the send cache, which holds the built message (images already base64-encoded by the adapter).
         """
-        libs = db.get_all_library_names(context_id)
-        
-        formatted_names = []
-        for primary, aliases in libs:
-            if aliases:
-               formatted_names.append(f"{primary} (别名: {', '.join(aliases)})")
-            else:
-               formatted_names.append(primary)
-               
-        return formatted_names
+        for _ in range(2):
+            loaded, image_id = db.random_index.try_pick(library_id)
+            if not loaded:
+                # First use (or just invalidated): load the library on the reader pool
+                image_id = await repo.pick_random_image(library_id)
+            if image_id is None:
+                return None, None
+
+            msg = db.send_cache.get(image_id)
+            if msg is not None:
+                return msg, image_id
+
+            data, meme_type = await repo.get_image(image_id)
+            if not meme_type:
+                # Row vanished underneath the index; reload the library and retry once
+                db.random_index.invalidate(library_id)
+                continue
+            if not data:
+                return None, None
+
+            msg = MemeManager.build_message(data, meme_type)
+            db.send_cache.put(image_id, msg, MemeManager._message_size(msg))
+            return msg, image_id
+        return None, None
+
+    @staticmethod
+    def _message_size(msg: Union[Message, MessageSegment]) -> int:
+        """Approximate memory held by a built message: its base64 image strings and text."""
+        segments = [msg] if isinstance(msg, MessageSegment) else msg
+        size = 0
+        for seg in segments:
+            if seg.type == "image":
+                size += len(seg.data.get("file") or "")
+            elif seg.type == "text":
+                size += len(seg.data.get("text", "").encode("utf-8"))
+        return size
+
+    @staticmethod
+    def build_message(data: Union[bytes, db.Segments], meme_type: str) -> Union[Message, MessageSegment]:
+        """Turn stored meme content (image bytes or a mixed segment list) into something sendable."""
+        if meme_type == "mixed":
+            msg = Message()
+            for kind, value in data:
+                if kind == "text":
+                    msg.append(MessageSegment.text(value))
+                elif kind == "image":
+                    msg.append(MessageSegment.image(value))
+            return msg
+        return MessageSegment.image(data)
 
     @staticmethod
-    async def add_meme(category_name: str, message: Message, context_id: str, force: bool = False) -> Tuple[str, Optional[bytes]]:
+    async def _collect_segments(segments: List[MessageSegment]) -> db.Segments:
+        """
+        Download and prepare (resize/re-encode) the images of a text+image message, keeping segment order.
+        All images are fetched and processed concurrently, so this takes as long as the slowest one.
+        """
+        urls = [seg.data.get("url") for seg in segments if seg.type == "image"]
+        raw_images = await download_many(urls)
+        images = iter(await asyncio.gather(*(pipeline.prepare_bytes(raw) for raw in raw_images)))
+
+        collected = []
+        for seg in segments:
+            if seg.type == "text":
+                collected.append(("text", seg.data["text"]))
+            elif seg.type == "image":
+                collected.append(("image", next(images)))
+        return collected
+
+    @staticmethod
+    async def get_listing(context_id: str) -> Tuple[int, List[str]]:
+        """
+        (library count, listing texts of up to LISTING_CHUNK_SIZE libraries each) for 查看图库.
+        Served from the in-memory listing; only a context's first request reads the DB.
+        """
+        listing = db.library_listing.get(context_id)
+        if listing is None:
+            listing = await repo.get_library_listing(context_id)
+        return listing
+
+    @staticmethod
+    async def get_hot_memes(context_id: str, days: int, library_limit: int = 10, image_limit: int = 5
+                            ) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int, Union[Message, MessageSegment]]]]:
+        """
+        Most-sent libraries and memes of the context over the last `days` days.
+        Returns ([(library_name, count)], [(library_name, count, message)]).
+        """
+        # Count what is still buffered too; if the DB is busy, the stored counts will do
+        try:
+            await usage_counter.flush()
+        except Exception as e:
+            logger.warning(f"[CustomMemes] Failed to flush usage stats before ranking: {e}")
+        since = today() - days + 1
+
+        libraries = []
+        for lib_id, count in await repo.top_libraries(context_id, since, library_limit):
+            name = await MemeManager._primary_name(lib_id)
+            if name:
+                libraries.append((name, count))
+
+        images = []
+        for lib_id, image_id, count in await repo.top_images(context_id, since, image_limit):
+            name = await MemeManager._primary_name(lib_id)
+            msg = await MemeManager._stored_message(image_id)
+            if name and msg is not None:
+                images.append((name, count, msg))
+        return libraries, images
+
+    @staticmethod
+    async def search_memes(query: str, context_id: str, limit: int = 10) -> List[Tuple[str, Union[Message, MessageSegment]]]:
+        """Memes of the context whose text contains `query`, best match first: [(library_name, message)]."""
+        results = []
+        for lib_id, image_id in await repo.search_memes(context_id, query, limit):
+            name = await MemeManager._primary_name(lib_id)
+            msg = await MemeManager._stored_message(image_id)
+            if name and msg is not None:
+                results.append((name, msg))
+        return results
+
+    @staticmethod
+    async def _primary_name(library_id: int) -> Optional[str]:
+        names = await repo.get_library_names(library_id)
+        return min(names, key=lambda x: (len(x), x)) if names else None
+
+    @staticmethod
+    async def _stored_message(image_id: int) -> Optional[Union[Message, MessageSegment]]:
+        """A specific meme ready to send (from the send cache if it's there), or None if it's gone."""
+        msg = db.send_cache.get(image_id)
+        if msg is None:
+            data, meme_type = await repo.get_image(image_id)
+            if not data:
+                return None
+            msg = MemeManager.build_message(data, meme_type)
+        return msg
+
+    @staticmethod
+    async def add_meme(category_name: str, message: Message, context_id: str, force: bool = False) -> Tuple[str, Optional[Union[bytes, db.Segments]]]:
         """
         Add a meme to the library.
-        Returns (result_message, duplicate_image_data).
-        If duplicate_image_data is not None, means a duplicate was found.
+        Returns (result_message, duplicate_data).
+        If duplicate_data is not None, means a duplicate was found
+        (image bytes, or the segment list of a mixed meme).
         """
         try:
             # Filter supported segments (text and image)
@@ -98,78 +243,100 @@ class MemeManager:
     @staticmethod
     async def _add_image_type(category_name: str, segment: MessageSegment, context_id: str, force: bool) -> Tuple[str, Optional[bytes]]:
         img_url = segment.data.get("url")
-        raw_img_data = await download_url(img_url)
-        
-        # Resize image
-        final_img_data = resize_image(raw_img_data)
-        
-        # Calculate hash
-        check_img = Image.open(BytesIO(final_img_data))
-        new_hash = str(imagehash.dhash(check_img))
+        # An image seen before (same QQ file, or same downloaded bytes) is already stored:
+        # reuse its blob and hash instead of downloading, decoding and hashing it again
+        keys = [_file_key(segment)]
+        known = await repo.find_image_source(keys)
+        final_img_data = None
+        if known is None:
+            raw_img_data = await download_url(img_url)
+            keys.append(_raw_key(raw_img_data))
+            known = await repo.find_image_source(keys[-1:])
+            if known is None:
+                # Resize image and calculate hash in the worker pool
+                final_img_data, new_hash = await pipeline.prepare_image(raw_img_data)
+        if known is not None:
+            digest, new_hash = known
         
         # Get or Create Library
-        lib_id = db.get_library_id(category_name.lower(), context_id)
-        if not lib_id:
-            lib_id = db.create_library(category_name.lower(), context_id)
-            
+        lib_id = await repo.get_or_create_library([category_name.lower()], context_id)
+
         # Check duplicates
         if not force:
-            is_dup, dup_img = db.check_duplicate(lib_id, new_hash, meme_type="image")
+            is_dup, dup_img = await repo.check_duplicate(lib_id, new_hash, meme_type="image")
             if is_dup:
                 return "水过了！你老冯的\n瞪大你的狗眼看看是不是这个：", dup_img
+
+        if final_img_data is None:
+            if await repo.add_image_by_digest(lib_id, digest, new_hash) is not None:
+                await repo.register_image_sources(keys, digest, new_hash)
+                return f"成功添加{category_name}！", None
+            # The stored copy was released meanwhile; process it after all
+            final_img_data, new_hash = await pipeline.prepare_image(await download_url(img_url))
         
-        db.add_image(lib_id, final_img_data, new_hash, meme_type="image")
+        await repo.add_image(lib_id, final_img_data, new_hash, meme_type="image")
+        keys.append(_sent_file_key(final_img_data))
+        await repo.register_image_sources(keys, db.blob_store.digest_of(final_img_data), new_hash)
         return f"成功添加{category_name}！", None
 
     @staticmethod
-    async def _add_mixed_type(category_name: str, segments: List[MessageSegment], context_id: str, force: bool) -> Tuple[str, Optional[bytes]]:
-        serialized_segs = []
-        
-        for seg in segments:
-            if seg.type == "text":
-                serialized_segs.append({
-                    "type": "text",
-                    "data": {"text": seg.data["text"]}
-                })
-            elif seg.type == "image":
-                img_url = seg.data.get("url")
-                raw_data = await download_url(img_url)
-                final_data = resize_image(raw_data)
-                b64_data = base64.b64encode(final_data).decode("utf-8")
-                serialized_segs.append({
-                    "type": "image",
-                    "data": {"file": b64_data}
-                })
-        
-        json_data = json.dumps(serialized_segs, ensure_ascii=False)
-        data_bytes = json_data.encode("utf-8")
+    async def _add_mixed_type(category_name: str, segments: List[MessageSegment], context_id: str, force: bool) -> Tuple[str, Optional[db.Segments]]:
+        mixed_segs = await MemeManager._collect_segments(segments)
         
         # MD5 hash for exact matching of mixed content
-        new_hash = hashlib.md5(data_bytes).hexdigest()
+        new_hash = db.mixed_meme_hash(mixed_segs)
         
         # Get or Create Library
-        lib_id = db.get_library_id(category_name.lower(), context_id)
-        if not lib_id:
-            lib_id = db.create_library(category_name.lower(), context_id)
-            
+        lib_id = await repo.get_or_create_library([category_name.lower()], context_id)
+
         # Check duplicates
         if not force:
-            is_dup, dup_img = db.check_duplicate(lib_id, new_hash, meme_type="mixed")
+            is_dup, dup_img = await repo.check_duplicate(lib_id, new_hash, meme_type="mixed")
             if is_dup:
-                # For mixed type duplicate, we might need to handle the return differently 
-                # since dup_img is the JSON data.
-                # But existing handlers expect bytes for image.
-                # Let's render it? Or just return text?
-                # For simplicity, we can let the handler try to display it, 
-                # but handlers.py expects image bytes to wrap in MessageSegment.image.
-                # We should probably return None or handle it in handler.
-                # To be consistent with existing logic, let's just return the data bytes,
-                # and let the handler (which we will update) handle it.
+                # dup_img is the stored segment list; the handler renders it with build_message
                 return "水过了！内容完全一致。", dup_img
 
-        db.add_image(lib_id, data_bytes, new_hash, meme_type="mixed")
+        await repo.add_image(lib_id, mixed_segs, new_hash, meme_type="mixed")
         return f"成功添加{category_name}！", None
 
+    @staticmethod
+    async def add_memes_batch(category_name: str, urls: List[str], context_id: str, force: bool = False) -> str:
+        """
+        Add every image as its own meme. Downloads and processing run concurrently,
+        at most BATCH_ADD_WORKERS at a time; a failed image is counted and skipped.
+        The survivors are deduplicated against the library and each other and
+        stored in one transaction. Returns the summary to send.
+        """
+        if not urls:
+            return "没有找到图片，批量添加失败。"
+        skipped = len(urls) - BATCH_ADD_MAX
+        urls = urls[:BATCH_ADD_MAX]
+
+        semaphore = asyncio.Semaphore(BATCH_ADD_WORKERS)
+
+        async def prepare(url: str) -> Optional[Tuple[bytes, str]]:
+            async with semaphore:
+                try:
+                    return await pipeline.prepare_image(await download_url(url))
+                except Exception as e:
+                    logger.warning(f"[CustomMemes] Batch add: failed to fetch/process {url}: {e}")
+                    return None
+
+        prepared = await asyncio.gather(*(prepare(url) for url in urls))
+        items = [item for item in prepared if item is not None]
+        failed = len(urls) - len(items)
+
+        added = duplicates = 0
+        if items:
+            lib_id = await repo.get_or_create_library([category_name.lower()], context_id)
+            new_ids, duplicates = await repo.add_images_batch(lib_id, items, force=force)
+            added = len(new_ids)
+
+        result = f"批量添加{category_name}：新增 {added} 张，重复 {duplicates} 张，失败 {failed} 张"
+        if skipped > 0:
+            result += f"\n一次最多添加 {BATCH_ADD_MAX} 张，剩下的 {skipped} 张没有处理"
+        return result
+
     @staticmethod
     async def delete_meme(category_name: str, message: Message, context_id: str) -> str:
         try:
@@ -190,38 +357,23 @@ class MemeManager:
             # Determine type (same logic as add)
             if len(segments) == 1 and segments[0].type == "image":
                 meme_type = "image"
-                img_url = segments[0].data.get("url")
-                target_img_data = await download_url(img_url)
-                target_img = Image.open(BytesIO(target_img_data))
-                target_hash = str(imagehash.dhash(target_img))
+                # Usually a meme the bot sent, so its QQ file id is known: no download needed
+                known = await repo.find_image_source([_file_key(segments[0])])
+                if known is None:
+                    img_url = segments[0].data.get("url")
+                    target_img_data = await download_url(img_url)
+                    known = await repo.find_image_source([_raw_key(target_img_data)])
+                target_hash = known[1] if known else await pipeline.dhash(target_img_data)
             else:
                 meme_type = "mixed"
-                serialized_segs = []
-                for seg in segments:
-                    if seg.type == "text":
-                        serialized_segs.append({
-                            "type": "text",
-                            "data": {"text": seg.data["text"]}
-                        })
-                    elif seg.type == "image":
-                        img_url = seg.data.get("url")
-                        raw_data = await download_url(img_url)
-                        final_data = resize_image(raw_data)
-                        b64_data = base64.b64encode(final_data).decode("utf-8")
-                        serialized_segs.append({
-                            "type": "image",
-                            "data": {"file": b64_data}
-                        })
-                
-                json_data = json.dumps(serialized_segs, ensure_ascii=False)
-                data_bytes = json_data.encode("utf-8")
-                target_hash = hashlib.md5(data_bytes).hexdigest()
+                mixed_segs = await MemeManager._collect_segments(segments)
+                target_hash = db.mixed_meme_hash(mixed_segs)
 
-            lib_id = db.get_library_id(category_name.lower(), context_id)
+            lib_id = await repo.get_library_id(category_name.lower(), context_id)
             deleted = False
             
             if lib_id:
-                deleted = db.delete_image_by_hash(lib_id, target_hash, meme_type=meme_type)
+                deleted = await repo.delete_image_by_hash(lib_id, target_hash, meme_type=meme_type)
             
             if deleted:
                 return f"已删除！{category_name}House"
@@ -232,44 +384,125 @@ class MemeManager:
             return f"删除失败：{e}，{category_name}别走😭"
 
     @staticmethod
-    def sync_memes(source_group: str, target_group: str, keyword: str) -> str:
+    def parse_context(raw: str) -> str:
+        """'p12345' -> private chat context, anything else is a group id."""
+        if raw.lower().startswith('p'):
+            return f"private_{raw[1:]}"
+        return raw
+
+    @staticmethod
+    async def sync_memes(source_group: str, target_group: str, keyword: str) -> str:
         """
         Sync memes from source group to target group for a specific keyword.
         """
-        def parse_context(raw: str) -> str:
-            if raw.lower().startswith('p'):
-                return f"private_{raw[1:]}"
-            return raw
-
-        src_ctx = parse_context(source_group)
-        tgt_ctx = parse_context(target_group)
+        src_ctx = MemeManager.parse_context(source_group)
+        tgt_ctx = MemeManager.parse_context(target_group)
         
         # 1. Check Source Category
-        source_lib_id = db.get_library_id(keyword.lower(), src_ctx)
+        source_lib_id = await repo.get_library_id(keyword.lower(), src_ctx)
         if not source_lib_id:
             return f"源 ({src_ctx}) 没有关于 '{keyword}' 的图片。"
             
-        # 2. Get Source Images
-        images = db.get_all_images(source_lib_id)
-        if not images:
+        # 2. Get/Create Target Category
+        target_lib_id = await repo.get_or_create_library([keyword.lower()], tgt_ctx)
+
+        # 3. Sync (dedup against the target and within the source in one pass)
+        count, skipped = await repo.sync_library(source_lib_id, target_lib_id)
+        if count == 0 and skipped == 0:
             return f"源 ({src_ctx}) 的 '{keyword}' 是空的。"
             
-        # 3. Get/Create Target Category
-        target_lib_id = db.get_library_id(keyword.lower(), tgt_ctx)
-        if not target_lib_id:
-            target_lib_id = db.create_library(keyword.lower(), tgt_ctx)
-            
-        # 4. Sync
-        count = 0
-        skipped = 0
-        
-        for img_data, img_phash, img_type in images:
-            is_dup, _ = db.check_duplicate(target_lib_id, img_phash, meme_type=img_type)
-            if is_dup:
-                skipped += 1
-                continue
-                
-            db.add_image(target_lib_id, img_data, img_phash, meme_type=img_type)
-            count += 1
-            
         return f"同步完成！\n关键字: {keyword}\n成功同步: {count} 张\n跳过重复: {skipped} 张"
+
+    @staticmethod
+    async def sync_all_memes(source_group: str, target_group: str,
+                             progress: Callable[[str], Awaitable[None]], progress_interval: float = 10.0) -> str:
+        """
+        Sync every library of the source group into the target group.
+        Libraries are matched by name (missing ones are created with all their aliases).
+        Each library is synced on the DB writer thread; `progress` gets a status line
+        at most every `progress_interval` seconds.
+        """
+        src_ctx = MemeManager.parse_context(source_group)
+        tgt_ctx = MemeManager.parse_context(target_group)
+
+        libraries = await repo.get_group_libraries(src_ctx)
+        if not libraries:
+            return f"源 ({src_ctx}) 没有任何图库。"
+
+        total_added = 0
+        total_skipped = 0
+        failed = []
+        last_report = time.monotonic()
+        for i, (src_lib_id, names) in enumerate(libraries, 1):
+            try:
+                target_lib_id = await repo.get_or_create_library(names, tgt_ctx)
+                added, skipped = await repo.sync_library(src_lib_id, target_lib_id)
+                total_added += added
+                total_skipped += skipped
+            except Exception as e:
+                logger.error(f"[CustomMemes] Sync of library {names[0]} failed: {e}")
+                failed.append(names[0])
+
+            if time.monotonic() - last_report >= progress_interval and i < len(libraries):
+                last_report = time.monotonic()
+                await progress(f"同步中... {i}/{len(libraries)} 个图库，已同步 {total_added} 张，跳过 {total_skipped} 张")
+
+        result = (
+            f"全部同步完成！\n{src_ctx} -> {tgt_ctx}\n"
+            f"图库: {len(libraries)} 个\n成功同步: {total_added} 张\n跳过重复: {total_skipped} 张"
+        )
+        if failed:
+            result += f"\n失败: {', '.join(failed)}"
+        return result
+
+    @staticmethod
+    async def reencode_memes(target_bytes: int, keyword: Optional[str] = None, context_id: Optional[str] = None) -> str:
+        """
+        Re-encode stored image memes larger than target_bytes (one library, or all of them).
+        Returns a summary with the bytes saved.
+        """
+        library_id = None
+        if keyword:
+            library_id = await repo.get_library_id(keyword.lower(), context_id)
+            if not library_id:
+                return f"没有叫 '{keyword}' 的图库。"
+
+        rows = await repo.get_large_images(target_bytes, library_id)
+        if not rows:
+            return "没有需要重新编码的图片。"
+
+        async def reencode_one(image_id: int) -> int:
+            data, _ = await repo.get_image(image_id)
+            if not data:
+                return 0
+            new_data, new_hash = await pipeline.reencode(data, target_bytes)
+            if len(new_data) >= len(data):
+                return 0
+            if not await repo.replace_image_data(image_id, new_data, new_hash):
+                return 0
+            return len(data) - len(new_data)
+
+        reencoded = 0
+        failed = 0
+        saved = 0
+        before = sum(size for _, size in rows)
+        # Keep at most one batch of jobs in flight, so we don't fill the pipeline queue
+        batch_size = pipeline.max_workers
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            results = await asyncio.gather(*(reencode_one(image_id) for image_id, _ in batch), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    failed += 1
+                elif result > 0:
+                    reencoded += 1
+                    saved += result
+
+        mb = 1024 * 1024
+        return (
+            f"重新编码完成！\n"
+            f"检查: {len(rows)} 张（共 {before / mb:.1f} MB）\n"
+            f"重新编码: {reencoded} 张\n"
+            f"失败: {failed} 张\n"
+            f"节省: {saved / mb:.1f} MB"
+        )
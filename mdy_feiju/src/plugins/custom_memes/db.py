@@ -1,11 +1,25 @@
 import sqlite3
 import imagehash
 import os
+import json
+import base64
+import hashlib
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Dict, Iterator, Optional, List, Tuple, Union
 from PIL import Image
 from io import BytesIO
 
+from .blob_store import BlobStore
+from .connection import ConnectionManager
+from .random_index import RandomIndex
+from .hash_index import HashIndex, hex_to_int, to_signed64, from_signed64, filter_new_hashes
+from .name_index import NameIndex
+from .library_listing import LibraryListing
+from .fuzzy_index import FuzzyNameIndex
+from .send_cache import SendCache
+from .migrations import Migration, run_migrations, iter_batches
+from .utils import MAX_DIMENSION, resize_image
+
 # Use environment variable for DB path if set, otherwise default to local file
 env_db_path = os.getenv("MEME_DB_PATH")
 if env_db_path:
@@ -13,8 +27,85 @@ if env_db_path:
 else:
     DB_PATH = Path(__file__).parent / "memes.db"
 
+# Image bytes live on disk next to the DB (i.e. on the data volume), not inside SQLite
+env_blob_dir = os.getenv("MEME_BLOB_DIR")
+if env_blob_dir:
+    BLOB_DIR = Path(env_blob_dir)
+else:
+    BLOB_DIR = DB_PATH.parent / "meme_blobs"
+
+blob_store = BlobStore(BLOB_DIR)
+
+# Pooled, long-lived connections (WAL, single serialized writer)
+connections = ConnectionManager(DB_PATH)
+
+# Memory budget for ready-to-send hot memes (MB, 0 disables)
+SEND_CACHE_MB = float(os.getenv("MEME_SEND_CACHE_MB", "64"))
+
+# A mixed meme in memory: [("text", str) | ("image", bytes)], in message order
+Segments = List[Tuple[str, Union[str, bytes]]]
+
+def _load_library_image_ids(library_id: int) -> List[int]:
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM images WHERE library_id = ?", (library_id,))
+        return [r[0] for r in cursor.fetchall()]
+
+def _load_library_hashes(library_id: int) -> List[Tuple[int, int]]:
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT dhash, id FROM images WHERE library_id = ? AND (type IS NULL OR type = 'image') AND dhash IS NOT NULL",
+            (library_id,)
+        )
+        return [(from_signed64(r[0]), r[1]) for r in cursor.fetchall()]
+
+def _load_all_names() -> List[Tuple[str, int, str]]:
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, library_id, group_id FROM names")
+        return cursor.fetchall()
+
+def _load_group_names(group_id: str) -> List[Tuple[int, str]]:
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT library_id, name FROM names WHERE group_id = ?", (group_id,))
+        return cursor.fetchall()
+
+# Per-library image id arrays for O(1) random picks
+random_index = RandomIndex(_load_library_image_ids)
+
+# Per-library dHash index for near-duplicate lookups
+hash_index = HashIndex(_load_library_hashes)
+
+# Per-context name tries for prefix matching in get_meme
+name_index = NameIndex(_load_all_names)
+
+# Per-context 查看图库 listing, rendered on demand
+library_listing = LibraryListing(_load_group_names)
+
+# Per-context bigram index over names for "did you mean" suggestions
+fuzzy_index = FuzzyNameIndex(lambda group_id: [name for _, name in _load_group_names(group_id)])
+
+# Built messages for recently sent memes, keyed by image id (filled by data_source)
+send_cache = SendCache(int(SEND_CACHE_MB * 1024 * 1024))
+
+def get_db_stats() -> dict:
+    """Connection/query statistics for memes.db."""
+    return connections.stats()
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    # Only migrations newer than PRAGMA user_version run; an up-to-date DB starts in milliseconds
+    with connections.write() as conn:
+        run_migrations(conn, MIGRATIONS)
+    random_index.invalidate()
+    hash_index.invalidate()
+    name_index.load()
+    library_listing.invalidate()
+    fuzzy_index.invalidate()
+    send_cache.clear()
+
+def _create_schema(conn: sqlite3.Connection):
     cursor = conn.cursor()
     
     # Check if migration is needed (if old tables exist)
@@ -43,28 +134,44 @@ def init_db():
         )
         """)
         
-        # Create images table (Note: category_id is preserved as column name to minimize change, but refers to library_id)
-        # Or better, let's rename it to library_id for clarity. RENAME COLUMN is supported in newer SQLite.
-        # But if we create new, let's use library_id.
+        # Create images table. The bytes themselves live in the blob store,
+        # rows only keep the sha256 digest, size and format.
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS images (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             library_id INTEGER NOT NULL,
-            data BLOB NOT NULL,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            format TEXT,
             phash TEXT NOT NULL,
+            type TEXT DEFAULT 'image',
+            dhash INTEGER,
             FOREIGN KEY(library_id) REFERENCES libraries(id) ON DELETE CASCADE
         )
         """)
-    
-    
-    # Run hash migration (phash -> dhash)
-    migrate_to_dhash(conn)
-    
-    # Run V3 migration (add type column)
-    migrate_v3(conn)
 
-    conn.commit()
-    conn.close()
+    # Mixed meme content: text segments inline, image segments by blob digest
+    _create_segments_table(cursor)
+
+def _create_segments_table(cursor: sqlite3.Cursor):
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS meme_segments (
+        image_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        text TEXT,
+        digest TEXT,
+        PRIMARY KEY (image_id, position),
+        FOREIGN KEY(image_id) REFERENCES images(id) ON DELETE CASCADE
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_meme_segments_digest ON meme_segments (digest)")
+
+def _create_indexes(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_library ON images (library_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_digest ON images (digest)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_library_phash ON images (library_id, phash)")
 
 def migrate_v3(conn: sqlite3.Connection):
     """
@@ -86,6 +193,222 @@ def migrate_v3(conn: sqlite3.Connection):
         print(f"Migration V3 failed: {e}")
         # Non-critical if it fails (maybe already exists?), but good to log.
 
+def migrate_to_blob_store(conn: sqlite3.Connection):
+    """
+    Migrate image bytes from the images.data BLOB column into the blob store.
+    The images table is rebuilt without the data column; rows keep digest, size and format.
+    Writing blobs is idempotent, so an interrupted migration can simply be re-run.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(images)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if "data" not in columns:
+        return
+
+    print(f"Migrating image data out of SQLite into blob store ({BLOB_DIR})...")
+    try:
+        cursor.execute("DROP TABLE IF EXISTS images_new")
+        cursor.execute("""
+        CREATE TABLE images_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            library_id INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            format TEXT,
+            phash TEXT NOT NULL,
+            type TEXT DEFAULT 'image',
+            FOREIGN KEY(library_id) REFERENCES libraries(id) ON DELETE CASCADE
+        )
+        """)
+
+        # Stream rows in batches so we never hold the whole table in memory
+        read_cursor = conn.cursor()
+        read_cursor.execute("SELECT id, library_id, data, phash, type FROM images")
+        moved = 0
+        while True:
+            rows = read_cursor.fetchmany(200)
+            if not rows:
+                break
+
+            batch = []
+            for img_id, lib_id, data, phash, img_type in rows:
+                meme_type = img_type or "image"
+                digest = blob_store.put(data)
+                batch.append((img_id, lib_id, digest, len(data), _detect_format(data, meme_type), phash, meme_type))
+
+            cursor.executemany(
+                "INSERT INTO images_new (id, library_id, digest, size, format, phash, type) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                batch
+            )
+            moved += len(batch)
+
+        cursor.execute("DROP TABLE images")
+        cursor.execute("ALTER TABLE images_new RENAME TO images")
+        conn.commit()
+        print(f"Moved {moved} images into the blob store. Reclaiming database space...")
+
+        # Give the freed pages back to the filesystem
+        conn.execute("VACUUM")
+        print("Migration to blob store completed.")
+
+    except Exception as e:
+        conn.rollback()
+        print(f"Blob store migration failed: {e}")
+        raise e
+
+def migrate_dhash_column(conn: sqlite3.Connection):
+    """
+    Add images.dhash (the dHash as a signed 64-bit integer) and fill it from the hex phash.
+    Only image memes get one; text/mixed rows keep their MD5 in phash.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(images)")
+    columns = [info[1] for info in cursor.fetchall()]
+    if "dhash" not in columns:
+        print("Adding integer dhash column to images...")
+        cursor.execute("ALTER TABLE images ADD COLUMN dhash INTEGER")
+
+    filled = 0
+    query = "SELECT id, phash FROM images WHERE dhash IS NULL AND (type IS NULL OR type = 'image')"
+    for rows in iter_batches(conn, "dhash_column", query, batch_size=5000):
+        updates = []
+        for img_id, phash in rows:
+            dhash = _dhash_to_db(phash)
+            if dhash is not None:
+                updates.append((dhash, img_id))
+        cursor.executemany("UPDATE images SET dhash = ? WHERE id = ?", updates)
+        filled += len(updates)
+    if filled:
+        print(f"Filled integer dhash for {filled} images.")
+
+def _dhash_to_db(phash: str) -> Optional[int]:
+    try:
+        return to_signed64(hex_to_int(phash))
+    except (TypeError, ValueError):
+        return None
+
+def _detect_format(data: bytes, meme_type: str) -> Optional[str]:
+    """Format label stored next to the digest. Only reads the image header."""
+    if meme_type != "image":
+        return "json"
+    try:
+        img_format = Image.open(BytesIO(data)).format
+        return img_format.lower() if img_format else None
+    except Exception:
+        return None
+
+def _load_blob(digest: str) -> Optional[bytes]:
+    try:
+        return blob_store.get(digest)
+    except (FileNotFoundError, ValueError):
+        print(f"Missing blob for digest {digest}")
+        return None
+
+def _has_blob_table(cursor: sqlite3.Cursor) -> bool:
+    # Older migrations release blobs before the refcount table exists
+    return cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'blobs'").fetchone() is not None
+
+def is_blob_referenced(cursor: sqlite3.Cursor, digest: str) -> bool:
+    """
+    Whether an image row or mixed meme segment still points at the blob: the refcount the
+    triggers maintain, or a lookup for digests it doesn't track (or before the table exists).
+    The one rule for deletes and the orphan sweep.
+    """
+    if _has_blob_table(cursor):
+        row = cursor.execute("SELECT refcount FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        if row is not None:
+            return row[0] > 0
+    cursor.execute("SELECT 1 FROM images WHERE digest = ? LIMIT 1", (digest,))
+    if cursor.fetchone():
+        return True
+    cursor.execute("SELECT 1 FROM meme_segments WHERE digest = ? LIMIT 1", (digest,))
+    return cursor.fetchone() is not None
+
+def _release_blobs(cursor: sqlite3.Cursor, digests: List[str]) -> int:
+    """
+    Delete blobs whose reference count dropped to zero (no image row or mixed meme
+    segment points at them any more).
+    Call with the writer connection after the delete is committed, so a concurrent add can't race it.
+    Returns the bytes freed.
+    """
+    counted = _has_blob_table(cursor)
+    freed = 0
+    for digest in set(digests):
+        if not BlobStore.is_digest(digest) or is_blob_referenced(cursor, digest):
+            continue
+        freed += blob_store.delete(digest)
+        if counted:
+            cursor.execute("DELETE FROM blobs WHERE digest = ? AND refcount <= 0", (digest,))
+    return freed
+
+def _record_blob_sizes(cursor: sqlite3.Cursor, sizes: Dict[str, int]):
+    """
+    Fill in the size of blobs first referenced by a segment row (the segment triggers
+    only know the digest). No-op before the blobs table exists.
+    """
+    if sizes and _has_blob_table(cursor):
+        cursor.executemany(
+            "UPDATE blobs SET size = ? WHERE digest = ? AND size = 0",
+            [(size, digest) for digest, size in sizes.items()]
+        )
+
+def mixed_meme_hash(segments: Segments) -> str:
+    """
+    Exact-match key for a mixed meme: MD5 over the segment list with each image
+    replaced by its sha256 digest, so it never hashes the image bytes twice over.
+    """
+    key = [[kind, value if kind == "text" else BlobStore.digest_of(value)] for kind, value in segments]
+    return hashlib.md5(json.dumps(key, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def _store_segments(cursor: sqlite3.Cursor, image_id: int, segments: Segments) -> int:
+    """
+    Write a mixed meme's segment rows. Images go to the blob store, so a picture that is
+    also stored as a plain image meme (or in another mixed meme) is kept only once.
+    Returns the total payload size in bytes.
+    """
+    rows = []
+    blob_sizes = {}
+    size = 0
+    for position, (kind, value) in enumerate(segments):
+        if kind == "image":
+            digest = blob_store.put(value)
+            rows.append((image_id, position, kind, None, digest))
+            blob_sizes[digest] = len(value)
+            size += len(value)
+        else:
+            rows.append((image_id, position, kind, value, None))
+            size += len(value.encode("utf-8"))
+    cursor.executemany(
+        "INSERT INTO meme_segments (image_id, position, kind, text, digest) VALUES (?, ?, ?, ?, ?)",
+        rows
+    )
+    _record_blob_sizes(cursor, blob_sizes)
+    return size
+
+def _load_segments(image_id: int) -> Segments:
+    """Segments of a mixed meme; image bytes are read from the blob store as-is."""
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT kind, text, digest FROM meme_segments WHERE image_id = ? ORDER BY position",
+            (image_id,)
+        )
+        rows = cursor.fetchall()
+    segments = []
+    for kind, text, digest in rows:
+        if kind == "image":
+            data = _load_blob(digest)
+            if data is not None:
+                segments.append((kind, data))
+        else:
+            segments.append((kind, text))
+    return segments
+
+def _load_meme(image_id: int, digest: str, meme_type: str) -> Optional[Union[bytes, Segments]]:
+    if meme_type == "mixed":
+        return _load_segments(image_id)
+    return _load_blob(digest)
+
 def migrate_v2(conn: sqlite3.Connection):
     """
     Migrate from old schema (categories, aliases, images.category_id) 
@@ -172,54 +495,65 @@ def migrate_v2(conn: sqlite3.Connection):
 
 def get_library_id(name: str, group_id: str) -> Optional[int]:
     """Get library ID by name (alias or real name)."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT library_id FROM names WHERE name = ? AND group_id = ?", (name, group_id))
-    result = cursor.fetchone()
-    conn.close()
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT library_id FROM names WHERE name = ? AND group_id = ?", (name, group_id))
+        result = cursor.fetchone()
     return result[0] if result else None
 
+def match_library_names(text: str, group_id: str) -> List[Tuple[str, int]]:
+    """
+    All library names in the group that are a prefix of `text`, longest first.
+    Served from the in-memory name trie; builds it from the DB first if it isn't loaded.
+    Returns [(name, library_id)].
+    """
+    return name_index.longest_matches(text, group_id)
+
+def suggest_library_names(text: str, group_id: str, limit: int = 3) -> List[str]:
+    """Existing names in the group closest to `text` by edit distance (for "did you mean")."""
+    return fuzzy_index.suggest(text, group_id, limit)
+
 def create_library(name: str, group_id: str) -> int:
     """Create a new library with a primary name."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
     try:
-        # Create library
-        cursor.execute("INSERT INTO libraries (group_id) VALUES (?)", (group_id,))
-        lib_id = cursor.lastrowid
-        
-        # Create name
-        cursor.execute("INSERT INTO names (name, library_id, group_id) VALUES (?, ?, ?)", (name, lib_id, group_id))
-        conn.commit()
+        with connections.write() as conn:
+            cursor = conn.cursor()
+            # Create library
+            cursor.execute("INSERT INTO libraries (group_id) VALUES (?)", (group_id,))
+            lib_id = cursor.lastrowid
+            
+            # Create name
+            cursor.execute("INSERT INTO names (name, library_id, group_id) VALUES (?, ?, ?)", (name, lib_id, group_id))
+        name_index.add(name, lib_id, group_id)
+        library_listing.add(name, lib_id, group_id)
+        fuzzy_index.add(name, group_id)
         return lib_id
     except sqlite3.IntegrityError:
-        # Name exists?
-        conn.close()
+        # Name exists? (the library insert was rolled back)
         return get_library_id(name, group_id)
-    finally:
-        conn.close()
 
 def add_name_to_library(name: str, library_id: int, group_id: str) -> bool:
     """Add a new name (alias) to an existing library."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO names (name, library_id, group_id) VALUES (?, ?, ?)", (name, library_id, group_id))
-        conn.commit()
+        with connections.write() as conn:
+            conn.execute("INSERT INTO names (name, library_id, group_id) VALUES (?, ?, ?)", (name, library_id, group_id))
+        name_index.add(name, library_id, group_id)
+        library_listing.add(name, library_id, group_id)
+        fuzzy_index.add(name, group_id)
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def remove_name(name: str, group_id: str) -> bool:
     """Remove a name from the system."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM names WHERE name = ? AND group_id = ?", (name, group_id))
-    rows = cursor.rowcount
-    conn.commit()
-    conn.close()
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM names WHERE name = ? AND group_id = ?", (name, group_id))
+        rows = cursor.rowcount
+    if rows > 0:
+        name_index.remove(name, group_id)
+        library_listing.remove(name, group_id)
+        fuzzy_index.remove(name, group_id)
     return rows > 0
 
 def merge_libraries(src_lib_id: int, dest_lib_id: int):
@@ -230,40 +564,57 @@ def merge_libraries(src_lib_id: int, dest_lib_id: int):
     if src_lib_id == dest_lib_id:
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    try:
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT group_id FROM libraries WHERE id = ?", (dest_lib_id,))
+        row = cursor.fetchone()
+        group_id = row[0] if row else None
+
         # 1. Move Images
+        cursor.execute("SELECT id FROM images WHERE library_id = ?", (src_lib_id,))
+        moved_ids = [r[0] for r in cursor.fetchall()]
         cursor.execute("UPDATE images SET library_id = ? WHERE library_id = ?", (dest_lib_id, src_lib_id))
         
         # 2. Move Names (Handle conflicts? Unique(name, group_id) shouldn't conflict because names imply different libs in same group)
         cursor.execute("UPDATE names SET library_id = ? WHERE library_id = ?", (dest_lib_id, src_lib_id))
         
-        # 3. Delete Src Library
+        # 3. Usage stats follow their images (image ids are unique, so no key collides)
+        cursor.execute("UPDATE meme_usage SET library_id = ? WHERE library_id = ?", (dest_lib_id, src_lib_id))
+
+        # 4. Delete Src Library
         cursor.execute("DELETE FROM libraries WHERE id = ?", (src_lib_id,))
-        
-        conn.commit()
-    finally:
-        conn.close()
+
+    random_index.merge(src_lib_id, dest_lib_id)
+    hash_index.merge(src_lib_id, dest_lib_id)
+    send_cache.discard_many(moved_ids)
+    if group_id is not None:
+        name_index.merge(src_lib_id, dest_lib_id, group_id)
+        library_listing.merge(src_lib_id, dest_lib_id, group_id)
+    else:
+        name_index.load()
+        library_listing.invalidate()
+        fuzzy_index.invalidate()
 
 def get_library_names(library_id: int) -> List[str]:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name FROM names WHERE library_id = ?", (library_id,))
-    results = cursor.fetchall()
-    conn.close()
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM names WHERE library_id = ?", (library_id,))
+        results = cursor.fetchall()
     return [r[0] for r in results]
 
+def get_library_listing(group_id: str) -> Tuple[int, List[str]]:
+    """(library count, 查看图库 chunk texts) for a group, from the listing cache."""
+    return library_listing.load(group_id)
+
 def get_all_library_names(group_id: str) -> List[Tuple[str, List[str]]]:
     """
     Get all library names for a group, grouped by library_id.
     Returns a list of (primary_name, [aliases]).
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT library_id, name FROM names WHERE group_id = ? ORDER BY library_id", (group_id,))
-    results = cursor.fetchall()
-    conn.close()
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT library_id, name FROM names WHERE group_id = ? ORDER BY library_id", (group_id,))
+        results = cursor.fetchall()
     
     current_lib_id = None
     names_map = {}
@@ -295,146 +646,565 @@ def get_all_library_names(group_id: str) -> List[Tuple[str, List[str]]]:
 
 # --- Image Operations (Updated for library_id) ---
 
-def add_image(library_id: int, data: bytes, phash: str, meme_type: str = "image"):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO images (library_id, data, phash, type) VALUES (?, ?, ?, ?)", (library_id, data, phash, meme_type))
-    conn.commit()
-    conn.close()
+def add_image(library_id: int, data: Union[bytes, Segments], phash: str, meme_type: str = "image") -> int:
+    """
+    Store a meme. `data` is the image bytes, or the segment list for a mixed meme
+    (`phash` is then its mixed_meme_hash).
+    """
+    if meme_type == "mixed":
+        return _add_mixed(library_id, data, phash)
 
-def get_random_image(library_id: int) -> Tuple[Optional[bytes], str]:
-    """Returns (data, type)"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    img_format = _detect_format(data, meme_type)
+    with connections.write() as conn:
+        # Write the bytes under the writer lock so a concurrent delete can't release this blob
+        # in between. Identical content across libraries/groups maps to the same blob.
+        digest = blob_store.put(data)
+        dhash = _dhash_to_db(phash) if meme_type == "image" else None
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO images (library_id, digest, size, format, phash, type, dhash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (library_id, digest, len(data), img_format, phash, meme_type, dhash)
+        )
+        image_id = cursor.lastrowid
+
+    random_index.add(library_id, image_id)
+    if dhash is not None:
+        hash_index.add(library_id, from_signed64(dhash), image_id)
+    return image_id
+
+def add_image_by_digest(library_id: int, digest: str, phash: str) -> Optional[int]:
+    """
+    Add an image meme whose bytes are already in the blob store (a known image, see
+    find_image_source): only the row is written. Returns None if the blob is gone.
+    """
+    dhash = _dhash_to_db(phash)
+    with connections.write() as conn:
+        # Under the writer lock, so the blob can't be released between the check and the insert
+        row = conn.execute("SELECT size, format FROM blobs WHERE digest = ? AND refcount > 0", (digest,)).fetchone()
+        if row is None or not blob_store.exists(digest):
+            return None
+        cursor = conn.execute(
+            "INSERT INTO images (library_id, digest, size, format, phash, type, dhash) VALUES (?, ?, ?, ?, ?, 'image', ?)",
+            (library_id, digest, row[0], row[1], phash, dhash)
+        )
+        image_id = cursor.lastrowid
+
+    random_index.add(library_id, image_id)
+    if dhash is not None:
+        hash_index.add(library_id, from_signed64(dhash), image_id)
+    return image_id
+
+def find_image_source(keys: List[str]) -> Optional[Tuple[str, str]]:
+    """(digest, phash) of the stored image one of `keys` was added as, if it is still stored."""
+    keys = [k for k in keys if k]
+    if not keys:
+        return None
+    placeholders = ",".join("?" * len(keys))
+    with connections.read() as conn:
+        return conn.execute(
+            f"SELECT s.digest, s.phash FROM image_sources s JOIN blobs b ON b.digest = s.digest "
+            f"WHERE s.source IN ({placeholders}) AND b.refcount > 0 LIMIT 1",
+            keys
+        ).fetchone()
+
+def register_image_sources(keys: List[str], digest: str, phash: str):
+    """Remember that these source keys (QQ file id, raw sha256, ...) resolve to a stored image."""
+    keys = [k for k in keys if k]
+    if not keys:
+        return
+    with connections.write() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO image_sources (source, digest, phash) VALUES (?, ?, ?)",
+            [(key, digest, phash) for key in keys]
+        )
+
+def _add_mixed(library_id: int, segments: Segments, phash: str) -> int:
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        # The row itself has no blob; its content lives in meme_segments
+        cursor.execute(
+            "INSERT INTO images (library_id, digest, size, format, phash, type) VALUES (?, '', 0, NULL, ?, 'mixed')",
+            (library_id, phash)
+        )
+        image_id = cursor.lastrowid
+        size = _store_segments(cursor, image_id, segments)
+        cursor.execute("UPDATE images SET size = ? WHERE id = ?", (size, image_id))
+
+    random_index.add(library_id, image_id)
+    return image_id
+
+def pick_random_image(library_id: int) -> Optional[int]:
+    """Random image id of the library, from the in-memory id array (no DB access)."""
+    return random_index.pick(library_id)
+
+def get_image(image_id: int) -> Tuple[Optional[Union[bytes, Segments]], str]:
+    """Returns (data, type) by primary key, or (None, "") if the row is gone."""
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT digest, type FROM images WHERE id = ?", (image_id,))
+        result = cursor.fetchone()
+    if not result:
+        return None, ""
     # Handle legacy records where type might be null (though schema default handles it, but just in case)
-    cursor.execute("SELECT data, type FROM images WHERE library_id = ? ORDER BY RANDOM() LIMIT 1", (library_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0], (result[1] or "image")
+    meme_type = result[1] or "image"
+    return _load_meme(image_id, result[0], meme_type), meme_type
+
+def get_random_image(library_id: int) -> Tuple[Optional[Union[bytes, Segments]], str]:
+    """Returns (data, type). For mixed memes data is the segment list."""
+    # Pick from the in-memory id array, then do a single primary-key lookup.
+    # If the row vanished underneath us (stale index), reload the library once and retry.
+    for _ in range(2):
+        image_id = pick_random_image(library_id)
+        if image_id is None:
+            return None, ""
+
+        data, meme_type = get_image(image_id)
+        if meme_type:
+            return data, meme_type
+        random_index.invalidate(library_id)
     return None, ""
 
-def get_all_images(library_id: int) -> List[Tuple[bytes, str, str]]:
+def get_all_images(library_id: int) -> List[Tuple[Union[bytes, Segments], str, str]]:
     """Returns list of (data, phash, type)"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT data, phash, type FROM images WHERE library_id = ?", (library_id,))
-    results = cursor.fetchall()
-    conn.close()
-    return [(r[0], r[1], (r[2] or "image")) for r in results]
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, digest, phash, type FROM images WHERE library_id = ?", (library_id,))
+        results = cursor.fetchall()
+    images = []
+    for img_id, digest, phash, img_type in results:
+        meme_type = img_type or "image"
+        data = _load_meme(img_id, digest, meme_type)
+        if data:
+            images.append((data, phash, meme_type))
+    return images
 
-def check_duplicate(library_id: int, new_hash: str, meme_type: str = "image", threshold: int = 18) -> Tuple[bool, Optional[bytes]]:
+def find_duplicate(library_id: int, new_hash: str, meme_type: str = "image", threshold: int = 18) -> Optional[Tuple[int, int]]:
     """
-    Check if an image with similar hash already exists.
-    Returns (is_duplicate, duplicate_image_data) tuple.
+    Find the closest existing meme of the same type.
+    Images: nearest dHash within `threshold` via the BK-tree index.
+    Text/mixed: exact MD5 match.
+    Returns (image_id, distance) or None.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT phash, data, type FROM images WHERE library_id = ?", (library_id,))
-    images = cursor.fetchall()
-    conn.close()
-    
-    # Pre-parse hash for image types only if needed
     if meme_type == "image":
-        new_hash_obj = imagehash.hex_to_hash(new_hash)
-    
-    for img_phash, img_data, img_type in images:
-        current_type = img_type or "image"
-        
-        # If types don't match, they aren't duplicates (e.g. text vs image)
-        if current_type != meme_type:
-            continue
-            
+        try:
+            hash_value = hex_to_int(new_hash)
+        except (TypeError, ValueError):
+            return None
+        return hash_index.nearest(library_id, hash_value, threshold)
+
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id FROM images WHERE library_id = ? AND phash = ? AND type = ? LIMIT 1",
+            (library_id, new_hash, meme_type)
+        )
+        result = cursor.fetchone()
+    return (result[0], 0) if result else None
+
+def _get_image_digest(image_id: int) -> Optional[str]:
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT digest FROM images WHERE id = ?", (image_id,))
+        result = cursor.fetchone()
+    return result[0] if result else None
+
+def check_duplicate(library_id: int, new_hash: str, meme_type: str = "image", threshold: int = 18) -> Tuple[bool, Optional[Union[bytes, Segments]]]:
+    """
+    Check if an image with similar hash already exists.
+    Returns (is_duplicate, duplicate_data) tuple; duplicate_data is a segment list for mixed memes.
+    """
+    match = find_duplicate(library_id, new_hash, meme_type, threshold)
+    if not match:
+        return False, None
+
+    digest = _get_image_digest(match[0])
+    if digest is None:
+        return True, None
+    return True, _load_meme(match[0], digest, meme_type)
+
+def get_group_libraries(group_id: str) -> List[Tuple[int, List[str]]]:
+    """All libraries of a group as (library_id, names), names sorted shortest first (primary name first)."""
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT library_id, name FROM names WHERE group_id = ? ORDER BY library_id", (group_id,))
+        results = cursor.fetchall()
+    names_map = {}
+    for lib_id, name in results:
+        names_map.setdefault(lib_id, []).append(name)
+    return [(lib_id, sorted(names, key=lambda x: (len(x), x))) for lib_id, names in names_map.items()]
+
+def get_or_create_library(names: List[str], group_id: str) -> int:
+    """
+    Library in `group_id` known by any of `names` (tried in order); if there is none,
+    create one named names[0] with the rest as aliases (aliases taken by other libraries are skipped).
+    """
+    for name in names:
+        lib_id = get_library_id(name, group_id)
+        if lib_id:
+            return lib_id
+    lib_id = create_library(names[0], group_id)
+    for alias in names[1:]:
+        add_name_to_library(alias, lib_id, group_id)
+    return lib_id
+
+def iter_group_memes(group_id: str, batch_size: int = 500) -> Iterator[Tuple[int, int, str, int, Optional[str], str, str]]:
+    """
+    Stream (library_id, image_id, digest, size, format, phash, type) for every meme
+    of the group's libraries, ordered by library, without loading them all at once.
+    """
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT i.library_id, i.id, i.digest, i.size, i.format, i.phash, COALESCE(i.type, 'image') "
+            "FROM images i JOIN libraries l ON l.id = i.library_id "
+            "WHERE l.group_id = ? ORDER BY i.library_id, i.id",
+            (group_id,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+def get_segment_refs(image_id: int) -> List[Tuple[str, Optional[str], Optional[str]]]:
+    """A mixed meme's segments as stored: [(kind, text, digest)], without loading any image."""
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT kind, text, digest FROM meme_segments WHERE image_id = ? ORDER BY position",
+            (image_id,)
+        )
+        return cursor.fetchall()
+
+def insert_meme_rows(rows: List[Tuple[int, str, int, Optional[str], str, str, Optional[list]]]) -> List[int]:
+    """
+    Insert already-stored memes in one transaction:
+    rows of (library_id, digest, size, format, phash, type, segment_refs or None).
+    The blobs must already be in the blob store; call while holding connections.write()
+    if they were just written, so a concurrent delete can't release them first.
+    Returns the new image ids in row order.
+    """
+    if not rows:
+        return []
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        # One INSERT per row, ids from lastrowid: the writer lock is per-process, so another
+        # process (e.g. meme_archive) may insert in between and MAX(id) can't be trusted
+        new_ids = []
+        for lib_id, digest, size, fmt, phash, meme_type, _ in rows:
+            cursor.execute(
+                "INSERT INTO images (library_id, digest, size, format, phash, type, dhash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (lib_id, digest, size, fmt, phash, meme_type, _dhash_to_db(phash) if meme_type == "image" else None)
+            )
+            new_ids.append(cursor.lastrowid)
+        cursor.executemany(
+            "INSERT INTO meme_segments (image_id, position, kind, text, digest) VALUES (?, ?, ?, ?, ?)",
+            [(new_id, position, kind, text, digest)
+             for new_id, row in zip(new_ids, rows) if row[6]
+             for position, (kind, text, digest) in enumerate(row[6])]
+        )
+        segment_digests = {digest for row in rows if row[6] for kind, _, digest in row[6] if digest}
+        _record_blob_sizes(cursor, {d: _blob_file_size(d) for d in segment_digests})
+
+    for new_id, (lib_id, _, _, _, phash, meme_type, _) in zip(new_ids, rows):
+        random_index.add(lib_id, new_id)
         if meme_type == "image":
-            # DHash comparison
-            try:
-                current_hash_obj = imagehash.hex_to_hash(img_phash)
-                if new_hash_obj - current_hash_obj <= threshold:
-                    return True, img_data
-            except Exception:
+            dhash = _dhash_to_db(phash)
+            if dhash is not None:
+                hash_index.add(lib_id, from_signed64(dhash), new_id)
+    return new_ids
+
+def add_images_batch(library_id: int, items: List[Tuple[bytes, str]], threshold: int = 18,
+                     force: bool = False) -> Tuple[List[int], int]:
+    """
+    Add many prepared image memes, items of (bytes, dhash_hex), in one transaction.
+    Near-duplicates (dHash within `threshold`) of the library or of an earlier item are
+    skipped in a single vectorized pass, unless `force`.
+    Returns (new image ids in item order, duplicates skipped).
+    """
+    if not items:
+        return [], 0
+    with connections.write() as conn:
+        if force:
+            keep = list(range(len(items)))
+        else:
+            cursor = conn.execute(
+                "SELECT dhash FROM images WHERE library_id = ? AND (type IS NULL OR type = 'image') "
+                "AND dhash IS NOT NULL",
+                (library_id,)
+            )
+            existing = [from_signed64(r[0]) for r in cursor.fetchall()]
+            keep = filter_new_hashes([hex_to_int(phash) for _, phash in items], existing, threshold)
+
+        # Blobs are written under the writer lock, like add_image
+        rows = []
+        for i in keep:
+            data, phash = items[i]
+            digest = blob_store.put(data)
+            rows.append((library_id, digest, len(data), _detect_format(data, "image"), phash, "image", None))
+        new_ids = insert_meme_rows(rows)
+    return new_ids, len(items) - len(keep)
+
+def sync_library(src_lib_id: int, dest_lib_id: int, threshold: int = 18) -> Tuple[int, int]:
+    """
+    Copy every meme of src into dest, skipping ones dest already has (same rules as
+    check_duplicate: dHash within `threshold` for images, exact key for mixed) and
+    duplicates within src itself. Hashes of both libraries are loaded once and the
+    new set is computed in memory; rows are inserted in a single transaction.
+    Blobs are shared by digest, nothing is re-read or re-written.
+    Returns (added, skipped).
+    """
+    if src_lib_id == dest_lib_id:
+        return 0, 0
+
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, digest, size, format, phash, type, dhash FROM images WHERE library_id = ? ORDER BY id",
+            (src_lib_id,)
+        )
+        src_rows = cursor.fetchall()
+        if not src_rows:
+            return 0, 0
+        cursor.execute("SELECT phash, type, dhash FROM images WHERE library_id = ?", (dest_lib_id,))
+        dest_rows = cursor.fetchall()
+
+        # Images: vectorized near-duplicate filter on the dHashes
+        image_rows = [r for r in src_rows if (r[5] or "image") == "image" and r[6] is not None]
+        dest_hashes = [from_signed64(d) for _, t, d in dest_rows if (t or "image") == "image" and d is not None]
+        keep = filter_new_hashes([from_signed64(r[6]) for r in image_rows], dest_hashes, threshold)
+        new_rows = [image_rows[i] for i in keep]
+
+        # Mixed (and any image rows without a dHash): exact key match
+        seen = {(p, t or "image") for p, t, _ in dest_rows}
+        for row in src_rows:
+            meme_type = row[5] or "image"
+            if meme_type == "image" and row[6] is not None:
                 continue
+            if (row[4], meme_type) in seen:
+                continue
+            seen.add((row[4], meme_type))
+            new_rows.append(row)
+        new_rows.sort(key=lambda r: r[0])
+
+        if new_rows:
+            # One INSERT per row, ids from lastrowid: another process may insert into dest meanwhile
+            new_ids = []
+            for _, digest, size, fmt, phash, meme_type, dhash in new_rows:
+                cursor.execute(
+                    "INSERT INTO images (library_id, digest, size, format, phash, type, dhash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (dest_lib_id, digest, size, fmt, phash, meme_type or "image", dhash)
+                )
+                new_ids.append(cursor.lastrowid)
+            cursor.executemany(
+                "INSERT INTO meme_segments (image_id, position, kind, text, digest) "
+                "SELECT ?, position, kind, text, digest FROM meme_segments WHERE image_id = ?",
+                [(new_id, row[0]) for new_id, row in zip(new_ids, new_rows) if row[5] == "mixed"]
+            )
         else:
-            # Exact match for text/mixed (hash is MD5)
-            if new_hash == img_phash:
-                return True, img_data
-                
-    return False, None
+            new_ids = []
+
+    for new_id, row in zip(new_ids, new_rows):
+        random_index.add(dest_lib_id, new_id)
+        if row[6] is not None and (row[5] or "image") == "image":
+            hash_index.add(dest_lib_id, from_signed64(row[6]), new_id)
+    return len(new_ids), len(src_rows) - len(new_ids)
 
 def migrate_to_dhash(conn: sqlite3.Connection):
     """
-    Check if we need to migrate hashes (simple heuristic: recompute one and see if it matches).
-    Actually, to be safe, we just scan all images and recompute dhash.
-    If the stored hash is already dhash, it will just result in the same value (or close).
-    But since we don't know which algorithm generated the hash stored, better recompute all.
-    This might be slow for many images but ensures consistency.
+    Recompute every image meme's hash as a dHash from its stored bytes.
+    Older rows may carry a pHash; since we don't know which algorithm produced a stored
+    hash, recompute all of them once. Batched and resumable (see iter_batches).
     """
     cursor = conn.cursor()
+    updated_count = 0
     # Only migrate types that are 'image' or NULL
-    try:
-        cursor.execute("SELECT id, data, phash FROM images WHERE type IS NULL OR type='image'")
-        images = cursor.fetchall()
-        
-        updated_count = 0
-        if not images:
-            return 
-
-        print("Checking for image hash updates (migrating to dhash)...")
-        
-        for img_id, data, old_phash in images:
+    query = "SELECT id, digest, phash FROM images WHERE (type IS NULL OR type = 'image')"
+    for rows in iter_batches(conn, "rehash_dhash", query):
+        for img_id, digest, old_phash in rows:
             try:
-                img = Image.open(BytesIO(data))
+                img = Image.open(BytesIO(blob_store.get(digest)))
                 new_hash = str(imagehash.dhash(img))
-                
-                # If hash is different significantly (or just different string), update it.
+
                 # Since phash and dhash are different algorithms, they will reliably be different strings.
                 if new_hash != old_phash:
-                    cursor.execute("UPDATE images SET phash = ? WHERE id = ?", (new_hash, img_id))
+                    cursor.execute("UPDATE images SET phash = ?, dhash = ? WHERE id = ?", (new_hash, _dhash_to_db(new_hash), img_id))
                     updated_count += 1
-            except Exception as e:
-                # This might happen if data is not a valid image
+            except Exception:
+                # This might happen if data is not a valid image or the blob is missing
                 pass
-                
-        if updated_count > 0:
-            conn.commit()
-            print(f"Updated hashes for {updated_count} images.")
-            
-    except Exception as e:
-        print(f"Hash migration failed: {e}")
+
+    if updated_count > 0:
+        print(f"Updated hashes for {updated_count} images.")
 
 def delete_image_by_hash(library_id: int, target_hash: str, meme_type: str = "image", threshold: int = 3) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id, phash, type FROM images WHERE library_id = ?", (library_id,))
-    images = cursor.fetchall()
-    
-    if meme_type == "image":
-        target_hash_obj = imagehash.hex_to_hash(target_hash)
-    
-    for img_id, img_phash, img_type in images:
-        current_type = img_type or "image"
-        if current_type != meme_type:
-            continue
-            
-        if meme_type == "image":
-            try:
-                current_hash_obj = imagehash.hex_to_hash(img_phash)
-                if target_hash_obj - current_hash_obj <= threshold:
-                    cursor.execute("DELETE FROM images WHERE id = ?", (img_id,))
-                    conn.commit()
-                    conn.close()
-                    return True
-            except Exception:
-                continue
+    with connections.write() as conn:
+        match = find_duplicate(library_id, target_hash, meme_type, threshold)
+        if not match:
+            return False
+
+        img_id = match[0]
+        cursor = conn.cursor()
+        cursor.execute("SELECT digest, dhash FROM images WHERE id = ?", (img_id,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        img_digest, dhash = row
+
+        cursor.execute("SELECT digest FROM meme_segments WHERE image_id = ? AND digest IS NOT NULL", (img_id,))
+        digests = [img_digest] + [r[0] for r in cursor.fetchall()]
+
+        cursor.execute("DELETE FROM meme_segments WHERE image_id = ?", (img_id,))
+        cursor.execute("DELETE FROM images WHERE id = ?", (img_id,))
+        conn.commit()
+        _release_blobs(cursor, digests)
+
+    random_index.remove(library_id, img_id)
+    if dhash is not None:
+        hash_index.remove(library_id, from_signed64(dhash), img_id)
+    send_cache.discard(img_id)
+    return True
+
+def delete_images(image_ids: List[int]) -> Tuple[int, int]:
+    """
+    Delete meme rows by id (and any segments under those ids) in one transaction, free
+    blobs nothing else references and drop them from the in-memory indexes.
+    Returns (rows deleted, blob bytes freed).
+    """
+    if not image_ids:
+        return 0, 0
+    placeholders = ",".join("?" * len(image_ids))
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id, library_id, digest FROM images WHERE id IN ({placeholders})", image_ids)
+        rows = cursor.fetchall()
+        cursor.execute(
+            f"SELECT digest FROM meme_segments WHERE image_id IN ({placeholders}) AND digest IS NOT NULL",
+            image_ids
+        )
+        digests = [r[2] for r in rows] + [r[0] for r in cursor.fetchall()]
+        cursor.execute(f"DELETE FROM meme_segments WHERE image_id IN ({placeholders})", image_ids)
+        cursor.execute(f"DELETE FROM images WHERE id IN ({placeholders})", image_ids)
+        conn.commit()
+        freed = _release_blobs(cursor, digests)
+
+    for lib_id in {r[1] for r in rows}:
+        random_index.invalidate(lib_id)
+        hash_index.invalidate(lib_id)
+    send_cache.discard_many(image_ids)
+    return len(rows), freed
+
+def _has_text_search(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'meme_text'").fetchone() is not None
+
+def search_memes(group_id: str, query: str, limit: int = 10) -> List[Tuple[int, int]]:
+    """
+    Memes of the group whose text contains `query`, best first: [(library_id, image_id)].
+    Queries of 3+ characters use the trigram FTS index ranked by bm25; shorter ones
+    (trigrams can't match them) scan the group's text segments with LIKE, shortest text first.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        if len(query) >= 3 and _has_text_search(conn):
+            # Quote as one FTS phrase so user input is never parsed as query syntax
+            phrase = '"' + query.replace('"', '""') + '"'
+            cursor.execute(
+                "SELECT i.library_id, i.id FROM meme_text t "
+                "JOIN images i ON i.id = t.rowid JOIN libraries l ON l.id = i.library_id "
+                "WHERE meme_text MATCH ? AND l.group_id = ? ORDER BY t.rank LIMIT ?",
+                (phrase, group_id, limit)
+            )
         else:
-            if target_hash == img_phash:
-                cursor.execute("DELETE FROM images WHERE id = ?", (img_id,))
-                conn.commit()
-                conn.close()
-                return True
-            
-    conn.close()
-    return False
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            cursor.execute(
+                "SELECT i.library_id, i.id FROM images i "
+                "JOIN libraries l ON l.id = i.library_id "
+                "JOIN meme_segments s ON s.image_id = i.id "
+                "WHERE l.group_id = ? AND s.kind = 'text' AND s.text LIKE ? ESCAPE '\\' "
+                "GROUP BY i.id ORDER BY SUM(LENGTH(s.text)) LIMIT ?",
+                (group_id, pattern, limit)
+            )
+        return cursor.fetchall()
+
+def add_usage(counts: Dict[Tuple[str, int, int], int], day: int):
+    """Add buffered send counts {(context_id, library_id, image_id): n} to `day`, in one transaction."""
+    with connections.write() as conn:
+        conn.executemany(
+            "INSERT INTO meme_usage (context_id, day, library_id, image_id, count) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (context_id, day, library_id, image_id) DO UPDATE SET count = count + excluded.count",
+            [(ctx, day, lib_id, image_id, n) for (ctx, lib_id, image_id), n in counts.items()]
+        )
+
+def top_libraries(context_id: str, since_day: int, limit: int = 10) -> List[Tuple[int, int]]:
+    """Most-sent libraries of a context since `since_day` (still existing ones): [(library_id, count)]."""
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT u.library_id, SUM(u.count) AS total FROM meme_usage u "
+            "JOIN libraries l ON l.id = u.library_id "
+            "WHERE u.context_id = ? AND u.day >= ? "
+            "GROUP BY u.library_id ORDER BY total DESC LIMIT ?",
+            (context_id, since_day, limit)
+        )
+        return cursor.fetchall()
+
+def top_images(context_id: str, since_day: int, limit: int = 5) -> List[Tuple[int, int, int]]:
+    """Most-sent memes of a context since `since_day` (still existing ones): [(library_id, image_id, count)]."""
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT i.library_id, u.image_id, SUM(u.count) AS total FROM meme_usage u "
+            "JOIN images i ON i.id = u.image_id "
+            "WHERE u.context_id = ? AND u.day >= ? "
+            "GROUP BY u.image_id ORDER BY total DESC LIMIT ?",
+            (context_id, since_day, limit)
+        )
+        return cursor.fetchall()
+
+def get_large_images(min_size: int, library_id: Optional[int] = None) -> List[Tuple[int, int]]:
+    """(image_id, size) of image memes stored bigger than min_size bytes, largest first."""
+    query = "SELECT id, size FROM images WHERE (type IS NULL OR type = 'image') AND size > ?"
+    params = [min_size]
+    if library_id is not None:
+        query += " AND library_id = ?"
+        params.append(library_id)
+    with connections.read() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query + " ORDER BY size DESC", params)
+        return cursor.fetchall()
+
+def replace_image_data(image_id: int, data: bytes, phash: str) -> bool:
+    """
+    Swap the stored bytes of an image meme (e.g. after re-encoding), keeping its id and library.
+    The old blob is released if nothing else references it.
+    """
+    img_format = _detect_format(data, "image")
+    dhash = _dhash_to_db(phash)
+    with connections.write() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT library_id, digest, dhash FROM images WHERE id = ?", (image_id,))
+        row = cursor.fetchone()
+        if not row:
+            return False
+        library_id, old_digest, old_dhash = row
+
+        digest = blob_store.put(data)
+        cursor.execute(
+            "UPDATE images SET digest = ?, size = ?, format = ?, phash = ?, dhash = ? WHERE id = ?",
+            (digest, len(data), img_format, phash, dhash, image_id)
+        )
+        conn.commit()
+        _release_blobs(cursor, [old_digest])
+
+    if old_dhash is not None:
+        hash_index.remove(library_id, from_signed64(old_dhash), image_id)
+    if dhash is not None:
+        hash_index.add(library_id, from_signed64(dhash), image_id)
+    send_cache.discard(image_id)
+    return True
 
 def migrate_lowercase_categories():
     # Deprecated or update logic?
@@ -442,47 +1212,278 @@ def migrate_lowercase_categories():
     # We can implement this on startup if needed.
     pass
 
-def resize_existing_images(max_dim: int = 512):
-    # Same as before but use library_id
-    conn = sqlite3.connect(DB_PATH)
+def resize_existing_images(conn: sqlite3.Connection, max_dim: int = MAX_DIMENSION):
+    """
+    Shrink stored image memes larger than `max_dim` (added before resizing on upload existed).
+    The dHash is recomputed from the shrunk bytes, like replace_image_data does; the
+    rehash migration runs before this one. Runs once as a migration, batched and resumable.
+    """
     cursor = conn.cursor()
-    
-    try:
-        # Only resize "image" type
-        cursor.execute("SELECT id, data FROM images WHERE type IS NULL OR type='image'")
-        images = cursor.fetchall()
-        
-        count = 0
-        for img_id, data in images:
-            # ... (Resize logic same as before) ...
+    count = 0
+
+    # Only resize "image" type
+    query = "SELECT id, digest FROM images WHERE (type IS NULL OR type = 'image')"
+    for rows in iter_batches(conn, "resize_images", query, batch_size=50):
+        replaced_digests = []
+        for img_id, digest in rows:
+            data = _load_blob(digest)
+            if data is None:
+                continue
+            new_data = resize_image(data, max_dim)
+            if new_data is data:
+                # Already small enough (or not an image we can decode)
+                continue
+            new_digest = blob_store.put(new_data)
             try:
-                img = Image.open(BytesIO(data))
-                format = img.format or "PNG"
-                w, h = img.size
-                
-                if max(w, h) > max_dim:
-                    ratio = max_dim / max(w, h)
-                    new_size = (int(w * ratio), int(h * ratio))
-                    buf = BytesIO()
-                    
-                    if getattr(img, "is_animated", False):
-                        frames = []
-                        for frame in range(img.n_frames):
-                            img.seek(frame)
-                            frame_img = img.copy()
-                            frame_img.thumbnail(new_size)
-                            frames.append(frame_img)
-                        frames[0].save(buf, format="GIF", save_all=True, append_images=frames[1:], loop=img.info.get("loop", 0), duration=img.info.get("duration", 100))
-                    else:
-                        img.thumbnail(new_size)
-                        img.save(buf, format=format)
-                    
-                    new_data = buf.getvalue()
-                    cursor.execute("UPDATE images SET data = ? WHERE id = ?", (new_data, img_id))
-                    count += 1
+                new_hash = str(imagehash.dhash(Image.open(BytesIO(new_data))))
             except Exception:
-                pass
-                
+                continue
+            cursor.execute(
+                "UPDATE images SET digest = ?, size = ?, format = ?, phash = ?, dhash = ? WHERE id = ?",
+                (new_digest, len(new_data), _detect_format(new_data, "image"), new_hash, _dhash_to_db(new_hash), img_id)
+            )
+            replaced_digests.append(digest)
+            count += 1
+
+        # Old blobs can only go once the new digests are committed
         conn.commit()
-    finally:
-        conn.close()
+        _release_blobs(cursor, replaced_digests)
+
+    if count:
+        print(f"Resized {count} oversized images.")
+
+def migrate_mixed_segments(conn: sqlite3.Connection):
+    """
+    Replace the base64-in-JSON blobs of mixed memes with meme_segments rows that
+    reference the images in the blob store. Batched and resumable.
+    """
+    cursor = conn.cursor()
+    _create_segments_table(cursor)
+
+    converted = 0
+    query = "SELECT id, digest FROM images WHERE type = 'mixed' AND digest != ''"
+    for rows in iter_batches(conn, "mixed_segments", query, batch_size=50):
+        old_digests = []
+        for img_id, digest in rows:
+            try:
+                content = json.loads(blob_store.get(digest).decode("utf-8"))
+                segments = []
+                for seg in content:
+                    if seg["type"] == "text":
+                        segments.append(("text", seg["data"]["text"]))
+                    elif seg["type"] == "image":
+                        segments.append(("image", base64.b64decode(seg["data"]["file"])))
+            except Exception as e:
+                print(f"Skipping unreadable mixed meme {img_id}: {e}")
+                continue
+
+            cursor.execute("DELETE FROM meme_segments WHERE image_id = ?", (img_id,))
+            size = _store_segments(cursor, img_id, segments)
+            cursor.execute(
+                "UPDATE images SET digest = '', size = ?, format = NULL, phash = ? WHERE id = ?",
+                (size, mixed_meme_hash(segments), img_id)
+            )
+            old_digests.append(digest)
+            converted += 1
+
+        conn.commit()
+        _release_blobs(cursor, old_digests)
+
+    if converted:
+        print(f"Converted {converted} mixed memes to segment storage.")
+
+def enable_incremental_vacuum(conn: sqlite3.Connection):
+    """
+    Switch to auto_vacuum=INCREMENTAL so maintenance can hand free pages back in small
+    steps. The mode only takes effect after one full VACUUM; memes.db holds metadata
+    only (image bytes are in the blob store), so that is quick.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+def _create_usage_table(conn: sqlite3.Connection):
+    # Daily send counts; the key leads with (context_id, day) for "top N in the last days" scans
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS meme_usage (
+        context_id TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        library_id INTEGER NOT NULL,
+        image_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (context_id, day, library_id, image_id)
+    ) WITHOUT ROWID
+    """)
+
+def create_text_search(conn: sqlite3.Connection):
+    """
+    FTS5 index over meme text: one document per meme (rowid = images.id), holding all
+    of its text segments. The trigram tokenizer gives substring matching, which suits
+    Chinese text without a word segmenter. Triggers on meme_segments rebuild a meme's
+    document whenever one of its text segments is added, removed or changed, so every
+    write path (add, delete, sync, import, maintenance) keeps it in step.
+    Needs SQLite >= 3.34 with FTS5; without it search falls back to LIKE.
+    """
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS meme_text USING fts5(text, tokenize = 'trigram')")
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 trigram search unavailable ({e}); meme search will use LIKE.")
+        return
+
+    rebuild = """
+        DELETE FROM meme_text WHERE rowid = {ref}.image_id;
+        INSERT INTO meme_text (rowid, text)
+            SELECT image_id, group_concat(text, char(10)) FROM meme_segments
+            WHERE image_id = {ref}.image_id AND kind = 'text' GROUP BY image_id;
+    """
+    triggers = {
+        "meme_segments_text_ai": ("AFTER INSERT", "new.kind = 'text'", "new"),
+        "meme_segments_text_ad": ("AFTER DELETE", "old.kind = 'text'", "old"),
+        "meme_segments_text_au_old": ("AFTER UPDATE", "old.kind = 'text'", "old"),
+        "meme_segments_text_au_new": ("AFTER UPDATE", "new.kind = 'text'", "new"),
+    }
+    for name, (event, condition, ref) in triggers.items():
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {name} {event} ON meme_segments "
+            f"WHEN {condition} BEGIN {rebuild.format(ref=ref)} END"
+        )
+
+    conn.execute("DELETE FROM meme_text")
+    conn.execute(
+        "INSERT INTO meme_text (rowid, text) SELECT image_id, group_concat(text, char(10)) "
+        "FROM meme_segments WHERE kind = 'text' GROUP BY image_id"
+    )
+
+def _blob_file_size(digest: str) -> int:
+    try:
+        return blob_store.path_for(digest).stat().st_size
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def create_blob_refcounts(conn: sqlite3.Connection):
+    """
+    Global blob table: one row per stored digest with its size, format and the number of
+    image rows and mixed meme segments referencing it. Those rows are the per-library
+    memberships; the same picture added in ten groups is one blob with refcount 10.
+    Triggers on images and meme_segments keep the counts exact on every write path
+    (add, sync, import, re-encode, delete, maintenance), so a delete frees the file only
+    when the count reaches zero instead of searching both tables for other references.
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        size INTEGER NOT NULL DEFAULT 0,
+        format TEXT,
+        refcount INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+
+    add_ref = """
+        INSERT INTO blobs (digest, size, format, refcount) VALUES ({digest}, {size}, {format}, 1)
+        ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1;
+    """
+    drop_ref = "UPDATE blobs SET refcount = refcount - 1 WHERE digest = {digest};"
+    image_ref = {"digest": "new.digest", "size": "new.size", "format": "new.format"}
+    segment_ref = {"digest": "new.digest", "size": "0", "format": "NULL"}
+    triggers = {
+        "images_blob_ai": ("AFTER INSERT ON images", "new.digest != ''", add_ref.format(**image_ref)),
+        "images_blob_ad": ("AFTER DELETE ON images", "old.digest != ''", drop_ref.format(digest="old.digest")),
+        "images_blob_au": (
+            "AFTER UPDATE OF digest ON images", "old.digest IS NOT new.digest",
+            # Either side may be '' (mixed memes keep no blob on the row)
+            "UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.digest AND old.digest != '';"
+            "INSERT INTO blobs (digest, size, format, refcount) SELECT new.digest, new.size, new.format, 1 "
+            "WHERE new.digest != '' ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1;"
+        ),
+        "meme_segments_blob_ai": ("AFTER INSERT ON meme_segments", "new.digest IS NOT NULL",
+                                  add_ref.format(**segment_ref)),
+        "meme_segments_blob_ad": ("AFTER DELETE ON meme_segments", "old.digest IS NOT NULL",
+                                  drop_ref.format(digest="old.digest")),
+        "meme_segments_blob_au": (
+            "AFTER UPDATE OF digest ON meme_segments", "old.digest IS NOT new.digest",
+            "UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.digest;"
+            "INSERT INTO blobs (digest, size, format, refcount) SELECT new.digest, 0, NULL, 1 "
+            "WHERE new.digest IS NOT NULL ON CONFLICT (digest) DO UPDATE SET refcount = refcount + 1;"
+        ),
+    }
+    for name, (event, condition, body) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} WHEN {condition} BEGIN {body} END")
+
+    # Backfill from the existing rows
+    conn.execute("DELETE FROM blobs")
+    conn.execute(
+        "INSERT INTO blobs (digest, size, format, refcount) "
+        "SELECT digest, MAX(size), MAX(format), COUNT(*) FROM images WHERE digest != '' GROUP BY digest"
+    )
+    cursor = conn.execute("SELECT digest, COUNT(*) FROM meme_segments WHERE digest IS NOT NULL GROUP BY digest")
+    for digest, refs in cursor.fetchall():
+        conn.execute(
+            "INSERT INTO blobs (digest, size, format, refcount) VALUES (?, ?, NULL, ?) "
+            "ON CONFLICT (digest) DO UPDATE SET refcount = refcount + excluded.refcount",
+            (digest, _blob_file_size(digest), refs)
+        )
+    unique, refs = conn.execute("SELECT COUNT(*), COALESCE(SUM(refcount), 0) FROM blobs").fetchone()
+    print(f"Tracking {unique} blobs with {refs} references.")
+
+def create_image_sources(conn: sqlite3.Connection):
+    """
+    Lookup from where an image came from to what was stored: source keys like
+    "file:<QQ file id>" or "sha256:<digest of the downloaded bytes>" map to the stored
+    blob's digest and dHash. A repeat add or a delete of a known image then needs no
+    download, decode or hash. Entries go away with their blob.
+    """
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS image_sources (
+        source TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        phash TEXT NOT NULL
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_image_sources_digest ON image_sources (digest)")
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS blobs_sources_ad AFTER DELETE ON blobs "
+        "BEGIN DELETE FROM image_sources WHERE digest = old.digest; END"
+    )
+
+def get_storage_stats() -> dict:
+    """
+    Global dedup savings: unique blobs and their bytes against what storing every
+    reference separately would take.
+    """
+    with connections.read() as conn:
+        unique, stored, refs, logical = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0), COALESCE(SUM(size * refcount), 0) "
+            "FROM blobs WHERE refcount > 0"
+        ).fetchone()
+    return {
+        "blobs": unique,
+        "references": refs,
+        "stored_bytes": stored,
+        "logical_bytes": logical,
+        "saved_bytes": logical - stored,
+        "saved_ratio": (logical - stored) / logical if logical else 0.0,
+    }
+
+# --- Schema migrations ---
+# Applied in order by init_db(); each runs once and records its version in PRAGMA user_version.
+# Existing databases start at version 0: every step checks the current shape first, so a
+# database that was already migrated by older code just gets its version stamped.
+# Append new migrations at the end, never renumber.
+
+MIGRATIONS = [
+    Migration(1, "base schema (libraries, names, images)", _create_schema),
+    Migration(2, "images.type column", migrate_v3),
+    Migration(3, "move image bytes into the blob store", migrate_to_blob_store),
+    Migration(4, "integer dhash column", migrate_dhash_column),
+    Migration(5, "images indexes", _create_indexes),
+    Migration(6, "recompute image hashes as dHash", migrate_to_dhash),
+    Migration(7, f"shrink images larger than {MAX_DIMENSION}px", resize_existing_images),
+    Migration(8, "mixed memes as segment rows", migrate_mixed_segments),
+    Migration(9, "incremental auto-vacuum", enable_incremental_vacuum),
+    Migration(10, "meme_usage table", _create_usage_table),
+    Migration(11, "FTS5 text search over meme segments", create_text_search),
+    Migration(12, "global blob table with reference counts", create_blob_refcounts),
+    Migration(13, "image source lookup (QQ file id / raw sha256)", create_image_sources),
+]
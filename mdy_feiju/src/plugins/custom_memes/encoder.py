@@ -0,0 +1,143 @@
+import os
+from io import BytesIO
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+# Storage re-encoding (env overrides, like MEME_DB_PATH). A target of 0 disables it.
+ENCODE_TARGET_BYTES = int(float(os.getenv("MEME_ENCODE_TARGET_KB", "0")) * 1024)
+ENCODE_MIN_SIMILARITY = float(os.getenv("MEME_ENCODE_MIN_SIMILARITY", "0.95"))
+
+# Images with at most this many colors (on a thumbnail) count as flat art and try a palette PNG
+FLAT_ART_MAX_COLORS = 256
+QUALITY_RANGE = (30, 92)
+PALETTE_SIZES = (256, 128, 64, 32)
+SIMILARITY_MAX_DIM = 512
+
+
+def _flatten_luma(img: Image.Image, size) -> np.ndarray:
+    """Composite onto white, convert to luma and scale to `size` for comparison."""
+    rgba = img.convert("RGBA")
+    background = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+    luma = Image.alpha_composite(background, rgba).convert("L")
+    if luma.size != size:
+        luma = luma.resize(size, Image.Resampling.BILINEAR)
+    return np.asarray(luma, dtype=np.float64)
+
+
+def similarity(original: Image.Image, candidate: Image.Image) -> float:
+    """
+    Mean SSIM over 8x8 blocks of the luma channel, compared at most SIMILARITY_MAX_DIM px.
+    1.0 is identical; ~0.95 is about where compression artifacts become visible on memes.
+    """
+    w, h = original.size
+    scale = min(1.0, SIMILARITY_MAX_DIM / max(w, h))
+    size = (max(8, int(w * scale)), max(8, int(h * scale)))
+    a = _flatten_luma(original, size)
+    b = _flatten_luma(candidate, size)
+
+    bh, bw = a.shape[0] // 8 * 8, a.shape[1] // 8 * 8
+    a = a[:bh, :bw].reshape(bh // 8, 8, bw // 8, 8)
+    b = b[:bh, :bw].reshape(bh // 8, 8, bw // 8, 8)
+    mu_a, mu_b = a.mean(axis=(1, 3)), b.mean(axis=(1, 3))
+    var_a, var_b = a.var(axis=(1, 3)), b.var(axis=(1, 3))
+    cov = ((a - mu_a[:, None, :, None]) * (b - mu_b[:, None, :, None])).mean(axis=(1, 3))
+
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim.mean())
+
+
+def _is_flat_art(img: Image.Image) -> bool:
+    thumb = img.copy()
+    thumb.thumbnail((128, 128))
+    return thumb.convert("RGBA").getcolors(maxcolors=FLAT_ART_MAX_COLORS) is not None
+
+
+def _encode_lossy(img: Image.Image, fmt: str, quality: int) -> bytes:
+    buf = BytesIO()
+    if fmt == "JPEG":
+        img.convert("RGB").save(buf, format="JPEG", quality=quality, optimize=True, progressive=True)
+    else:
+        img.save(buf, format="WEBP", quality=quality, method=4)
+    return buf.getvalue()
+
+
+def _encode_palette(img: Image.Image, colors: int) -> bytes:
+    method = Image.Quantize.FASTOCTREE if img.mode == "RGBA" else Image.Quantize.MEDIANCUT
+    buf = BytesIO()
+    img.quantize(colors=colors, method=method).save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def _search_quality(img: Image.Image, fmt: str, target_bytes: int) -> bytes:
+    """Highest quality that fits target_bytes (binary search), or the lowest quality tried."""
+    lo, hi = QUALITY_RANGE
+    best = None
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = _encode_lossy(img, fmt, quality)
+        if len(data) <= target_bytes:
+            best = data
+            lo = quality + 1
+        else:
+            hi = quality - 1
+    return best if best is not None else _encode_lossy(img, fmt, QUALITY_RANGE[0])
+
+
+def _search_palette(img: Image.Image, target_bytes: int) -> bytes:
+    """Largest palette that fits target_bytes, or the smallest palette tried."""
+    data = b""
+    for colors in PALETTE_SIZES:
+        data = _encode_palette(img, colors)
+        if len(data) <= target_bytes:
+            break
+    return data
+
+
+def encode_to_budget(data: bytes, target_bytes: int = ENCODE_TARGET_BYTES,
+                     min_similarity: float = ENCODE_MIN_SIMILARITY) -> bytes:
+    """
+    Re-encode a still image to fit `target_bytes`.
+
+    Flat art (few colors) tries an optimized palette PNG; everything tries lossy WebP,
+    and opaque images also JPEG, each searched for the highest quality that fits.
+    A candidate must stay above `min_similarity` (see similarity()) and be smaller
+    than the input. Among those that fit the budget the most faithful one wins,
+    otherwise the smallest. Returns the input unchanged when nothing qualifies,
+    when it's already within budget, for animations, or if target_bytes <= 0.
+    """
+    if target_bytes <= 0 or len(data) <= target_bytes:
+        return data
+    try:
+        img = Image.open(BytesIO(data))
+        if getattr(img, "is_animated", False):
+            return data
+        img.load()
+    except Exception:
+        return data
+
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    work = img.convert("RGBA" if has_alpha else "RGB")
+
+    candidates: List[bytes] = []
+    if _is_flat_art(work):
+        candidates.append(_search_palette(work, target_bytes))
+    candidates.append(_search_quality(work, "WEBP", target_bytes))
+    if not has_alpha:
+        candidates.append(_search_quality(work, "JPEG", target_bytes))
+
+    best: Optional[bytes] = None
+    best_key = None
+    for candidate in candidates:
+        if len(candidate) >= len(data):
+            continue
+        score = similarity(work, Image.open(BytesIO(candidate)))
+        if score < min_similarity:
+            continue
+        fits = len(candidate) <= target_bytes
+        key = (fits, score if fits else -len(candidate))
+        if best_key is None or key > best_key:
+            best, best_key = candidate, key
+    return best if best is not None else data
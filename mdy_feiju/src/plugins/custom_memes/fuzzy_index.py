@@ -0,0 +1,149 @@
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+def _grams(text: str) -> Set[str]:
+    """Padded character bigrams: "猫猫" -> {"^猫", "猫猫", "猫$"}. Bigrams suit 2-4 character names."""
+    padded = f"^{text}$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance, or limit + 1 as soon as it must exceed `limit`."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def max_distance(text: str) -> int:
+    """Edits tolerated for a query of this length (one typo in a short Chinese name)."""
+    if len(text) <= 4:
+        return 1
+    return 2 if len(text) <= 8 else 3
+
+
+class GroupGrams:
+    """One context's names and their bigram postings."""
+
+    __slots__ = ("names", "postings")
+
+    def __init__(self, names: Iterable[str]):
+        self.names: Set[str] = set()
+        self.postings: Dict[str, Set[str]] = defaultdict(set)
+        for name in names:
+            self.add(name)
+
+    def add(self, name: str):
+        if name in self.names:
+            return
+        self.names.add(name)
+        for gram in _grams(name):
+            self.postings[gram].add(name)
+
+    def remove(self, name: str):
+        if name not in self.names:
+            return
+        self.names.discard(name)
+        for gram in _grams(name):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                posting.discard(name)
+                if not posting:
+                    del self.postings[gram]
+
+    def closest(self, text: str, limit: int) -> List[Tuple[int, str]]:
+        grams = _grams(text)
+        distance = max_distance(text)
+        # Count filter: one edit changes at most two bigrams, so a name within `distance`
+        # edits shares at least len(grams) - 2 * distance of them (and at least one)
+        needed = max(1, len(grams) - 2 * distance)
+
+        shared: Dict[str, int] = defaultdict(int)
+        for gram in grams:
+            for name in self.postings.get(gram, ()):
+                shared[name] += 1
+
+        scored = []
+        for name, count in shared.items():
+            if count < needed or name == text:
+                continue
+            d = edit_distance(text, name, distance)
+            if d <= distance:
+                scored.append((d, -count, len(name), name))
+        scored.sort()
+        return [(d, name) for d, _, _, name in scored[:limit]]
+
+
+class FuzzyNameIndex:
+    """
+    Per-context bigram inverted index over library names and aliases, for
+    "did you mean" suggestions when a lookup finds nothing.
+
+    Candidates come from the postings of the query's bigrams (never a scan over
+    every name) and are ranked by edit distance. `loader(context_id)` returns the
+    context's names; a context is loaded on first use, then kept in step by the
+    db layer as names are added and removed.
+    """
+
+    def __init__(self, loader: Callable[[str], Iterable[str]]):
+        self._loader = loader
+        self._groups: Dict[str, GroupGrams] = {}
+        # Bumped by every change, so a load that raced with a write isn't kept
+        self._versions: Dict[str, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _group(self, context_id: str) -> GroupGrams:
+        with self._lock:
+            group = self._groups.get(context_id)
+            if group is not None:
+                return group
+            version = (self._epoch, self._versions.get(context_id, 0))
+        group = GroupGrams(self._loader(context_id))
+        with self._lock:
+            if (self._epoch, self._versions.get(context_id, 0)) == version:
+                group = self._groups.setdefault(context_id, group)
+            return group
+
+    def suggest(self, text: str, context_id: str, limit: int = 3) -> List[str]:
+        """Up to `limit` existing names closest to `text`, nearest first."""
+        text = text.strip().lower()
+        if not text:
+            return []
+        group = self._group(context_id)
+        with self._lock:
+            return [name for _, name in group.closest(text, limit)]
+
+    def add(self, name: str, context_id: str):
+        with self._lock:
+            self._versions[context_id] = self._versions.get(context_id, 0) + 1
+            group = self._groups.get(context_id)
+            if group is not None:
+                group.add(name)
+
+    def remove(self, name: str, context_id: str):
+        with self._lock:
+            self._versions[context_id] = self._versions.get(context_id, 0) + 1
+            group = self._groups.get(context_id)
+            if group is not None:
+                group.remove(name)
+
+    def invalidate(self, context_id: Optional[str] = None):
+        """Forget one context (or all of them) so it is reloaded on next use."""
+        with self._lock:
+            if context_id is None:
+                self._epoch += 1
+                self._versions.clear()
+                self._groups.clear()
+            else:
+                self._versions[context_id] = self._versions.get(context_id, 0) + 1
+                self._groups.pop(context_id, None)
@@ -1,18 +1,43 @@
 import re
-import json
-import base64
+import time
+import asyncio
+from typing import List, Optional
 from nonebot.adapters.onebot.v11 import Bot, MessageEvent, PrivateMessageEvent, MessageSegment, Message
 from nonebot.matcher import Matcher
 from nonebot import get_driver
+from nonebot.log import logger
 
 from . import db
-from .utils import get_context_id, MAX_DIMENSION
+from .utils import get_context_id, close_http_client
 from .data_source import MemeManager
+from .repository import repo
+from .pipeline import pipeline
+from .encoder import ENCODE_TARGET_BYTES
+from . import archive
+from . import maintenance
+from . import usage
+
+# Forwards nested inside forwards are followed this deep when batch adding
+FORWARD_MAX_DEPTH = 3
 
 async def init_data():
+    # Fork the image workers first, while no other thread is running yet
+    pipeline.start()
     db.init_db()
     db.migrate_lowercase_categories()
-    db.resize_existing_images(MAX_DIMENSION)
+    maintenance.start_schedule()
+    usage.start_flusher()
+
+async def shutdown_data():
+    stats = db.get_db_stats()
+    logger.info(f"[CustomMemes] memes.db stats: {stats}")
+    logger.info(f"[CustomMemes] send cache stats: {db.send_cache.stats()}")
+    maintenance.stop_schedule()
+    await usage.stop_flusher()
+    pipeline.shutdown()
+    repo.shutdown()
+    await close_http_client()
+    db.connections.close()
 
 async def handle_get_meme(matcher: Matcher, event: MessageEvent):
     msg = event.get_plaintext().strip()
@@ -23,9 +48,12 @@ async def handle_get_meme(matcher: Matcher, event: MessageEvent):
     raw_text = match.group(1).strip()
     context_id = get_context_id(event)
     
-    result, matched_name = MemeManager.get_meme(raw_text, context_id)
+    result, matched_name = await MemeManager.get_meme(raw_text, context_id)
     
     if not matched_name:
+        suggestions = await MemeManager.suggest_names(raw_text, context_id)
+        if suggestions:
+            await matcher.finish(f"一张{raw_text}都没有，来鸡毛？\n你是不是想找：{'、'.join(suggestions)}")
         await matcher.finish(f"一张{raw_text}都没有，来鸡毛？")
 
     if not result:
@@ -45,6 +73,12 @@ async def handle_add_meme(matcher: Matcher, bot: Bot, event: MessageEvent):
     if "--force" in category_name:
         force = True
         category_name = category_name.replace("--force", "").strip()
+
+    # --each: every image is its own meme instead of one mixed meme
+    each = False
+    if "--each" in category_name:
+        each = True
+        category_name = category_name.replace("--each", "").strip()
     
     if not category_name:
         return
@@ -56,33 +90,51 @@ async def handle_add_meme(matcher: Matcher, bot: Bot, event: MessageEvent):
     # No longer require images check here, as we support text
 
     context_id = get_context_id(event)
+
+    # A forwarded chat can't be one meme, so it is always added image by image
+    if each or any(seg.type == "forward" for seg in reply_msg):
+        urls = await _collect_image_urls(bot, [{"type": seg.type, "data": seg.data} for seg in reply_msg])
+        if len(urls) > 1:
+            await matcher.send(f"找到 {len(urls)} 张图片，正在添加...")
+        await matcher.finish(await MemeManager.add_memes_batch(category_name, urls, context_id, force=force))
+
     result_msg, dup_img = await MemeManager.add_meme(category_name, reply_msg, context_id, force=force)
     
     if dup_img:
         # If duplicate found, send message with the conflicting original image/content
-        # Check if dup_img is JSON (mixed) or bytes (image)
-        try:
-             # Try to parse as JSON list
-            content = json.loads(dup_img.decode("utf-8"))
-            if isinstance(content, list):
-                 # Construct message
-                 dup_msg = Message()
-                 for seg in content:
-                    if seg["type"] == "text":
-                        dup_msg.append(MessageSegment.text(seg["data"]["text"]))
-                    elif seg["type"] == "image":
-                        img_bytes = base64.b64decode(seg["data"]["file"])
-                        dup_msg.append(MessageSegment.image(img_bytes))
-                 await matcher.finish(result_msg + dup_msg)
-                 return
-        except Exception:
-            pass
-            
-        # Fallback to pure image
-        await matcher.finish(result_msg + MessageSegment.image(dup_img))
+        # (bytes for an image meme, a segment list for a mixed one)
+        meme_type = "mixed" if isinstance(dup_img, list) else "image"
+        await matcher.finish(result_msg + MemeManager.build_message(dup_img, meme_type))
     else:
         await matcher.finish(result_msg)
 
+async def _collect_image_urls(bot: Bot, segments: List[dict], depth: int = 0) -> List[str]:
+    """
+    Image urls of a message, in order, including those inside forwarded messages
+    (fetched with get_forward_msg; nested forwards up to FORWARD_MAX_DEPTH levels).
+    """
+    urls = []
+    for seg in segments:
+        data = seg.get("data") or {}
+        if seg.get("type") == "image":
+            url = data.get("url") or data.get("file")
+            if url and url.startswith("http"):
+                urls.append(url)
+        elif seg.get("type") == "forward" and depth < FORWARD_MAX_DEPTH:
+            nodes = data.get("content")
+            if not isinstance(nodes, list):
+                try:
+                    forward = await bot.get_forward_msg(id=data.get("id"))
+                except Exception as e:
+                    logger.warning(f"[CustomMemes] Failed to fetch forward message {data.get('id')}: {e}")
+                    continue
+                nodes = forward.get("messages", []) if isinstance(forward, dict) else []
+            for node in nodes:
+                content = node.get("message") or node.get("content") or []
+                if isinstance(content, list):
+                    urls.extend(await _collect_image_urls(bot, content, depth + 1))
+    return urls
+
 async def handle_delete_meme(matcher: Matcher, bot: Bot, event: MessageEvent):
     msg = event.get_plaintext().strip()
     category_name = msg[2:].strip()
@@ -119,22 +171,198 @@ async def handle_sync(matcher: Matcher, bot: Bot, event: PrivateMessageEvent):
         msg = msg[2:].strip()
         
     parts = msg.split()
+    # Only the flag: a word like 全部 could be a library name
+    if len(parts) == 3 and parts[2] == "--all":
+        await start_sync_all(matcher, bot, event, parts[0], parts[1])
+        return
+
     if len(parts) < 3:
-        await matcher.finish("格式错误！\n请发送：/同步 [源ID] [目标ID] [关键词]")
+        await matcher.finish("格式错误！\n请发送：/同步 [源ID] [目标ID] [关键词]\n或同步全部图库（--all 是参数，不是图库名）：/同步 [源ID] [目标ID] --all")
         return
         
     raw_source = parts[0]
     raw_target = parts[1]
     keyword = " ".join(parts[2:]).strip()
 
-    result = MemeManager.sync_memes(raw_source, raw_target, keyword)
+    result = await MemeManager.sync_memes(raw_source, raw_target, keyword)
+    await matcher.finish(result)
+
+# Background "sync all libraries" job (one at a time)
+_sync_all_task: Optional[asyncio.Task] = None
+
+async def start_sync_all(matcher: Matcher, bot: Bot, event: PrivateMessageEvent, raw_source: str, raw_target: str):
+    global _sync_all_task
+    if _sync_all_task is not None and not _sync_all_task.done():
+        await matcher.finish("已经有一个全部同步任务在跑了，等它结束再来")
+        return
+
+    user_id = event.user_id
+
+    async def report(text: str):
+        try:
+            await bot.send_private_msg(user_id=user_id, message=text)
+        except Exception as e:
+            logger.warning(f"[CustomMemes] Failed to send sync progress: {e}")
+
+    async def run():
+        try:
+            result = await MemeManager.sync_all_memes(raw_source, raw_target, report)
+        except Exception as e:
+            logger.exception("[CustomMemes] Sync-all job failed")
+            result = f"全部同步失败：{e}"
+        await report(result)
+
+    _sync_all_task = asyncio.create_task(run())
+    await matcher.finish(f"开始后台同步 {raw_source} 的全部图库到 {raw_target}，完成后通知你")
+
+async def handle_status(matcher: Matcher, event: MessageEvent):
+    if str(event.user_id) not in get_driver().config.superusers:
+        await matcher.finish("你不是超管，不能用这个命令")
+        return
+
+    stats = db.get_db_stats()
+    cache = db.send_cache.stats()
+    storage = await repo.get_storage_stats()
+    status_msg = (
+        "📊 图库数据库状态\n"
+        f"已打开连接: {stats['connections_opened']}\n"
+        f"读: {stats['reads']} 次，平均 {stats['avg_read_ms']:.2f} ms，最慢 {stats['max_read_ms']:.2f} ms\n"
+        f"写: {stats['writes']} 次，平均 {stats['avg_write_ms']:.2f} ms，最慢 {stats['max_write_ms']:.2f} ms\n"
+        f"写锁等待累计: {stats['write_wait_ms']:.2f} ms\n"
+        f"发送缓存: {cache['entries']} 条，{cache['bytes'] / 1024 / 1024:.1f}/{cache['max_bytes'] / 1024 / 1024:.0f} MB，"
+        f"命中 {cache['hits']} / 未命中 {cache['misses']}（{cache['hit_rate']:.0%}），淘汰 {cache['evictions']}\n"
+        f"图片存储: {storage['blobs']} 个文件 {storage['stored_bytes'] / 1024 / 1024:.1f} MB，被引用 {storage['references']} 次，"
+        f"去重节省 {storage['saved_bytes'] / 1024 / 1024:.1f} MB（{storage['saved_ratio']:.0%}）"
+    )
+    report = maintenance.last_report
+    if report:
+        status_msg += (
+            f"\n上次维护: {time.strftime('%Y-%m-%d %H:%M', time.localtime(report['started_at']))}，"
+            f"回收 {report['bytes_reclaimed'] / 1024 / 1024:.2f} MB"
+        )
+    await matcher.finish(status_msg)
+
+async def handle_maintenance(matcher: Matcher, event: MessageEvent):
+    if str(event.user_id) not in get_driver().config.superusers:
+        await matcher.finish("你不是超管，不能用这个命令")
+        return
+
+    await matcher.send("开始维护图库数据库，请稍等...")
+    report = await asyncio.to_thread(maintenance.run_maintenance)
+    if report is None:
+        await matcher.finish("维护已经在进行中了")
+        return
+    await matcher.finish(maintenance.format_report(report))
+
+async def handle_reencode(matcher: Matcher, event: MessageEvent):
+    if str(event.user_id) not in get_driver().config.superusers:
+        await matcher.finish("你不是超管，不能用这个命令")
+        return
+
+    msg = event.get_plaintext().strip()
+    if msg.startswith("/压缩图库"):
+        msg = msg[5:].strip()
+    elif msg.startswith("压缩图库"):
+        msg = msg[4:].strip()
+
+    # Optional "--kb N" overrides MEME_ENCODE_TARGET_KB
+    target_bytes = ENCODE_TARGET_BYTES
+    match = re.search(r"--kb\s+(\d+)", msg)
+    if match:
+        target_bytes = int(match.group(1)) * 1024
+        msg = (msg[:match.start()] + msg[match.end():]).strip()
+
+    if target_bytes <= 0:
+        await matcher.finish("没设置目标大小！\n请配置 MEME_ENCODE_TARGET_KB 或发送：/压缩图库 [关键词] --kb 500")
+        return
+
+    keyword = msg or None
+    scope = f"'{keyword}'" if keyword else "所有图库"
+    await matcher.send(f"开始重新编码{scope}中超过 {target_bytes // 1024} KB 的图片，请稍等...")
+    result = await MemeManager.reencode_memes(target_bytes, keyword, get_context_id(event))
+    await matcher.finish(result)
+
+async def handle_export(matcher: Matcher, event: MessageEvent):
+    if str(event.user_id) not in get_driver().config.superusers:
+        await matcher.finish("你不是超管，不能用这个命令")
+        return
+
+    msg = event.get_plaintext().strip()
+    if msg.startswith("/导出图库"):
+        msg = msg[5:].strip()
+    elif msg.startswith("导出图库"):
+        msg = msg[4:].strip()
+
+    fmt = "tar"
+    if "--zip" in msg:
+        fmt = "zip"
+        msg = msg.replace("--zip", "").strip()
+
+    context_id = MemeManager.parse_context(msg) if msg else get_context_id(event)
+    if not await repo.get_group_libraries(context_id):
+        await matcher.finish(f"{context_id} 没有任何图库")
+        return
+
+    await matcher.send(f"开始导出 {context_id} 的图库，请稍等...")
+    path = archive.new_export_path(context_id, fmt)
+    try:
+        stats = await asyncio.to_thread(archive.export_group, context_id, path, fmt)
+    except Exception as e:
+        logger.exception(f"[CustomMemes] Export of {context_id} failed")
+        await matcher.finish(f"导出失败：{e}")
+        return
+
+    result = (f"导出完成：{stats['libraries']} 个图库，{stats['memes']} 个表情，"
+              f"{stats['bytes'] / 1024 / 1024:.1f} MB\n文件：{path.name}")
+    if stats["missing"]:
+        result += f"\n{stats['missing']} 个表情的图片文件已丢失，未导出"
+    await matcher.finish(result)
+
+async def handle_import(matcher: Matcher, event: MessageEvent):
+    if str(event.user_id) not in get_driver().config.superusers:
+        await matcher.finish("你不是超管，不能用这个命令")
+        return
+
+    msg = event.get_plaintext().strip()
+    if msg.startswith("/导入图库"):
+        msg = msg[5:].strip()
+    elif msg.startswith("导入图库"):
+        msg = msg[4:].strip()
+
+    parts = msg.split()
+    if not parts or len(parts) > 2:
+        await matcher.finish("格式错误！\n请发送：/导入图库 [文件名] [目标ID]\n不填目标ID则导入回原来的群")
+        return
+
+    try:
+        path = archive.resolve_archive(parts[0])
+    except archive.ArchiveError as e:
+        await matcher.finish(str(e))
+        return
+    target = MemeManager.parse_context(parts[1]) if len(parts) == 2 else None
+
+    await matcher.send(f"开始导入 {path.name}，请稍等...")
+    try:
+        stats = await asyncio.to_thread(archive.import_archive, path, target)
+    except archive.ArchiveError as e:
+        await matcher.finish(f"导入失败：{e}")
+        return
+    except Exception as e:
+        logger.exception(f"[CustomMemes] Import of {path.name} failed")
+        await matcher.finish(f"导入失败：{e}")
+        return
+
+    result = (f"导入完成：{stats['libraries']} 个图库，新增 {stats['added']} 个表情，"
+              f"跳过重复 {stats['duplicates']} 个")
+    if stats["failed"]:
+        result += f"，失败 {stats['failed']} 个"
     await matcher.finish(result)
 
 async def handle_list_memes(matcher: Matcher, bot: Bot, event: MessageEvent):
     context_id = get_context_id(event)
-    memes = MemeManager.get_all_memes(context_id)
+    count, chunks = await MemeManager.get_listing(context_id)
     
-    if not memes:
+    if not count:
         await matcher.finish("当前群没有任何图库")
         return
 
@@ -151,14 +379,12 @@ async def handle_list_memes(matcher: Matcher, bot: Bot, event: MessageEvent):
         MessageSegment.node_custom(
             user_id=sender_id, # Use sender's ID to look like they sent it, or bot's ID
             nickname=sender_name,
-            content=Message(f"当前群共有 {len(memes)} 个图库")
+            content=Message(f"当前群共有 {count} 个图库")
         )
     )
     
-    chunk_size = 50
-    for i in range(0, len(memes), chunk_size):
-        chunk = memes[i:i + chunk_size]
-        text = "\n".join(chunk)
+    # Chunk texts are pre-rendered by the listing cache
+    for text in chunks:
         msgs.append(
             MessageSegment.node_custom(
                 user_id=sender_id,
@@ -186,6 +412,90 @@ async def handle_list_memes(matcher: Matcher, bot: Bot, event: MessageEvent):
         traceback.print_exc()
         await matcher.finish(f"发送合并消息失败：{e}\n请检查Bot是否有发送合并消息的权限。")
 
+async def handle_hot_memes(matcher: Matcher, bot: Bot, event: MessageEvent):
+    msg = event.get_plaintext().strip()[4:].strip()
+    match = re.fullmatch(r"(\d+)\s*天?", msg)
+    if msg and not match:
+        return
+    days = min(int(match.group(1)), 365) if match else 7
+    if days <= 0:
+        await matcher.finish("天数至少是 1")
+        return
+
+    context_id = get_context_id(event)
+    libraries, images = await MemeManager.get_hot_memes(context_id, days)
+    if not libraries:
+        await matcher.finish(f"最近 {days} 天还没人来过表情包")
+        return
+
+    sender_id = str(event.user_id)
+    sender_name = event.sender.nickname or "Bot"
+    ranking = "\n".join(f"{i}. {name}：{count} 次" for i, (name, count) in enumerate(libraries, 1))
+    msgs = [
+        MessageSegment.node_custom(
+            user_id=sender_id,
+            nickname=sender_name,
+            content=Message(f"🔥 最近 {days} 天热门图库\n{ranking}")
+        )
+    ]
+    for i, (name, count, meme) in enumerate(images, 1):
+        msgs.append(
+            MessageSegment.node_custom(
+                user_id=sender_id,
+                nickname=sender_name,
+                content=Message(f"热门表情第 {i} 名 · {name} · {count} 次\n") + meme
+            )
+        )
+
+    try:
+        if isinstance(event, PrivateMessageEvent):
+            await bot.send_private_forward_msg(user_id=event.user_id, messages=msgs)
+        else:
+            await bot.send_group_forward_msg(group_id=event.group_id, messages=msgs)
+    except Exception as e:
+        logger.warning(f"[CustomMemes] Failed to send hot memes forward message: {e}")
+        # Fall back to the plain ranking
+        await matcher.finish(f"🔥 最近 {days} 天热门图库\n{ranking}")
+
+async def handle_search_memes(matcher: Matcher, bot: Bot, event: MessageEvent):
+    query = event.get_plaintext().strip()[4:].strip()
+    if not query:
+        await matcher.finish("搜什么？例如：搜索表情 下班")
+        return
+
+    context_id = get_context_id(event)
+    results = await MemeManager.search_memes(query, context_id)
+    if not results:
+        await matcher.finish(f"没有找到包含「{query}」的表情")
+        return
+
+    sender_id = str(event.user_id)
+    sender_name = event.sender.nickname or "Bot"
+    msgs = [
+        MessageSegment.node_custom(
+            user_id=sender_id,
+            nickname=sender_name,
+            content=Message(f"🔍 包含「{query}」的表情（{len(results)} 个）")
+        )
+    ]
+    for name, meme in results:
+        msgs.append(
+            MessageSegment.node_custom(
+                user_id=sender_id,
+                nickname=sender_name,
+                content=Message(f"来自 {name}：\n") + meme
+            )
+        )
+
+    try:
+        if isinstance(event, PrivateMessageEvent):
+            await bot.send_private_forward_msg(user_id=event.user_id, messages=msgs)
+        else:
+            await bot.send_group_forward_msg(group_id=event.group_id, messages=msgs)
+    except Exception as e:
+        logger.warning(f"[CustomMemes] Failed to send search results forward message: {e}")
+        await matcher.finish(f"找到 {len(results)} 个，但发送合并消息失败：{e}")
+
 async def handle_help(matcher: Matcher):
     help_msg = (
         "✨花活列表✨\n"
@@ -194,6 +504,7 @@ async def handle_help(matcher: Matcher):
         "2. 添加[关键词] [图片/文字]\n"
         "   👉 回复图片或文字发送：添加哆啦A梦\n"
         "   💡 添加 --force 跳过查重：添加哆啦A梦 --force\n"
+        "   💡 添加 --each 把每张图分别加入，回复合并转发时自动批量：添加哆啦A梦 --each\n"
         "3. 删除[关键词] [图片/文字]\n"
         "   👉 回复我发的消息发送：删除哆啦A梦\n"
         "4. 添加别名 [原名] [别名]\n"
@@ -203,7 +514,11 @@ async def handle_help(matcher: Matcher):
         "6. 查看别名 [关键词]\n"
         "   👉 例如：查看别名 哆啦A梦\n"
         "7. 查看图库\n"
-        "   👉 查看本群所有表情包库名\n\n"
-        "⚠️ 注意：同步功能仅限超管使用"
+        "   👉 查看本群所有表情包库名\n"
+        "8. 热门图库 [天数]\n"
+        "   👉 最近几天最常用的图库和表情，默认 7 天，例如：热门图库 30\n"
+        "9. 搜索表情 [文字]\n"
+        "   👉 按内容搜索本群的文字/图文表情，例如：搜索表情 下班\n\n"
+        "⚠️ 注意：同步、压缩图库、导出/导入图库、维护图库功能仅限超管使用"
     )
     await matcher.finish(help_msg)
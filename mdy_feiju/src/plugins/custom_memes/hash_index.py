@@ -0,0 +1,358 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+HASH_BITS = 64
+_SIGN_BIT = 1 << (HASH_BITS - 1)
+_MASK = (1 << HASH_BITS) - 1
+
+# The vectorized scan beats BK-tree pruning except for narrow radii on huge libraries:
+# at the add threshold (18 of 64 bits) the tree visits most of its nodes.
+# See bench_dedup.py for the numbers behind these cutoffs.
+BK_TREE_MAX_THRESHOLD = 4
+BK_TREE_MIN_SIZE = 500_000
+
+
+def hex_to_int(hex_hash: str) -> int:
+    """imagehash hex string (16 hex chars for the default 8x8 dHash) -> unsigned 64-bit int."""
+    return int(hex_hash, 16) & _MASK
+
+
+def to_signed64(value: int) -> int:
+    """SQLite INTEGER is signed 64-bit; fold the unsigned hash into that range for storage."""
+    return value - (1 << HASH_BITS) if value & _SIGN_BIT else value
+
+
+def from_signed64(value: int) -> int:
+    return value & _MASK
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def popcount64(values: np.ndarray) -> np.ndarray:
+    """Per-element popcount of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    # SWAR popcount for NumPy < 2.0
+    x = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+def filter_new_hashes(candidates: List[int], existing: List[int], threshold: int,
+                      max_cells: int = 4_000_000) -> List[int]:
+    """
+    Bulk near-duplicate filter. Returns the indices of `candidates` (in order) that are
+    farther than `threshold` from every `existing` hash and from every earlier kept
+    candidate, i.e. what adding them one by one with a duplicate check would keep.
+    Candidates are compared against `existing` in vectorized blocks of at most
+    `max_cells` distances.
+    """
+    cand = np.fromiter(candidates, dtype=np.uint64, count=len(candidates))
+    keep = np.ones(len(cand), dtype=bool)
+
+    if existing:
+        ex = np.fromiter(existing, dtype=np.uint64, count=len(existing))
+        rows = max(1, max_cells // len(ex))
+        for start in range(0, len(cand), rows):
+            block = cand[start:start + rows]
+            keep[start:start + rows] = popcount64(block[:, None] ^ ex[None, :]).min(axis=1) > threshold
+
+    # Greedy pass for duplicates within the candidates themselves
+    kept = np.empty(len(cand), dtype=np.uint64)
+    count = 0
+    result = []
+    for i in np.flatnonzero(keep):
+        h = cand[i]
+        if count and int(popcount64(kept[:count] ^ h).min()) <= threshold:
+            continue
+        kept[count] = h
+        count += 1
+        result.append(int(i))
+    return result
+
+
+class PackedHashes:
+    """
+    A library's hashes packed into a uint64 array, scanned in one vectorized
+    XOR + popcount instead of a Python loop. Appends are buffered and folded in
+    on the next query; removals are handled by rebuilding (see HashIndex).
+    """
+
+    __slots__ = ("hashes", "ids", "_pending")
+
+    def __init__(self, entries: Iterable[Tuple[int, int]] = ()):
+        entries = list(entries)
+        self.hashes = np.fromiter((h for h, _ in entries), dtype=np.uint64, count=len(entries))
+        self.ids = np.fromiter((i for _, i in entries), dtype=np.int64, count=len(entries))
+        self._pending: List[Tuple[int, int]] = []
+
+    def __len__(self) -> int:
+        return len(self.hashes) + len(self._pending)
+
+    def append(self, hash_value: int, image_id: int):
+        self._pending.append((hash_value, image_id))
+
+    def _flush(self):
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        self.hashes = np.concatenate([self.hashes, np.array([h for h, _ in pending], dtype=np.uint64)])
+        self.ids = np.concatenate([self.ids, np.array([i for _, i in pending], dtype=np.int64)])
+
+    def distances(self, hash_value: int) -> np.ndarray:
+        self._flush()
+        return popcount64(self.hashes ^ np.uint64(hash_value))
+
+    def nearest(self, hash_value: int, threshold: int) -> Optional[Tuple[int, int]]:
+        if not len(self):
+            return None
+        dists = self.distances(hash_value)
+        i = int(dists.argmin())
+        dist = int(dists[i])
+        if dist > threshold:
+            return None
+        return int(self.ids[i]), dist
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with Hamming distance.
+    Each node holds one hash value and the image ids sharing it.
+    Removed ids leave their node in place as a routing point; the tree is
+    rebuilt once more than half of its nodes are empty.
+    """
+
+    __slots__ = ("root", "node_count", "empty_count")
+
+    def __init__(self, entries: Iterable[Tuple[int, int]] = ()):
+        # node = [hash, [image ids], {distance: child}]
+        self.root = None
+        self.node_count = 0
+        self.empty_count = 0
+        for hash_value, image_id in entries:
+            self.add(hash_value, image_id)
+
+    def __len__(self) -> int:
+        return self.node_count - self.empty_count
+
+    def add(self, hash_value: int, image_id: int):
+        if self.root is None:
+            self.root = [hash_value, [image_id], {}]
+            self.node_count = 1
+            return
+
+        node = self.root
+        while True:
+            dist = hamming(hash_value, node[0])
+            if dist == 0:
+                if not node[1]:
+                    self.empty_count -= 1
+                if image_id not in node[1]:
+                    node[1].append(image_id)
+                return
+            child = node[2].get(dist)
+            if child is None:
+                node[2][dist] = [hash_value, [image_id], {}]
+                self.node_count += 1
+                return
+            node = child
+
+    def remove(self, hash_value: int, image_id: int) -> bool:
+        node = self.root
+        while node is not None:
+            dist = hamming(hash_value, node[0])
+            if dist == 0:
+                if image_id in node[1]:
+                    node[1].remove(image_id)
+                    if not node[1]:
+                        self.empty_count += 1
+                        if self.empty_count * 2 > self.node_count:
+                            self._rebuild()
+                    return True
+                return False
+            node = node[2].get(dist)
+        return False
+
+    def entries(self) -> List[Tuple[int, int]]:
+        result = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            result.extend((node[0], image_id) for image_id in node[1])
+            stack.extend(node[2].values())
+        return result
+
+    def _rebuild(self):
+        entries = self.entries()
+        self.root = None
+        self.node_count = 0
+        self.empty_count = 0
+        for hash_value, image_id in entries:
+            self.add(hash_value, image_id)
+
+    def nearest(self, hash_value: int, threshold: int) -> Optional[Tuple[int, int]]:
+        """
+        Closest stored hash within `threshold`.
+        Returns (image_id, distance) or None. The search radius shrinks as better matches are found.
+        """
+        if self.root is None:
+            return None
+
+        best = None
+        radius = threshold
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            dist = hamming(hash_value, node[0])
+            if node[1] and dist <= radius:
+                if best is None or dist < best[1]:
+                    best = (node[1][0], dist)
+                    radius = dist
+                    if dist == 0:
+                        break
+            # Triangle inequality: only children at distance [dist - radius, dist + radius] can match
+            low, high = dist - radius, dist + radius
+            for child_dist, child in node[2].items():
+                if low <= child_dist <= high:
+                    stack.append(child)
+        return best
+
+
+class HashIndex:
+    """
+    Per-library dHash index for image memes, loaded lazily via
+    `loader(library_id) -> [(hash, image_id)]` and kept in sync on add/delete/merge.
+
+    The canonical copy is a {image_id: hash} dict. Lookups go through a packed
+    NumPy array built from it on demand (appends are buffered, removals and merges
+    drop it so it is rebuilt on the next query). Only very large libraries with a
+    narrow radius get a BK-tree, which is the one case where it beats the scan.
+    """
+
+    def __init__(self, loader: Callable[[int], List[Tuple[int, int]]]):
+        self._loader = loader
+        self._hashes: Dict[int, Dict[int, int]] = {}
+        self._packed: Dict[int, PackedHashes] = {}
+        self._trees: Dict[int, BKTree] = {}
+        # Bumped by every change (per library, or all at once), so a load that raced with a write isn't kept
+        self._versions: Dict[int, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _changed(self, library_id: int):
+        self._versions[library_id] = self._versions.get(library_id, 0) + 1
+
+    def _ensure_loaded(self, library_id: int) -> Dict[int, int]:
+        # The DB read happens without the lock, so other libraries' checks and add/remove
+        # bookkeeping never wait on a cold load. If a write raced with it, the result is
+        # returned for this query but not kept.
+        with self._lock:
+            hashes = self._hashes.get(library_id)
+            if hashes is not None:
+                return hashes
+            version = (self._epoch, self._versions.get(library_id, 0))
+        hashes = {image_id: hash_value for hash_value, image_id in self._loader(library_id)}
+        with self._lock:
+            if library_id in self._hashes:
+                return self._hashes[library_id]
+            if (self._epoch, self._versions.get(library_id, 0)) == version:
+                self._hashes[library_id] = hashes
+            return hashes
+
+    def _ensure_packed(self, library_id: int) -> PackedHashes:
+        # Callers hold the lock and the library is loaded
+        packed = self._packed.get(library_id)
+        if packed is None:
+            hashes = self._hashes[library_id]
+            packed = PackedHashes((h, image_id) for image_id, h in hashes.items())
+            self._packed[library_id] = packed
+        return packed
+
+    def _ensure_tree(self, library_id: int) -> BKTree:
+        tree = self._trees.get(library_id)
+        if tree is None:
+            hashes = self._hashes[library_id]
+            tree = BKTree((h, image_id) for image_id, h in hashes.items())
+            self._trees[library_id] = tree
+        return tree
+
+    def nearest(self, library_id: int, hash_value: int, threshold: int) -> Optional[Tuple[int, int]]:
+        hashes = self._ensure_loaded(library_id)
+        with self._lock:
+            if self._hashes.get(library_id) is not hashes:
+                # A load that lost a race with a write: answer from it once, uncached
+                return PackedHashes((h, image_id) for image_id, h in hashes.items()).nearest(hash_value, threshold)
+            if threshold <= BK_TREE_MAX_THRESHOLD and len(hashes) >= BK_TREE_MIN_SIZE:
+                return self._ensure_tree(library_id).nearest(hash_value, threshold)
+            return self._ensure_packed(library_id).nearest(hash_value, threshold)
+
+    def add(self, library_id: int, hash_value: int, image_id: int):
+        with self._lock:
+            self._changed(library_id)
+            hashes = self._hashes.get(library_id)
+            if hashes is None:
+                # Not loaded yet; the next load will read it from the DB.
+                return
+            if image_id in hashes:
+                return
+            hashes[image_id] = hash_value
+            packed = self._packed.get(library_id)
+            if packed is not None:
+                packed.append(hash_value, image_id)
+            tree = self._trees.get(library_id)
+            if tree is not None:
+                tree.add(hash_value, image_id)
+
+    def remove(self, library_id: int, hash_value: int, image_id: int):
+        with self._lock:
+            self._changed(library_id)
+            hashes = self._hashes.get(library_id)
+            if hashes is None or hashes.pop(image_id, None) is None:
+                return
+            self._packed.pop(library_id, None)
+            tree = self._trees.get(library_id)
+            if tree is not None:
+                tree.remove(hash_value, image_id)
+
+    def merge(self, src_library_id: int, dest_library_id: int):
+        with self._lock:
+            self._changed(src_library_id)
+            self._changed(dest_library_id)
+            src_hashes = self._hashes.pop(src_library_id, None)
+            self._packed.pop(src_library_id, None)
+            self._trees.pop(src_library_id, None)
+            self._packed.pop(dest_library_id, None)
+
+            dest_hashes = self._hashes.get(dest_library_id)
+            if dest_hashes is None:
+                return
+            if src_hashes is None:
+                # Unknown contents moved over; reload dest lazily.
+                self._hashes.pop(dest_library_id, None)
+                self._trees.pop(dest_library_id, None)
+                return
+            dest_hashes.update(src_hashes)
+            tree = self._trees.get(dest_library_id)
+            if tree is not None:
+                for image_id, h in src_hashes.items():
+                    tree.add(h, image_id)
+
+    def invalidate(self, library_id: Optional[int] = None):
+        with self._lock:
+            if library_id is None:
+                self._epoch += 1
+                self._versions.clear()
+                self._hashes.clear()
+                self._packed.clear()
+                self._trees.clear()
+            else:
+                self._changed(library_id)
+                self._hashes.pop(library_id, None)
+                self._packed.pop(library_id, None)
+                self._trees.pop(library_id, None)
@@ -0,0 +1,114 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Libraries per forward-message node in 查看图库
+LISTING_CHUNK_SIZE = 50
+
+
+class GroupListing:
+    """
+    One context's names, as {name: library_id}, plus the rendered 查看图库 text,
+    built on first request and dropped whenever a name changes.
+    """
+
+    __slots__ = ("names", "rendered")
+
+    def __init__(self, rows: Iterable[Tuple[int, str]]):
+        self.names: Dict[str, int] = {name: library_id for library_id, name in rows}
+        self.rendered: Optional[Tuple[int, List[str]]] = None
+
+    def render(self, chunk_size: int) -> Tuple[int, List[str]]:
+        if self.rendered is None:
+            libraries: Dict[int, List[str]] = {}
+            for name, library_id in self.names.items():
+                libraries.setdefault(library_id, []).append(name)
+
+            lines = []
+            # Primary name: shortest, then alphabetical (same rule as db.get_all_library_names)
+            for names in libraries.values():
+                names.sort(key=lambda x: (len(x), x))
+            for names in sorted(libraries.values(), key=lambda n: n[0]):
+                primary, aliases = names[0], names[1:]
+                lines.append(f"{primary} (别名: {', '.join(aliases)})" if aliases else primary)
+
+            chunks = ["\n".join(lines[i:i + chunk_size]) for i in range(0, len(lines), chunk_size)]
+            self.rendered = (len(lines), chunks)
+        return self.rendered
+
+
+class LibraryListing:
+    """
+    Per-context library listing for 查看图库, so a big group's list isn't re-read,
+    regrouped and re-sorted on every request.
+
+    `loader(context_id)` returns that context's (library_id, name) rows; a context is
+    loaded on first use and then kept in step by the db layer (create, alias, remove,
+    merge). Any change only drops that context's rendered text.
+    """
+
+    def __init__(self, loader: Callable[[str], Iterable[Tuple[int, str]]], chunk_size: int = LISTING_CHUNK_SIZE):
+        self._loader = loader
+        self.chunk_size = chunk_size
+        self._groups: Dict[str, GroupListing] = {}
+        # Bumped by every change (per context, or all at once), so a load that raced with a write isn't kept
+        self._versions: Dict[str, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def get(self, context_id: str) -> Optional[Tuple[int, List[str]]]:
+        """(library count, chunk texts) if the context is loaded, else None (no DB access)."""
+        with self._lock:
+            group = self._groups.get(context_id)
+            return group.render(self.chunk_size) if group is not None else None
+
+    def load(self, context_id: str) -> Tuple[int, List[str]]:
+        """(library count, chunk texts), loading the context from the DB if needed."""
+        cached = self.get(context_id)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            version = (self._epoch, self._versions.get(context_id, 0))
+        group = GroupListing(self._loader(context_id))
+        with self._lock:
+            if (self._epoch, self._versions.get(context_id, 0)) == version:
+                self._groups.setdefault(context_id, group)
+            return group.render(self.chunk_size)
+
+    def _changed(self, context_id: str) -> Optional[GroupListing]:
+        self._versions[context_id] = self._versions.get(context_id, 0) + 1
+        group = self._groups.get(context_id)
+        if group is not None:
+            group.rendered = None
+        return group
+
+    def add(self, name: str, library_id: int, context_id: str):
+        with self._lock:
+            group = self._changed(context_id)
+            if group is not None:
+                group.names[name] = library_id
+
+    def remove(self, name: str, context_id: str):
+        with self._lock:
+            group = self._changed(context_id)
+            if group is not None:
+                group.names.pop(name, None)
+
+    def merge(self, src_library_id: int, dest_library_id: int, context_id: str):
+        with self._lock:
+            group = self._changed(context_id)
+            if group is not None:
+                for name, library_id in group.names.items():
+                    if library_id == src_library_id:
+                        group.names[name] = dest_library_id
+
+    def invalidate(self, context_id: Optional[str] = None):
+        """Forget one context (or all of them) so it is reloaded on next use."""
+        with self._lock:
+            if context_id is None:
+                self._epoch += 1
+                self._versions.clear()
+                self._groups.clear()
+            else:
+                self._changed(context_id)
+                self._groups.pop(context_id, None)
@@ -0,0 +1,415 @@
+import asyncio
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from nonebot.log import logger
+
+from . import db
+from .usage import USAGE_RETENTION_DAYS, today
+
+# Off-peak maintenance (env overrides, like MEME_DB_PATH).
+# Local hour of the daily run; -1 disables the schedule (/维护图库 still works).
+MAINTENANCE_HOUR = int(os.getenv("MEME_MAINTENANCE_HOUR", "4"))
+# Time budget of each step; a step that runs out stops and continues on the next run
+MAINTENANCE_STEP_SECONDS = float(os.getenv("MEME_MAINTENANCE_STEP_SECONDS", "30"))
+
+# Work per write transaction, small enough that an add waiting on the writer
+# lock is held up by milliseconds, never by a whole step
+CLEANUP_CHUNK_ROWS = 200
+BLOB_CHUNK = 500
+VACUUM_CHUNK_PAGES = 256
+ANALYZE_TABLE_SECONDS = 1.0
+# Pause between chunks so queued writers get the lock
+CHUNK_PAUSE_SECONDS = 0.01
+# Temp files older than this are left over from a crash mid-write
+STALE_TMP_SECONDS = 3600
+
+_run_lock = threading.Lock()
+_schedule_task: Optional[asyncio.Task] = None
+# Blob sweep position (top-level blob directory), so a huge store is covered over several runs
+_blob_cursor = ""
+
+last_report: Optional[Dict[str, Any]] = None
+
+
+def _db_file_bytes() -> int:
+    total = 0
+    for suffix in ("", "-wal"):
+        try:
+            total += os.path.getsize(f"{db.DB_PATH}{suffix}")
+        except OSError:
+            pass
+    return total
+
+
+def _select_ids(query: str, limit: int) -> List[int]:
+    with db.connections.read() as conn:
+        return [r[0] for r in conn.execute(f"{query} LIMIT ?", (limit,)).fetchall()]
+
+
+def _cleanup_rows(deadline: float) -> Dict[str, Any]:
+    """
+    Orphans and dangling rows left by deletes and merges:
+    names of missing libraries, libraries without any name (unreachable),
+    memes of missing libraries and segments of missing memes.
+    Also drops usage stats older than USAGE_RETENTION_DAYS and image source lookups
+    whose blob is gone (registered while it was being released).
+    """
+    result = {"names": 0, "libraries": 0, "memes": 0, "usage_rows": 0, "sources": 0, "blob_bytes": 0, "done": False}
+    names_removed = False
+
+    while time.monotonic() < deadline:
+        with db.connections.write() as conn:
+            cursor = conn.execute(
+                "DELETE FROM names WHERE rowid IN (SELECT rowid FROM names "
+                "WHERE library_id NOT IN (SELECT id FROM libraries) LIMIT ?)",
+                (CLEANUP_CHUNK_ROWS,)
+            )
+            removed = cursor.rowcount
+        result["names"] += removed
+        names_removed = names_removed or removed > 0
+        if removed < CLEANUP_CHUNK_ROWS:
+            break
+        time.sleep(CHUNK_PAUSE_SECONDS)
+    if names_removed:
+        db.name_index.load()
+        db.library_listing.invalidate()
+        db.fuzzy_index.invalidate()
+
+    while time.monotonic() < deadline:
+        ids = _select_ids("SELECT id FROM libraries WHERE id NOT IN (SELECT library_id FROM names)", CLEANUP_CHUNK_ROWS)
+        if not ids:
+            break
+        placeholders = ",".join("?" * len(ids))
+        with db.connections.write() as conn:
+            # Re-check under the lock: a name may have been added since the read
+            cursor = conn.execute(
+                f"DELETE FROM libraries WHERE id IN ({placeholders}) "
+                "AND id NOT IN (SELECT library_id FROM names)",
+                ids
+            )
+            result["libraries"] += cursor.rowcount
+        time.sleep(CHUNK_PAUSE_SECONDS)
+
+    dangling_queries = (
+        "SELECT id FROM images WHERE library_id NOT IN (SELECT id FROM libraries)",
+        "SELECT DISTINCT image_id FROM meme_segments WHERE image_id NOT IN (SELECT id FROM images)",
+    )
+    for query in dangling_queries:
+        while time.monotonic() < deadline:
+            ids = _select_ids(query, CLEANUP_CHUNK_ROWS)
+            if not ids:
+                break
+            rows, freed = db.delete_images(ids)
+            result["memes"] += rows
+            result["blob_bytes"] += freed
+            time.sleep(CHUNK_PAUSE_SECONDS)
+        else:
+            return result
+
+    cutoff = today() - USAGE_RETENTION_DAYS
+    while time.monotonic() < deadline:
+        with db.connections.write() as conn:
+            cursor = conn.execute(
+                "DELETE FROM meme_usage WHERE (context_id, day, library_id, image_id) IN "
+                "(SELECT context_id, day, library_id, image_id FROM meme_usage WHERE day < ? LIMIT ?)",
+                (cutoff, CLEANUP_CHUNK_ROWS)
+            )
+            removed = cursor.rowcount
+        result["usage_rows"] += removed
+        if removed < CLEANUP_CHUNK_ROWS:
+            break
+        time.sleep(CHUNK_PAUSE_SECONDS)
+
+    while time.monotonic() < deadline:
+        with db.connections.write() as conn:
+            cursor = conn.execute(
+                "DELETE FROM image_sources WHERE source IN (SELECT source FROM image_sources "
+                "WHERE digest NOT IN (SELECT digest FROM blobs) LIMIT ?)",
+                (CLEANUP_CHUNK_ROWS,)
+            )
+            removed = cursor.rowcount
+        result["sources"] += removed
+        if removed < CLEANUP_CHUNK_ROWS:
+            break
+        time.sleep(CHUNK_PAUSE_SECONDS)
+
+    result["done"] = time.monotonic() < deadline
+    return result
+
+
+def _sweep_blobs(deadline: float) -> Dict[str, Any]:
+    """
+    Delete blob files no row references and temp files left by interrupted writes.
+    Walks the store one top-level directory at a time and resumes where the last run stopped.
+    """
+    global _blob_cursor
+    result = {"blobs": 0, "blob_bytes": 0, "tmp_files": 0, "done": False}
+    root = db.blob_store.root
+    if not root.exists():
+        result["done"] = True
+        return result
+
+    # An empty table next to a full blob store means a wrong MEME_DB_PATH, not garbage
+    with db.connections.read() as conn:
+        if conn.execute("SELECT 1 FROM images LIMIT 1").fetchone() is None:
+            result["done"] = True
+            return result
+
+    def remove_if_stale(tmp: Path):
+        try:
+            if time.time() - tmp.stat().st_mtime > STALE_TMP_SECONDS:
+                tmp.unlink()
+                result["tmp_files"] += 1
+        except OSError:
+            pass
+
+    for tmp in root.glob(".tmp-*"):
+        remove_if_stale(tmp)
+
+    prefixes = sorted(p.name for p in root.iterdir() if p.is_dir() and p.name > _blob_cursor)
+    checked = 0
+    for prefix in prefixes:
+        if time.monotonic() >= deadline:
+            return result
+        digests = []
+        for path in (root / prefix).glob("*/*"):
+            if path.name.startswith(".tmp-"):
+                remove_if_stale(path)
+            elif path.is_file() and db.blob_store.is_digest(path.name):
+                digests.append(path.name)
+        for start in range(0, len(digests), BLOB_CHUNK):
+            # Check and delete under the writer lock: blobs are written under it too,
+            # so a blob can't gain its first reference between the check and the delete
+            chunk = digests[start:start + BLOB_CHUNK]
+            with db.connections.write() as conn:
+                cursor = conn.cursor()
+                for digest in chunk:
+                    if not db.is_blob_referenced(cursor, digest):
+                        result["blob_bytes"] += db.blob_store.delete(digest)
+                        result["blobs"] += 1
+                        cursor.execute("DELETE FROM blobs WHERE digest = ? AND refcount <= 0", (digest,))
+            checked += len(chunk)
+            if checked >= BLOB_CHUNK:
+                time.sleep(CHUNK_PAUSE_SECONDS)
+                checked = 0
+        _blob_cursor = prefix
+
+    _blob_cursor = ""
+    result["done"] = True
+    return result
+
+
+def _deadline_handler(deadline: float) -> Callable[[], int]:
+    # Non-zero return makes SQLite abort the running statement ("interrupted")
+    return lambda: 1 if time.monotonic() >= deadline else 0
+
+
+def _analyze(deadline: float) -> Dict[str, Any]:
+    """
+    Refresh planner statistics, sampling at most a few hundred rows per index.
+    One table per write transaction, each capped at ANALYZE_TABLE_SECONDS, so a
+    waiting add gets the lock between tables instead of after the whole step.
+    """
+    result = {"tables": 0, "interrupted": 0, "done": False}
+    with db.connections.read() as conn:
+        tables = [r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+            "AND sql NOT LIKE 'CREATE VIRTUAL TABLE%' ORDER BY name"
+        )]
+
+    for table in tables:
+        if time.monotonic() >= deadline:
+            return result
+        with db.connections.write() as conn:
+            conn.set_progress_handler(_deadline_handler(min(deadline, time.monotonic() + ANALYZE_TABLE_SECONDS)), 10000)
+            try:
+                conn.execute("PRAGMA analysis_limit = 400")
+                conn.execute(f'ANALYZE "{table}"')
+                result["tables"] += 1
+            except sqlite3.OperationalError as e:
+                if "interrupt" not in str(e):
+                    raise
+                result["interrupted"] += 1
+            finally:
+                conn.set_progress_handler(None, 0)
+        time.sleep(CHUNK_PAUSE_SECONDS)
+
+    result["done"] = result["interrupted"] == 0
+    return result
+
+
+def _incremental_vacuum(deadline: float) -> Dict[str, Any]:
+    """Return free pages to the filesystem, VACUUM_CHUNK_PAGES per write transaction."""
+    result = {"pages": 0, "done": False}
+    with db.connections.read() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            result["skipped"] = "auto_vacuum is not INCREMENTAL"
+            return result
+
+    while time.monotonic() < deadline:
+        with db.connections.write() as conn:
+            before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if before == 0:
+                break
+            conn.execute(f"PRAGMA incremental_vacuum({VACUUM_CHUNK_PAGES})").fetchall()
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        result["pages"] += before - after
+        time.sleep(CHUNK_PAUSE_SECONDS)
+    else:
+        return result
+
+    # Freed pages sit in the WAL until a checkpoint copies them back and truncates it
+    with db.connections.write() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    result["done"] = True
+    return result
+
+
+def _integrity_check(deadline: float) -> Dict[str, Any]:
+    """PRAGMA quick_check on a reader (doesn't block writers), plus memes whose blob file is missing."""
+    result = {"ok": None, "errors": [], "missing_blobs": 0, "done": False}
+    with db.connections.read() as conn:
+        conn.set_progress_handler(_deadline_handler(deadline), 10000)
+        try:
+            rows = [r[0] for r in conn.execute("PRAGMA quick_check(20)").fetchall()]
+            result["ok"] = rows == ["ok"]
+            if not result["ok"]:
+                result["errors"] = rows
+        except sqlite3.OperationalError as e:
+            if "interrupt" not in str(e):
+                raise
+            return result
+        finally:
+            conn.set_progress_handler(None, 0)
+
+        last_id = 0
+        while time.monotonic() < deadline:
+            rows = conn.execute(
+                "SELECT id, digest FROM images WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, BLOB_CHUNK)
+            ).fetchall()
+            if not rows:
+                result["done"] = True
+                break
+            for _, digest in rows:
+                if digest and not db.blob_store.exists(digest):
+                    result["missing_blobs"] += 1
+            last_id = rows[-1][0]
+
+    if result["errors"] or result["missing_blobs"]:
+        logger.warning(f"[CustomMemes] memes.db integrity check: {result}")
+    return result
+
+
+STEPS = (
+    ("cleanup", _cleanup_rows),
+    ("blobs", _sweep_blobs),
+    ("analyze", _analyze),
+    ("vacuum", _incremental_vacuum),
+    ("integrity", _integrity_check),
+)
+
+
+def run_maintenance(step_seconds: float = MAINTENANCE_STEP_SECONDS) -> Optional[Dict[str, Any]]:
+    """
+    Run every maintenance step, each within `step_seconds`.
+    Returns the report (also kept in `last_report`), or None if a run is already in progress.
+    """
+    global last_report
+    if not _run_lock.acquire(blocking=False):
+        return None
+    try:
+        started = time.time()
+        db_before = _db_file_bytes()
+        steps = {}
+        for name, step in STEPS:
+            step_start = time.monotonic()
+            try:
+                steps[name] = step(step_start + step_seconds)
+            except Exception as e:
+                logger.exception(f"[CustomMemes] Maintenance step {name} failed")
+                steps[name] = {"done": False, "error": str(e)}
+            steps[name]["seconds"] = round(time.monotonic() - step_start, 2)
+
+        db_after = _db_file_bytes()
+        blob_bytes = steps["cleanup"].get("blob_bytes", 0) + steps["blobs"].get("blob_bytes", 0)
+        report = {
+            "started_at": started,
+            "seconds": round(time.time() - started, 2),
+            "db_bytes_before": db_before,
+            "db_bytes_after": db_after,
+            "blob_bytes_freed": blob_bytes,
+            "bytes_reclaimed": max(0, db_before - db_after) + blob_bytes,
+            "steps": steps,
+        }
+        last_report = report
+        logger.info(f"[CustomMemes] Maintenance finished: {report}")
+        return report
+    finally:
+        _run_lock.release()
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    steps = report["steps"]
+    cleanup, blobs = steps["cleanup"], steps["blobs"]
+    integrity, vacuum = steps["integrity"], steps["vacuum"]
+    started = datetime.datetime.fromtimestamp(report["started_at"]).strftime("%Y-%m-%d %H:%M")
+
+    lines = [
+        f"图库维护 {started}，用时 {report['seconds']:.1f}s",
+        f"回收空间：{report['bytes_reclaimed'] / 1024 / 1024:.2f} MB "
+        f"(数据库 {report['db_bytes_before'] / 1024 / 1024:.2f} → {report['db_bytes_after'] / 1024 / 1024:.2f} MB)",
+        f"清理：{cleanup.get('libraries', 0)} 个无名图库，{cleanup.get('names', 0)} 个失效名字，"
+        f"{cleanup.get('memes', 0)} 个悬空表情，{blobs.get('blobs', 0)} 个无用图片文件",
+        f"整理空闲页：{vacuum.get('pages', 0)} 页",
+    ]
+    if integrity.get("ok") is False:
+        lines.append(f"⚠️ 完整性检查失败：{'; '.join(integrity['errors'][:3])}")
+    elif integrity.get("ok"):
+        lines.append("完整性检查：正常")
+    if integrity.get("missing_blobs"):
+        lines.append(f"⚠️ {integrity['missing_blobs']} 个表情的图片文件丢失")
+
+    unfinished = [name for name, result in steps.items() if not result.get("done", True)]
+    if unfinished:
+        lines.append(f"未在时限内完成（下次继续）：{', '.join(unfinished)}")
+    return "\n".join(lines)
+
+
+def _seconds_until(hour: int) -> float:
+    now = datetime.datetime.now()
+    run_at = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if run_at <= now:
+        run_at += datetime.timedelta(days=1)
+    return (run_at - now).total_seconds()
+
+
+async def _schedule_loop(hour: int):
+    while True:
+        await asyncio.sleep(_seconds_until(hour))
+        try:
+            await asyncio.to_thread(run_maintenance)
+        except Exception:
+            logger.exception("[CustomMemes] Scheduled maintenance failed")
+
+
+def start_schedule(hour: int = MAINTENANCE_HOUR):
+    """Run maintenance every day at `hour` (local time) in the background; hour < 0 disables it."""
+    global _schedule_task
+    if hour < 0 or (_schedule_task is not None and not _schedule_task.done()):
+        return
+    _schedule_task = asyncio.create_task(_schedule_loop(hour % 24))
+    logger.info(f"[CustomMemes] Maintenance scheduled daily at {hour % 24:02d}:00")
+
+
+def stop_schedule():
+    global _schedule_task
+    if _schedule_task is not None:
+        _schedule_task.cancel()
+        _schedule_task = None
@@ -0,0 +1,69 @@
+"""
+Export / import meme libraries as tar or zip archives, outside the bot.
+
+Same format as the /导出图库 and /导入图库 commands (see archive.py). Uses the
+memes.db / blob store from MEME_DB_PATH / MEME_BLOB_DIR, like the bot.
+
+Usage:
+    python meme_archive.py export 123456789 [-o memes.tar] [--zip]
+    python meme_archive.py import memes.tar [--group 987654321] [--batch-size 200]
+
+In Docker: docker-compose exec <bot service> python src/plugins/custom_memes/meme_archive.py ...
+Restart the bot after an import so its in-memory indexes pick up the new memes.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import nonebot
+
+# The plugin package needs a NoneBot driver to import; a bare one is enough here
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "..")))
+nonebot.init(driver="~none")
+
+from src.plugins.custom_memes import archive, db  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = sub.add_parser("export", help="export one group's libraries")
+    export_parser.add_argument("group", help="group id, or p<user id> for a private chat")
+    export_parser.add_argument("-o", "--output", type=Path, help="archive path (default: MEME_EXPORT_DIR)")
+    export_parser.add_argument("--zip", action="store_true", help="write a zip instead of a tar")
+
+    import_parser = sub.add_parser("import", help="import an archive")
+    import_parser.add_argument("archive", type=Path)
+    import_parser.add_argument("--group", help="target group id (default: the group it was exported from)")
+    import_parser.add_argument("--batch-size", type=int, default=archive.IMPORT_BATCH_SIZE)
+    import_parser.add_argument("--threshold", type=int, default=18, help="dHash distance counted as duplicate")
+
+    args = parser.parse_args()
+    db.init_db()
+
+    def parse_context(raw: str) -> str:
+        return f"private_{raw[1:]}" if raw.lower().startswith("p") else raw
+
+    try:
+        if args.command == "export":
+            fmt = "zip" if args.zip else "tar"
+            group_id = parse_context(args.group)
+            path = args.output or archive.new_export_path(group_id, fmt)
+            stats = archive.export_group(group_id, path, fmt)
+            print(f"Exported to {path}: {stats}")
+        else:
+            group_id = parse_context(args.group) if args.group else None
+            stats = archive.import_archive(args.archive, group_id, batch_size=args.batch_size,
+                                           threshold=args.threshold)
+            print(f"Imported {args.archive}: {stats}")
+            print("Restart the bot to load the imported memes.")
+    except archive.ArchiveError as e:
+        sys.exit(f"Error: {e}")
+    finally:
+        db.connections.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import sqlite3
+import time
+from typing import Callable, Iterator, List, NamedTuple
+
+from nonebot.log import logger
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _set_schema_version(conn: sqlite3.Connection, version: int):
+    # PRAGMA doesn't take bound parameters; version is always an int from the registry
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def _ensure_progress_table(conn: sqlite3.Connection):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS migration_progress (
+        task TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    )
+    """)
+
+
+def run_migrations(conn: sqlite3.Connection, migrations: List[Migration]) -> int:
+    """
+    Apply every migration newer than the DB's PRAGMA user_version, in order.
+    Each one commits and bumps user_version when it finishes, so it runs exactly once;
+    an up-to-date DB costs a single PRAGMA read. Returns the number of migrations applied.
+    """
+    current = get_schema_version(conn)
+    pending = [m for m in sorted(migrations, key=lambda m: m.version) if m.version > current]
+    if not pending:
+        return 0
+
+    logger.info(f"[CustomMemes] memes.db schema v{current}, applying {len(pending)} migration(s)")
+    _ensure_progress_table(conn)
+    conn.commit()
+
+    for migration in pending:
+        start = time.perf_counter()
+        logger.info(f"[CustomMemes] Migration v{migration.version}: {migration.name}...")
+        migration.apply(conn)
+        # Checkpoints only matter while a migration is unfinished
+        conn.execute("DELETE FROM migration_progress")
+        _set_schema_version(conn, migration.version)
+        conn.commit()
+        elapsed = time.perf_counter() - start
+        logger.info(f"[CustomMemes] Migration v{migration.version} done in {elapsed:.1f}s")
+    return len(pending)
+
+
+def iter_batches(conn: sqlite3.Connection, task: str, query: str, params: tuple = (),
+                 batch_size: int = 200) -> Iterator[List[tuple]]:
+    """
+    Resumable scan for long data migrations.
+
+    `query` selects rows whose first column is `id` and must end with a WHERE clause;
+    " AND id > ? ORDER BY id LIMIT ?" is appended. Each yielded batch is followed by a
+    checkpoint and a commit, so work the caller did on the batch is saved together with
+    the checkpoint. After a crash or restart the scan picks up after the last committed batch.
+    """
+    row = conn.execute("SELECT last_id FROM migration_progress WHERE task = ?", (task,)).fetchone()
+    last_id = row[0] if row else 0
+
+    total = conn.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+    done = conn.execute(f"SELECT COUNT(*) FROM ({query} AND id <= ?)", params + (last_id,)).fetchone()[0]
+    if done:
+        logger.info(f"[CustomMemes] {task}: resuming at {done}/{total}")
+
+    next_report = time.perf_counter() + 5
+    while True:
+        rows = conn.execute(f"{query} AND id > ? ORDER BY id LIMIT ?", params + (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+
+        yield rows
+
+        last_id = rows[-1][0]
+        done += len(rows)
+        conn.execute(
+            "INSERT OR REPLACE INTO migration_progress (task, last_id) VALUES (?, ?)",
+            (task, last_id)
+        )
+        conn.commit()
+
+        if time.perf_counter() >= next_report:
+            logger.info(f"[CustomMemes] {task}: {done}/{total}")
+            next_report = time.perf_counter() + 5
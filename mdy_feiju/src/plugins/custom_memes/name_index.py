@@ -0,0 +1,170 @@
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class NameTrie:
+    """
+    Character trie over library names in one context.
+    Node layout: [children: {char: node}, library_id or None]
+    """
+
+    __slots__ = ("root", "size")
+
+    def __init__(self, entries: Iterable[Tuple[str, int]] = ()):
+        self.root = [{}, None]
+        self.size = 0
+        for name, library_id in entries:
+            self.insert(name, library_id)
+
+    def insert(self, name: str, library_id: int):
+        node = self.root
+        for ch in name:
+            child = node[0].get(ch)
+            if child is None:
+                child = [{}, None]
+                node[0][ch] = child
+            node = child
+        if node[1] is None:
+            self.size += 1
+        node[1] = library_id
+
+    def remove(self, name: str) -> bool:
+        path = [self.root]
+        node = self.root
+        for ch in name:
+            node = node[0].get(ch)
+            if node is None:
+                return False
+            path.append(node)
+        if node[1] is None:
+            return False
+        node[1] = None
+        self.size -= 1
+
+        # Prune nodes that no longer lead anywhere
+        for i in range(len(name) - 1, -1, -1):
+            child = path[i + 1]
+            if child[0] or child[1] is not None:
+                break
+            del path[i][0][name[i]]
+        return True
+
+    def relink(self, old_library_id: int, new_library_id: int):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node[1] == old_library_id:
+                node[1] = new_library_id
+            stack.extend(node[0].values())
+
+    def prefix_matches(self, text: str) -> List[Tuple[int, int]]:
+        """
+        All names that are a prefix of `text`, in one pass over it.
+        Returns [(prefix_length, library_id)], longest first.
+        """
+        matches = []
+        node = self.root
+        for i, ch in enumerate(text):
+            node = node[0].get(ch)
+            if node is None:
+                break
+            if node[1] is not None:
+                matches.append((i + 1, node[1]))
+        matches.reverse()
+        return matches
+
+
+class NameIndex:
+    """
+    Per-context name tries, so "来只xxx" resolves its longest library name
+    without a DB round trip per candidate prefix.
+
+    `loader()` returns every (name, library_id, context_id) row. The whole
+    index is loaded once and then updated incrementally by the db layer.
+    The DB scan runs without the lock; the built tries are swapped in under it.
+    """
+
+    def __init__(self, loader: Callable[[], Iterable[Tuple[str, int, str]]]):
+        self._loader = loader
+        self._tries: Optional[Dict[str, NameTrie]] = None
+        # Bumped by every change, so a build that raced with a write isn't installed
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def _build(self) -> Dict[str, NameTrie]:
+        tries: Dict[str, NameTrie] = {}
+        for name, library_id, context_id in self._loader():
+            trie = tries.get(context_id)
+            if trie is None:
+                trie = tries[context_id] = NameTrie()
+            trie.insert(name, library_id)
+        return tries
+
+    def load(self):
+        """(Re)build the whole index from the DB, e.g. at startup (call off the event loop)."""
+        while True:
+            with self._lock:
+                version = self._version
+            tries = self._build()
+            with self._lock:
+                if self._version == version:
+                    self._tries = tries
+                    return
+
+    def invalidate(self):
+        """Forget everything so the index is rebuilt on next use."""
+        with self._lock:
+            self._version += 1
+            self._tries = None
+
+    def _matches(self, text: str, context_id: str) -> List[Tuple[str, int]]:
+        trie = self._tries.get(context_id)
+        if trie is None:
+            return []
+        return [(text[:length], library_id) for length, library_id in trie.prefix_matches(text)]
+
+    def longest_matches(self, text: str, context_id: str) -> List[Tuple[str, int]]:
+        """
+        Library names that prefix `text`, longest first, as (name, library_id).
+        Builds the index from the DB first if needed (call off the event loop).
+        """
+        while True:
+            loaded, matches = self.try_longest_matches(text, context_id)
+            if loaded:
+                return matches
+            self.load()
+
+    def try_longest_matches(self, text: str, context_id: str) -> Tuple[bool, List[Tuple[str, int]]]:
+        """Memory only: (True, matches) if the index is loaded, else (False, [])."""
+        with self._lock:
+            if self._tries is None:
+                return False, []
+            return True, self._matches(text, context_id)
+
+    def add(self, name: str, library_id: int, context_id: str):
+        with self._lock:
+            self._version += 1
+            if self._tries is None:
+                return
+            trie = self._tries.get(context_id)
+            if trie is None:
+                trie = self._tries[context_id] = NameTrie()
+            trie.insert(name, library_id)
+
+    def remove(self, name: str, context_id: str):
+        with self._lock:
+            self._version += 1
+            if self._tries is None:
+                return
+            trie = self._tries.get(context_id)
+            if trie is not None:
+                trie.remove(name)
+
+    def merge(self, src_library_id: int, dest_library_id: int, context_id: str):
+        with self._lock:
+            self._version += 1
+            if self._tries is None:
+                return
+            trie = self._tries.get(context_id)
+            if trie is not None:
+                trie.relink(src_library_id, dest_library_id)
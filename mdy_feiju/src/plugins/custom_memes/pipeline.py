@@ -0,0 +1,163 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import imagehash
+from PIL import Image
+from nonebot.log import logger
+
+from .encoder import ENCODE_TARGET_BYTES, encode_to_budget
+from .utils import resize_image
+
+# Pipeline tuning (env overrides, like MEME_DB_PATH)
+PIPELINE_WORKERS = int(os.getenv("MEME_PIPELINE_WORKERS", str(min(4, os.cpu_count() or 1))))
+PIPELINE_MAX_QUEUE = int(os.getenv("MEME_PIPELINE_MAX_QUEUE", "32"))
+PIPELINE_JOB_TIMEOUT = float(os.getenv("MEME_PIPELINE_JOB_TIMEOUT", "60"))
+
+
+class PipelineBusyError(Exception):
+    """Raised when too many image jobs are already queued."""
+
+
+# --- Worker functions (run in the pool, must stay module-level so they pickle) ---
+
+def _dhash(data: bytes) -> str:
+    return str(imagehash.dhash(Image.open(BytesIO(data))))
+
+def _prepare_bytes(data: bytes) -> bytes:
+    """Storage form of an incoming image: resized, then re-encoded to the byte budget if one is set."""
+    return encode_to_budget(resize_image(data))
+
+def _prepare(data: bytes) -> Tuple[bytes, str]:
+    """Prepare for storage, then hash the stored version."""
+    final_data = _prepare_bytes(data)
+    return final_data, _dhash(final_data)
+
+def _reencode(data: bytes, target_bytes: int) -> Tuple[bytes, str]:
+    new_data = encode_to_budget(data, target_bytes)
+    return new_data, _dhash(new_data)
+
+def _warm() -> int:
+    return os.getpid()
+
+
+class ImagePipeline:
+    """
+    Runs decode / resize / re-encode / dHash off the event loop in a bounded
+    process pool, so one huge GIF can't freeze the bot.
+
+    - At most `max_queue` jobs may be queued or running; more raise PipelineBusyError.
+    - Each job gets `job_timeout` seconds; on timeout the pool is torn down and
+      recreated, so a stuck worker doesn't keep its slot.
+    - Uses fork-based worker processes where available (the plugin package can't be
+      re-imported in a fresh interpreter without a NoneBot driver, which rules out
+      spawn/forkserver), threads elsewhere. start() forks the workers at startup, before
+      the bot runs other threads; only a restart after a stuck job forks later.
+    """
+
+    def __init__(self, max_workers: int = PIPELINE_WORKERS, max_queue: int = PIPELINE_MAX_QUEUE,
+                 job_timeout: float = PIPELINE_JOB_TIMEOUT):
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(1, max_queue)
+        self.job_timeout = job_timeout
+        self._executor: Optional[Executor] = None
+        self._workers: List[multiprocessing.Process] = []
+        self._pending = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def start(self):
+        """
+        Create the pool and fork its workers now. Call at startup before any other thread
+        runs (DB reader/writer pool, ...): fork copies only the calling thread, so a lock
+        another thread holds at that moment would stay locked in the child forever.
+        """
+        if self._executor is not None:
+            return
+        if "fork" not in multiprocessing.get_all_start_methods():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="meme-img")
+            return
+        before = set(multiprocessing.active_children())
+        executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+        )
+        # With fork, the first job starts every worker at once
+        executor.submit(_warm).result()
+        # Our own handles on the workers, to kill a stuck one
+        self._workers = [p for p in multiprocessing.active_children() if p not in before]
+        self._executor = executor
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self.start()
+        return self._executor
+
+    def _reset_executor(self, executor: Executor):
+        # Only the pool that ran the failed job: it may have been replaced already,
+        # and a late failure from the old pool must not take down the new one
+        if executor is None or self._executor is not executor:
+            return
+        workers = self._workers
+        self._executor = None
+        self._workers = []
+        # Kill stuck workers; shutdown() alone would wait for them to finish
+        for process in workers:
+            try:
+                process.terminate()
+            except Exception:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn, *args):
+        if self._pending >= self.max_queue:
+            raise PipelineBusyError("图片处理队列已满，稍后再试")
+
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self._get_executor()
+            future = loop.run_in_executor(executor, fn, *args)
+            try:
+                return await asyncio.wait_for(future, timeout=self.job_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"[CustomMemes] Image job {fn.__name__} timed out after {self.job_timeout}s, restarting pool")
+                self._reset_executor(executor)
+                raise TimeoutError("图片处理超时")
+            except BrokenProcessPool:
+                logger.warning("[CustomMemes] Image worker pool broke, restarting pool")
+                self._reset_executor(executor)
+                raise
+        finally:
+            self._pending -= 1
+
+    async def prepare_image(self, data: bytes) -> Tuple[bytes, str]:
+        """Resize/re-encode for storage and dHash the result. Returns (final_bytes, dhash_hex)."""
+        return await self._run(_prepare, data)
+
+    async def prepare_bytes(self, data: bytes) -> bytes:
+        """Resize/re-encode for storage without hashing (images inside mixed memes)."""
+        return await self._run(_prepare_bytes, data)
+
+    async def reencode(self, data: bytes, target_bytes: int = ENCODE_TARGET_BYTES) -> Tuple[bytes, str]:
+        """Re-encode a stored image to target_bytes. Returns (bytes, dhash_hex); bytes may be unchanged."""
+        return await self._run(_reencode, data, target_bytes)
+
+    async def dhash(self, data: bytes) -> str:
+        return await self._run(_dhash, data)
+
+    def shutdown(self):
+        executor = self._executor
+        self._executor = None
+        self._workers = []
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+pipeline = ImagePipeline()
@@ -0,0 +1,123 @@
+import random
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class RandomIndex:
+    """
+    In-memory per-library arrays of image ids, so picking a random meme is
+    a random.choice plus one primary-key lookup instead of ORDER BY RANDOM().
+
+    Libraries are loaded lazily on first use through `loader(library_id)`.
+    Removal is O(1): the removed slot is filled with the last id (swap-remove).
+    All mutators are idempotent, so replaying an update that a fresh load
+    already picked up is harmless.
+    """
+
+    def __init__(self, loader: Callable[[int], List[int]]):
+        self._loader = loader
+        self._ids: Dict[int, List[int]] = {}
+        self._pos: Dict[int, Dict[int, int]] = {}
+        # Bumped by every change (per library, or all at once), so a load that raced with a write isn't kept
+        self._versions: Dict[int, int] = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def _changed(self, library_id: int):
+        self._versions[library_id] = self._versions.get(library_id, 0) + 1
+
+    def _ensure_loaded(self, library_id: int) -> List[int]:
+        # The DB read happens without the lock, so picks from loaded libraries never wait on it
+        with self._lock:
+            ids = self._ids.get(library_id)
+            if ids is not None:
+                return ids
+            version = (self._epoch, self._versions.get(library_id, 0))
+        ids = list(self._loader(library_id))
+        with self._lock:
+            if library_id in self._ids:
+                return self._ids[library_id]
+            if (self._epoch, self._versions.get(library_id, 0)) == version:
+                self._ids[library_id] = ids
+                self._pos[library_id] = {image_id: i for i, image_id in enumerate(ids)}
+            return ids
+
+    def pick(self, library_id: int) -> Optional[int]:
+        """Random image id; loads the library from the DB first if needed (call off the event loop)."""
+        ids = self._ensure_loaded(library_id)
+        with self._lock:
+            ids = self._ids.get(library_id, ids)
+            return random.choice(ids) if ids else None
+
+    def try_pick(self, library_id: int) -> Tuple[bool, Optional[int]]:
+        """Memory only: (True, random id or None) if the library is loaded, else (False, None)."""
+        with self._lock:
+            ids = self._ids.get(library_id)
+            if ids is None:
+                return False, None
+            return True, (random.choice(ids) if ids else None)
+
+    def size(self, library_id: int) -> int:
+        ids = self._ensure_loaded(library_id)
+        with self._lock:
+            return len(self._ids.get(library_id, ids))
+
+    def add(self, library_id: int, image_id: int):
+        with self._lock:
+            self._changed(library_id)
+            ids = self._ids.get(library_id)
+            if ids is None:
+                # Not loaded yet; the next load will read it from the DB.
+                return
+            pos = self._pos[library_id]
+            if image_id not in pos:
+                pos[image_id] = len(ids)
+                ids.append(image_id)
+
+    def remove(self, library_id: int, image_id: int):
+        with self._lock:
+            self._changed(library_id)
+            ids = self._ids.get(library_id)
+            if ids is None:
+                return
+            pos = self._pos[library_id]
+            i = pos.pop(image_id, None)
+            if i is None:
+                return
+            last = ids.pop()
+            if last != image_id:
+                ids[i] = last
+                pos[last] = i
+
+    def merge(self, src_library_id: int, dest_library_id: int):
+        with self._lock:
+            self._changed(src_library_id)
+            self._changed(dest_library_id)
+            src_ids = self._ids.pop(src_library_id, None)
+            self._pos.pop(src_library_id, None)
+            if dest_library_id not in self._ids:
+                return
+            if src_ids is None:
+                # We don't know what moved over; reload dest lazily.
+                self._ids.pop(dest_library_id, None)
+                self._pos.pop(dest_library_id, None)
+                return
+            ids = self._ids[dest_library_id]
+            pos = self._pos[dest_library_id]
+            for image_id in src_ids:
+                if image_id not in pos:
+                    pos[image_id] = len(ids)
+                    ids.append(image_id)
+
+    def invalidate(self, library_id: Optional[int] = None):
+        """Forget one library (or everything) so it is reloaded on next use."""
+        with self._lock:
+            if library_id is None:
+                self._epoch += 1
+                self._versions.clear()
+                self._ids.clear()
+                self._pos.clear()
+            else:
+                self._changed(library_id)
+                self._ids.pop(library_id, None)
+                self._pos.pop(library_id, None)
@@ -0,0 +1,165 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar, Union
+
+from . import db
+
+# Reader threads (env override, like MEME_DB_PATH); each keeps its own SQLite read connection
+DB_READERS = int(os.getenv("MEME_DB_READERS", "4"))
+
+T = TypeVar("T")
+
+
+class MemeRepository:
+    """
+    Async facade over db.py for coroutines.
+
+    Every call runs in a worker thread, so a slow query, a blob read or a wait on the
+    writer lock never blocks the event loop:
+    - writes go through one writer thread, a FIFO queue in front of the single writer
+      connection, so they apply in the order they were awaited;
+    - reads run on a small pool, each thread with its own WAL read connection, in parallel
+      with each other and with the writer.
+
+    The in-memory indexes (name trie, random pick, send cache) stay synchronous on db;
+    they never touch the disk once loaded. The name trie and a library's random-pick ids
+    are loaded through match_library_names / pick_random_image here the first time
+    (and after an invalidation).
+    """
+
+    def __init__(self, readers: int = DB_READERS):
+        self.readers = max(1, readers)
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._writer: Optional[ThreadPoolExecutor] = None
+
+    def _executors(self) -> Tuple[ThreadPoolExecutor, ThreadPoolExecutor]:
+        if self._reader_pool is None:
+            self._reader_pool = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="meme-db-read")
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="meme-db-write")
+        return self._reader_pool, self._writer
+
+    async def read(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Run a read-only db function on the reader pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executors()[0], functools.partial(fn, *args, **kwargs))
+
+    async def write(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Queue a db function that writes on the single writer thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executors()[1], functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        """Finish queued writes, then stop the threads."""
+        writer, readers = self._writer, self._reader_pool
+        self._writer = self._reader_pool = None
+        if writer is not None:
+            writer.shutdown(wait=True)
+        if readers is not None:
+            readers.shutdown(wait=True, cancel_futures=True)
+
+    # --- Libraries ---
+
+    async def get_library_id(self, name: str, group_id: str) -> Optional[int]:
+        return await self.read(db.get_library_id, name, group_id)
+
+    async def get_library_names(self, library_id: int) -> List[str]:
+        return await self.read(db.get_library_names, library_id)
+
+    async def get_all_library_names(self, group_id: str) -> List[Tuple[str, List[str]]]:
+        return await self.read(db.get_all_library_names, group_id)
+
+    async def get_library_listing(self, group_id: str) -> Tuple[int, List[str]]:
+        return await self.read(db.get_library_listing, group_id)
+
+    async def match_library_names(self, text: str, group_id: str) -> List[Tuple[str, int]]:
+        # Builds the name trie from the DB when it isn't in memory yet
+        return await self.read(db.match_library_names, text, group_id)
+
+    async def suggest_library_names(self, text: str, group_id: str, limit: int = 3) -> List[str]:
+        return await self.read(db.suggest_library_names, text, group_id, limit)
+
+    async def get_group_libraries(self, group_id: str) -> List[Tuple[int, List[str]]]:
+        return await self.read(db.get_group_libraries, group_id)
+
+    async def create_library(self, name: str, group_id: str) -> int:
+        return await self.write(db.create_library, name, group_id)
+
+    async def get_or_create_library(self, names: List[str], group_id: str) -> int:
+        # On the writer queue, so two concurrent adds can't both create the library
+        return await self.write(db.get_or_create_library, names, group_id)
+
+    async def merge_libraries(self, src_lib_id: int, dest_lib_id: int):
+        await self.write(db.merge_libraries, src_lib_id, dest_lib_id)
+
+    # --- Names ---
+
+    async def add_name_to_library(self, name: str, library_id: int, group_id: str) -> bool:
+        return await self.write(db.add_name_to_library, name, library_id, group_id)
+
+    async def remove_name(self, name: str, group_id: str) -> bool:
+        return await self.write(db.remove_name, name, group_id)
+
+    # --- Images ---
+
+    async def pick_random_image(self, library_id: int) -> Optional[int]:
+        # Loads the library's ids from the DB when they aren't in memory yet
+        return await self.read(db.pick_random_image, library_id)
+
+    async def get_image(self, image_id: int) -> Tuple[Optional[Union[bytes, db.Segments]], str]:
+        return await self.read(db.get_image, image_id)
+
+    async def get_large_images(self, min_size: int, library_id: Optional[int] = None) -> List[Tuple[int, int]]:
+        return await self.read(db.get_large_images, min_size, library_id)
+
+    async def find_image_source(self, keys: List[str]) -> Optional[Tuple[str, str]]:
+        return await self.read(db.find_image_source, keys)
+
+    async def register_image_sources(self, keys: List[str], digest: str, phash: str):
+        await self.write(db.register_image_sources, keys, digest, phash)
+
+    async def add_image_by_digest(self, library_id: int, digest: str, phash: str) -> Optional[int]:
+        return await self.write(db.add_image_by_digest, library_id, digest, phash)
+
+    async def check_duplicate(self, library_id: int, new_hash: str, meme_type: str = "image",
+                              threshold: int = 18) -> Tuple[bool, Optional[Union[bytes, db.Segments]]]:
+        return await self.read(db.check_duplicate, library_id, new_hash, meme_type, threshold)
+
+    async def add_image(self, library_id: int, data: Union[bytes, db.Segments], phash: str,
+                        meme_type: str = "image") -> int:
+        return await self.write(db.add_image, library_id, data, phash, meme_type)
+
+    async def add_images_batch(self, library_id: int, items: List[Tuple[bytes, str]], threshold: int = 18,
+                               force: bool = False) -> Tuple[List[int], int]:
+        return await self.write(db.add_images_batch, library_id, items, threshold, force)
+
+    async def delete_image_by_hash(self, library_id: int, target_hash: str, meme_type: str = "image",
+                                   threshold: int = 3) -> bool:
+        return await self.write(db.delete_image_by_hash, library_id, target_hash, meme_type, threshold)
+
+    async def replace_image_data(self, image_id: int, data: bytes, phash: str) -> bool:
+        return await self.write(db.replace_image_data, image_id, data, phash)
+
+    async def sync_library(self, src_lib_id: int, dest_lib_id: int, threshold: int = 18) -> Tuple[int, int]:
+        return await self.write(db.sync_library, src_lib_id, dest_lib_id, threshold)
+
+    async def search_memes(self, group_id: str, query: str, limit: int = 10) -> List[Tuple[int, int]]:
+        return await self.read(db.search_memes, group_id, query, limit)
+
+    async def get_storage_stats(self) -> dict:
+        return await self.read(db.get_storage_stats)
+
+    # --- Usage stats ---
+
+    async def add_usage(self, counts: Dict[Tuple[str, int, int], int], day: int):
+        await self.write(db.add_usage, counts, day)
+
+    async def top_libraries(self, context_id: str, since_day: int, limit: int = 10) -> List[Tuple[int, int]]:
+        return await self.read(db.top_libraries, context_id, since_day, limit)
+
+    async def top_images(self, context_id: str, since_day: int, limit: int = 5) -> List[Tuple[int, int, int]]:
+        return await self.read(db.top_images, context_id, since_day, limit)
+
+
+repo = MemeRepository()
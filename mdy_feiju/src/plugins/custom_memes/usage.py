@@ -0,0 +1,84 @@
+import asyncio
+import datetime
+import os
+from collections import Counter
+from typing import Optional, Tuple
+
+from nonebot.log import logger
+
+from .repository import repo
+
+# Usage statistics (env overrides, like MEME_DB_PATH)
+USAGE_FLUSH_SECONDS = float(os.getenv("MEME_USAGE_FLUSH_SECONDS", "60"))
+USAGE_RETENTION_DAYS = int(os.getenv("MEME_USAGE_RETENTION_DAYS", "180"))
+
+UsageKey = Tuple[str, int, int]
+
+
+def today() -> int:
+    """Local day number used as the usage bucket."""
+    return datetime.date.today().toordinal()
+
+
+class UsageCounter:
+    """
+    Write-behind counter of sent memes, keyed by (context_id, library_id, image_id).
+
+    record() is a single dict increment on the event loop; flush() swaps the buffer
+    out and writes it to meme_usage in one transaction, bucketed by the day of the
+    flush. A failed write puts the counts back so the next flush retries them.
+    """
+
+    def __init__(self):
+        self._counts: "Counter[UsageKey]" = Counter()
+
+    def record(self, context_id: str, library_id: int, image_id: int):
+        self._counts[(context_id, library_id, image_id)] += 1
+
+    @property
+    def pending(self) -> int:
+        return len(self._counts)
+
+    async def flush(self) -> int:
+        """Write buffered counts to the DB. Returns the number of keys written."""
+        if not self._counts:
+            return 0
+        counts, self._counts = self._counts, Counter()
+        try:
+            await repo.add_usage(counts, today())
+        except Exception:
+            self._counts.update(counts)
+            raise
+        return len(counts)
+
+
+usage_counter = UsageCounter()
+
+_flush_task: Optional[asyncio.Task] = None
+
+
+async def _flush_loop(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await usage_counter.flush()
+        except Exception:
+            logger.exception("[CustomMemes] Failed to flush usage stats")
+
+
+def start_flusher(interval: float = USAGE_FLUSH_SECONDS):
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_loop(interval))
+
+
+async def stop_flusher():
+    """Stop the periodic flush and write whatever is still buffered."""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    try:
+        await usage_counter.flush()
+    except Exception:
+        logger.exception("[CustomMemes] Failed to flush usage stats on shutdown")
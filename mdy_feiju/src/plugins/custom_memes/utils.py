@@ -1,57 +1,145 @@
+import asyncio
+import os
+import random
 import httpx
 from io import BytesIO
-from PIL import Image
+from typing import Iterator, List, Optional, Tuple
+from PIL import GifImagePlugin, Image, ImageChops, ImageSequence
 from nonebot.adapters.onebot.v11 import GroupMessageEvent, PrivateMessageEvent, MessageEvent
 from nonebot.log import logger
 
 MAX_DIMENSION = 2048
 
-def resize_image(img_data: bytes) -> bytes:
+# Downloader tuning (env overrides, like MEME_DB_PATH)
+DOWNLOAD_MAX_BYTES = int(float(os.getenv("MEME_DOWNLOAD_MAX_MB", "20")) * 1024 * 1024)
+DOWNLOAD_CONCURRENCY = int(os.getenv("MEME_DOWNLOAD_CONCURRENCY", "4"))
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF_BASE = 0.5
+DOWNLOAD_BACKOFF_MAX = 8.0
+
+# Pillow's GIF writer buffers every frame before writing; these helpers let us write frame by frame
+_GIF_STREAM_HELPERS = ("_normalize_mode", "_normalize_palette", "_get_global_header", "_write_frame_data")
+_CAN_STREAM_GIF = all(hasattr(GifImagePlugin, name) for name in _GIF_STREAM_HELPERS)
+
+def probe_image(img_data: bytes) -> Optional[Tuple[str, int, int]]:
     """
-    Resize image if dimensions exceed MAX_DIMENSION.
-    Preserves format (GIF, PNG, JPEG).
+    (format, width, height) from the image header, without decoding any pixels.
+    Returns None if the data isn't a readable image.
     """
     try:
         img = Image.open(BytesIO(img_data))
-        format = img.format or "PNG"
-        w, h = img.size
-        
-        if max(w, h) > MAX_DIMENSION:
-            # Calculate new size
-            ratio = MAX_DIMENSION / max(w, h)
-            new_size = (int(w * ratio), int(h * ratio))
-            
-            buf = BytesIO()
-            
-            if getattr(img, "is_animated", False):
-                # Handle GIF
-                frames = []
-                for frame in range(img.n_frames):
-                    img.seek(frame)
-                    # Resize frame
-                    frame_img = img.copy()
-                    frame_img.thumbnail(new_size)
-                    frames.append(frame_img)
-                
-                # Save as GIF
-                frames[0].save(
-                    buf, 
-                    format="GIF", 
-                    save_all=True, 
-                    append_images=frames[1:], 
-                    loop=img.info.get("loop", 0),
-                    duration=img.info.get("duration", 100)
-                )
-            else:
-                # Handle static image
-                img.thumbnail(new_size)
-                img.save(buf, format=format)
-                
-            return buf.getvalue()
-            
-        # If no resize needed, return original data
+        return (img.format or "PNG"), img.size[0], img.size[1]
+    except Exception:
+        return None
+
+def _target_size(w: int, h: int, max_dim: int) -> Tuple[int, int]:
+    ratio = max_dim / max(w, h)
+    return max(1, int(w * ratio)), max(1, int(h * ratio))
+
+def _iter_resized_frames(img: Image.Image, new_size: Tuple[int, int]) -> Iterator[Tuple[Image.Image, dict]]:
+    """
+    Yield (resized_frame, frame_params) one frame at a time, so only the current
+    frame is ever held in memory. Durations and disposal are kept per frame.
+    """
+    for frame in ImageSequence.Iterator(img):
+        params = {
+            "duration": frame.info.get("duration", 100),
+            "disposal": getattr(frame, "disposal_method", 0),
+        }
+        # Resample in RGBA (a palette image would be resized with NEAREST)
+        yield frame.convert("RGBA").resize(new_size, Image.Resampling.LANCZOS), params
+
+def _save_gif_frames(buf: BytesIO, frames: Iterator[Tuple[Image.Image, dict]], loop: int):
+    """
+    Encode RGBA frames into buf as they arrive; each frame after the first carries its own palette.
+    Like Pillow, an opaque frame over a kept, opaque previous frame is written as just the
+    changed rectangle. Only the previous frame is held for that comparison.
+    """
+    first = True
+    previous = None
+    previous_disposal = 0
+    for frame, params in frames:
+        params = dict(params)
+        offset = (0, 0)
+        full_frame = frame.convert("RGB") if frame.getchannel("A").getextrema()[0] == 255 else None
+        if previous is not None and full_frame is not None and previous_disposal in (0, 1):
+            # Both frames opaque: compare RGB (getbbox on RGBA only looks at alpha)
+            bbox = ImageChops.difference(previous, full_frame).getbbox()
+            if bbox is None:
+                # Identical to the previous frame; still written (1px) to keep its duration
+                bbox = (0, 0, 1, 1)
+            frame = frame.crop(bbox)
+            offset = bbox[:2]
+
+        encoded = GifImagePlugin._normalize_mode(frame)
+        encoded = GifImagePlugin._normalize_palette(encoded, None, params)
+        if "transparency" in encoded.info:
+            params["transparency"] = encoded.info["transparency"]
+        if first:
+            for block in GifImagePlugin._get_global_header(encoded, {"loop": loop, "duration": params["duration"]}):
+                buf.write(block)
+        else:
+            params["include_color_table"] = True
+        GifImagePlugin._write_frame_data(buf, encoded, offset, params)
+
+        first = False
+        previous = full_frame
+        previous_disposal = params.get("disposal", 0)
+    buf.write(b";")
+
+def _resize_animated(img: Image.Image, new_size: Tuple[int, int]) -> bytes:
+    buf = BytesIO()
+    loop = img.info.get("loop", 0)
+    frames = _iter_resized_frames(img, new_size)
+    if _CAN_STREAM_GIF:
+        _save_gif_frames(buf, frames, loop)
+    else:
+        # Older/newer Pillow without the helpers: let Pillow buffer the frames
+        resized = []
+        durations = []
+        disposals = []
+        for frame, params in frames:
+            resized.append(frame)
+            durations.append(params["duration"])
+            disposals.append(params["disposal"])
+        resized[0].save(buf, format="GIF", save_all=True, append_images=resized[1:],
+                        loop=loop, duration=durations, disposal=disposals)
+    return buf.getvalue()
+
+def resize_image(img_data: bytes, max_dim: int = MAX_DIMENSION) -> bytes:
+    """
+    Resize image if dimensions exceed max_dim (MAX_DIMENSION by default).
+    Preserves format (GIF, PNG, JPEG); other animated formats are saved as GIF.
+
+    The size comes from a header probe, so images that already fit are returned
+    untouched without decoding. JPEGs are decoded at a reduced DCT scale (draft
+    mode) and animations are resized and encoded one frame at a time.
+    """
+    probe = probe_image(img_data)
+    if probe is None:
+        return img_data
+    format, w, h = probe
+
+    # If no resize needed, return original data
+    if max(w, h) <= max_dim:
         return img_data
-            
+
+    new_size = _target_size(w, h, max_dim)
+    try:
+        img = Image.open(BytesIO(img_data))
+
+        if getattr(img, "is_animated", False):
+            return _resize_animated(img, new_size)
+
+        if format == "JPEG":
+            # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding; thumbnail does the rest
+            img.draft(img.mode, new_size)
+        img.thumbnail(new_size, Image.Resampling.LANCZOS)
+
+        buf = BytesIO()
+        img.save(buf, format=format)
+        return buf.getvalue()
+
     except Exception as e:
         logger.error(f"Failed to resize image: {e}")
     return img_data
@@ -70,16 +158,80 @@ def get_context_id(event: MessageEvent) -> str:
         # Fallback for other types if any
         return f"unknown_{event.user_id}"
 
-async def download_url(url: str) -> bytes:
-    max_retries = 3
-    for attempt in range(max_retries + 1):
+class DownloadTooLargeError(Exception):
+    """The response is bigger than DOWNLOAD_MAX_BYTES; not retried."""
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+_download_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared keep-alive client, created on first use and closed by close_http_client()."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=DOWNLOAD_CONCURRENCY * 2,
+                max_keepalive_connections=DOWNLOAD_CONCURRENCY,
+                keepalive_expiry=30.0,
+            ),
+            follow_redirects=True,
+        )
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def _get_download_semaphore() -> asyncio.Semaphore:
+    # Created lazily so it binds to the running event loop
+    global _download_semaphore
+    if _download_semaphore is None:
+        _download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+    return _download_semaphore
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        status = e.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(e, httpx.RequestError)
+
+async def _fetch(url: str, max_bytes: int) -> bytes:
+    async with get_http_client().stream("GET", url) as resp:
+        resp.raise_for_status()
+        length = resp.headers.get("content-length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise DownloadTooLargeError(f"图片太大了（超过 {max_bytes / 1024 / 1024:.3g} MB）")
+
+        buf = bytearray()
+        async for chunk in resp.aiter_bytes():
+            buf += chunk
+            # Content-Length can be missing or wrong; stop as soon as we're over the cap
+            if len(buf) > max_bytes:
+                raise DownloadTooLargeError(f"图片太大了（超过 {max_bytes / 1024 / 1024:.3g} MB）")
+        return bytes(buf)
+
+async def download_url(url: str, max_bytes: int = DOWNLOAD_MAX_BYTES) -> bytes:
+    """
+    Download through the shared client, at most DOWNLOAD_CONCURRENCY at a time.
+    Transient failures (network errors, 429, 5xx) are retried with exponential backoff and jitter.
+    A slot is only held while a request is in flight, not during the backoff sleeps.
+    """
+    for attempt in range(DOWNLOAD_RETRIES + 1):
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.get(url)
-                resp.raise_for_status()
-                return resp.content
+            async with _get_download_semaphore():
+                return await _fetch(url, max_bytes)
         except (httpx.RequestError, httpx.HTTPStatusError) as e:
-            if attempt == max_retries:
-                logger.error(f"Failed to download image after {max_retries} retries: {e}")
+            if attempt == DOWNLOAD_RETRIES or not _is_retryable(e):
+                logger.error(f"Failed to download image after {attempt + 1} attempt(s): {e}")
                 raise e
-            logger.warning(f"Download failed (attempt {attempt + 1}/{max_retries + 1}), retrying... Error: {e}")
+            delay = min(DOWNLOAD_BACKOFF_MAX, DOWNLOAD_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Download failed (attempt {attempt + 1}/{DOWNLOAD_RETRIES + 1}), retrying in {delay:.1f}s... Error: {e}")
+            await asyncio.sleep(delay)
+
+async def download_many(urls: List[str], max_bytes: int = DOWNLOAD_MAX_BYTES) -> List[bytes]:
+    """Download all urls concurrently (bounded by the shared limit), results in input order."""
+    return list(await asyncio.gather(*(download_url(url, max_bytes) for url in urls)))